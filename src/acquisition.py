@@ -0,0 +1,442 @@
+from metrics import REGISTRY
+from readiness import READINESS
+from collections import deque
+import numpy as np
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# LJM fills every channel of a scan the device skipped (buffer overflow, auto-recovery) with this
+SKIP_MARKER = -9999.0
+# the T7 core timer ticks at 40 MHz
+CORE_TIMER_HZ = 40e6
+
+class ScanRingBuffer():
+    """
+    Preallocated single-producer/single-consumer ring of stream scans, shape (capacity, num_channels).
+    The acquisition thread only ever advances `head` and the event loop only ever advances `tail`,
+    so the two sides never need a lock- each index is published after the copy it covers.
+    """
+    def __init__(self, capacity: int, num_channels: int):
+        self.capacity = capacity
+        self.num_channels = num_channels
+        self.buf = np.empty((capacity, num_channels))
+        self.index = np.empty(capacity, dtype=np.int64) # stream scan index of each row
+        self.head = 0 # total scans written
+        self.tail = 0 # total scans consumed
+        self.overruns = 0 # scans dropped because the consumer fell a whole buffer behind
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def push(self, values, first_index: int = None) -> int:
+        """
+        Append a block of scans, the first of which is scan number `first_index` of the stream
+        (defaults to continuing from the last pushed scan).
+        """
+        if first_index is None:
+            first_index = self.index[(self.head - 1) % self.capacity] + 1 if self.head else 0
+        block = np.asarray(values, dtype=self.buf.dtype).reshape(-1, self.num_channels)
+        rows = block.shape[0]
+        free = self.capacity - (self.head - self.tail)
+        if rows > free:
+            self.overruns += rows - free
+            block = block[:free]
+            rows = free
+        start = self.head % self.capacity
+        first = min(rows, self.capacity - start)
+        self.buf[start:start + first] = block[:first]
+        self.buf[:rows - first] = block[first:]
+        indices = np.arange(first_index, first_index + rows)
+        self.index[start:start + first] = indices[:first]
+        self.index[:rows - first] = indices[first:]
+        self.head += rows
+        return rows
+
+    def pop_into(self, out: np.ndarray, index_out: np.ndarray) -> int:
+        """
+        Copy up to len(out) of the oldest scans into `out` (rows, num_channels), which may be a view,
+        and their scan indices into `index_out`. Returns the number of rows filled- nothing is allocated.
+        """
+        rows = min(self.head - self.tail, out.shape[0])
+        start = self.tail % self.capacity
+        first = min(rows, self.capacity - start)
+        out[:first] = self.buf[start:start + first]
+        out[first:rows] = self.buf[:rows - first]
+        index_out[:first] = self.index[start:start + first]
+        index_out[first:rows] = self.index[:rows - first]
+        self.tail += rows
+        return rows
+
+    def pop(self, max_rows: int = None) -> np.ndarray:
+        return self.pop_indexed(max_rows)[1]
+
+    def pop_indexed(self, max_rows: int = None):
+        """
+        Returns (scan indices, scans) for everything buffered, oldest first.
+        """
+        rows = self.head - self.tail
+        if max_rows is not None:
+            rows = min(rows, max_rows)
+        out = np.empty((rows, self.num_channels))
+        indices = np.empty(rows, dtype=np.int64)
+        start = self.tail % self.capacity
+        first = min(rows, self.capacity - start)
+        out[:first] = self.buf[start:start + first]
+        out[first:] = self.buf[:rows - first]
+        indices[:first] = self.index[start:start + first]
+        indices[first:] = self.index[:rows - first]
+        self.tail += rows
+        return indices, out
+
+class BlockPool():
+    """
+    Reusable (max_rows, num_columns) float64 blocks for the consumer side of the stream, so a steady
+    stream assembles its batches without allocating. A block goes back with release() once whoever
+    holds it last (normally the recorder thread) is done with it. If every block is out, acquire()
+    allocates a new one rather than stalling acquisition- the pool only grows to what it actually needs.
+    """
+    def __init__(self, max_rows: int, num_columns: int, blocks: int = 16):
+        self.max_rows = max_rows
+        self.num_columns = num_columns
+        self.free = deque(np.empty((max_rows, num_columns)) for _ in range(blocks))
+        self.size = blocks
+        self.size_gauge = REGISTRY.gauge("block_pool_blocks", "Batch blocks allocated by the pool")
+        self.size_gauge.set(blocks)
+
+    def acquire(self) -> np.ndarray:
+        try:
+            return self.free.popleft()
+        except IndexError:
+            self.size += 1
+            self.size_gauge.set(self.size)
+            return np.empty((self.max_rows, self.num_columns))
+
+    def release(self, block: np.ndarray):
+        # deque append/popleft are atomic, so the recorder thread can release while the loop acquires
+        self.free.append(block)
+
+    def stats(self):
+        return {"blocks": self.size, "free": len(self.free), "max_rows": self.max_rows}
+
+class StreamTimebase():
+    """
+    Per-scan timestamps derived from the scan's index in the stream and the scan rate the device
+    actually configured, so they don't depend on when or how often eStreamRead returns.
+    `anchor` picks what time zero is: 'stream' (the first scan, the default), 'monotonic' (the
+    host's time.monotonic() at stream start) or 'core_timer' (the T7 CORE_TIMER at stream start, in seconds).
+    A stream restarted at another rate adds a segment- scan indices keep counting up across it, and
+    its first scan is placed after the last one of the old rate by however long the restart took.
+    """
+    ANCHORS = ("stream", "monotonic", "core_timer")
+
+    def __init__(self, scan_rate: float, anchor: str = "stream", start_monotonic: float = None, core_timer: int = None):
+        if anchor not in self.ANCHORS:
+            raise Exception(f"Unknown timestamp anchor '{anchor}', expected one of {list(self.ANCHORS)}")
+        if anchor == "core_timer" and core_timer is None:
+            raise Exception("Timestamp anchor 'core_timer' needs a CORE_TIMER reading at stream start")
+        self.scan_rate = float(scan_rate)
+        self.anchor = anchor
+        self.start_monotonic = time.monotonic() if start_monotonic is None else start_monotonic
+        self.core_timer = core_timer
+        self.origin = 0.0
+        if anchor == "monotonic":
+            self.origin = self.start_monotonic
+        elif anchor == "core_timer":
+            self.origin = core_timer / CORE_TIMER_HZ
+        # (first scan index, its time, scan rate) per rate- replaced rather than appended to, the
+        # stream thread adds segments while the event loop stamps
+        self.segments = [(0, self.origin, self.scan_rate)]
+
+    def add_segment(self, first_index: int, gap_secs: float, scan_rate: float):
+        """
+        Scans from `first_index` on are at `scan_rate`, the first of them `gap_secs` after the scan before it.
+        """
+        index, start, rate = self.segments[-1]
+        start += (first_index - 1 - index) / rate + gap_secs
+        self.segments = self.segments + [(first_index, start, float(scan_rate))]
+        self.scan_rate = float(scan_rate)
+
+    def times(self, indices: np.ndarray) -> np.ndarray:
+        return self.stamp(np.array(indices, dtype=np.float64), None)
+
+    def stamp(self, column: np.ndarray, decimals: int = 5) -> np.ndarray:
+        """
+        Turn a column of scan indices into timestamps in place.
+        """
+        segments = self.segments
+        if len(segments) == 1 or column.shape[0] == 0 or column[0] >= segments[-1][0]:
+            self._stamp_segment(column, *segments[-1])
+        else:
+            # only a block that straddles a rate change gets here
+            which = np.searchsorted([first for first, _, _ in segments], column, side="right") - 1
+            for k in np.unique(which):
+                rows = which == k
+                part = column[rows]
+                column[rows] = self._stamp_segment(part, *segments[k])
+        if decimals is not None:
+            np.round(column, decimals, out=column)
+        return column
+
+    @staticmethod
+    def _stamp_segment(column: np.ndarray, first: int, start: float, rate: float):
+        if first:
+            np.subtract(column, first, out=column)
+        np.divide(column, rate, out=column)
+        np.add(column, start, out=column)
+        return column
+
+    def describe(self):
+        return {
+            "scan_rate": self.scan_rate,
+            "timestamp_anchor": self.anchor,
+            "time_origin": self.origin,
+            "stream_start_monotonic": self.start_monotonic,
+            "stream_start_core_timer": self.core_timer,
+        }
+
+    def describe_segments(self):
+        # [first scan index, its time, scan rate] after every rate change
+        return [[first, round(start, 5), rate] for first, start, rate in self.segments[1:]]
+
+class StreamReader(threading.Thread):
+    """
+    Owns the blocking eStreamRead calls for one stream handle and pushes every scan block
+    into a ScanRingBuffer, keeping USB latency off the asyncio event loop. Every block is also passed
+    to `monitors` (see SafetyMonitor) right here on this thread, before it is queued.
+    Scans the device skipped are counted and turned into NaN rows, so they keep their place on the
+    time axis without ever looking like real readings.
+    If a read fails (the device dropped off USB, LJM's buffer overflowed...) and there's a `reconnect`
+    callable, it is retried with exponential backoff until the stream is back- see _recover.
+    With a `restart` callable the stream can be switched to another rate between reads, see request_rate.
+    """
+    def __init__(self, handle: int, ring: ScanRingBuffer, monitors=None, data_ready: threading.Event = None,
+                 name: str = "labjack-stream", scan_rate: float = None, reconnect=None, notify=None,
+                 backoff=(0.1, 5.0), restart=None, timebase: StreamTimebase = None):
+        super().__init__(name=name, daemon=True)
+        self.handle = handle
+        self.ring = ring
+        self.monitors = monitors or []
+        # set after every push, for a consumer thread waiting on new scans
+        self.data_ready = data_ready
+        self.scan_rate = scan_rate
+        # reconnect() reopens the stream and returns (handle, time.monotonic() at stream start)
+        self.reconnect = reconnect
+        self.notify = notify
+        self.backoff = backoff
+        # restart(sample_rate, reads_per_sec) restarts the stream and returns (scan rate, time.monotonic() at stream start)
+        self.restart = restart
+        self.timebase = timebase
+        self.rate_request = None
+        self.rate_error = None
+        self.wake = threading.Event()
+        labels = {"stream": name}
+        self.read_latency = REGISTRY.histogram("ljm_stream_read_seconds", "Time spent in eStreamRead", labels)
+        self.backlog_hist = REGISTRY.histogram("ljm_device_backlog_scans", "Device scan backlog after each read", labels,
+                                               buckets=[0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000])
+        self.scans_total = REGISTRY.counter("ljm_scans", "Scans read from the device, including skipped ones", labels)
+        self.skipped_total = REGISTRY.counter("ljm_skipped_scans", "Scans the device skipped", labels)
+        self.recovery_time = REGISTRY.histogram("ljm_stream_recovery_seconds", "From a failed stream read to the stream running again",
+                                                labels, buckets=[0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300])
+        self.connected = REGISTRY.gauge("ljm_stream_connected", "1 while the stream is running, 0 while reconnecting", labels)
+        self.connected.set(1)
+        self.running = False
+        self.error = None
+        self.reads = 0
+        self.scans = 0
+        self.scan_index = 0 # scans the device has produced, including skipped ones
+        self.skipped_scans = 0
+        self.skip_events = 0
+        self.last_scan_skipped = False
+        self.scratch = None # reused for every read, the ring keeps its own copy
+        self.device_backlog = 0
+        self.max_device_backlog = 0
+        self.ljm_backlog = 0
+        self.max_ljm_backlog = 0
+        self.last_read_time = time.monotonic()
+        self.reconnects = 0
+        self.gap_scans = 0 # scans lost while reconnecting
+        self.gaps = [] # (scan index, scans lost) per reconnect
+
+    def start(self):
+        self.running = True
+        super().start()
+        READINESS.set(self.name, "ready")
+
+    def stop(self, timeout: float = 1.0):
+        self.running = False
+        self.wake.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        # imported here so the buffers and timebase work without the LJM library, see devices.py
+        from labjack import ljm
+        while self.running:
+            start = time.perf_counter()
+            try:
+                read_val = ljm.eStreamRead(self.handle)
+            except Exception as e:
+                if self.reconnect is None or not self.running:
+                    self.error = e
+                    logger.error(f"Stream read failed, acquisition stopped: {e}")
+                    READINESS.set(self.name, "failed", str(e))
+                    break
+                self._recover(e)
+                continue
+            read_time = self.last_read_time = time.monotonic()
+            self.read_latency.observe(time.perf_counter() - start)
+            block = self._copy_block(read_val[0])
+            # every real reading is well above the marker, so one min() covers the common no-skip read
+            if block.size and block.min() <= SKIP_MARKER:
+                skipped = (block == SKIP_MARKER).any(axis=1)
+                self._mark_skipped(block, skipped)
+                self.last_scan_skipped = bool(skipped[-1])
+            elif block.size:
+                self.last_scan_skipped = False
+            for monitor in self.monitors:
+                try:
+                    monitor.check(block, read_time, read_val[1] + read_val[2])
+                except Exception as e:
+                    logger.error(f"Safety monitor failed: {e}")
+            overruns = self.ring.overruns
+            self.scans += self.ring.push(block, self.scan_index)
+            self.scan_index += block.shape[0]
+            if self.data_ready is not None:
+                self.data_ready.set()
+            if self.ring.overruns != overruns:
+                logger.warning(f"Scan ring buffer full, dropped {self.ring.overruns - overruns} scans")
+            self.device_backlog = read_val[1]
+            self.ljm_backlog = read_val[2]
+            self.max_device_backlog = max(self.max_device_backlog, self.device_backlog)
+            self.backlog_hist.observe(self.device_backlog)
+            self.scans_total.inc(block.shape[0])
+            self.max_ljm_backlog = max(self.max_ljm_backlog, self.ljm_backlog)
+            self.reads += 1
+            if self.reads % 1000 == 0:
+                logger.info(f"{self.reads} samples obtained - {self.stats()}")
+            # once LJM's buffer is drained, so no scans are thrown away with the old stream
+            if self.rate_request is not None and (self.ljm_backlog == 0 or time.monotonic() - self.rate_request[3] > 0.5):
+                self._change_rate(*self.rate_request)
+
+    def request_rate(self, sample_rate: int, reads_per_sec: int) -> threading.Event:
+        """
+        Ask the reader to restart the stream at `sample_rate` after its current read. The returned Event
+        is set once it has, with rate_error set if the restart failed (the stream is then reopened at
+        the old rate).
+        """
+        done = threading.Event()
+        self.rate_request = (sample_rate, reads_per_sec, done, time.monotonic())
+        return done
+
+    def _change_rate(self, sample_rate: int, reads_per_sec: int, done: threading.Event, requested: float):
+        self.rate_request = None
+        # when the last scan we got was sampled, as in _recover
+        last_scan = self.last_read_time - (self.device_backlog + self.ljm_backlog) / self.scan_rate
+        try:
+            scan_rate, started = self.restart(sample_rate, reads_per_sec)
+        except Exception as e:
+            self.rate_error = e
+            done.set()
+            if self.reconnect is None:
+                # nothing to reopen the stream with, same as a failed read
+                self.error = e
+                self.running = False
+                logger.error(f"Stream restart failed, acquisition stopped: {e}")
+                READINESS.set(self.name, "failed", str(e))
+                return
+            self._recover(e)
+            return
+        self.timebase.add_segment(self.scan_index, started - last_scan, scan_rate)
+        self.scan_rate = scan_rate
+        self.last_read_time = started
+        self.device_backlog = self.ljm_backlog = 0
+        self.last_scan_skipped = False
+        for monitor in self.monitors:
+            monitor.set_sample_rate(scan_rate)
+        self.rate_error = None
+        done.set()
+        logger.info(f"Stream on {self.name} switched to {scan_rate} scans/s at scan {self.scan_index}, "
+                    f"{(started - last_scan) * 1000:.1f} ms between scans, {(started - requested) * 1000:.1f} ms after the request")
+
+    def _recover(self, error: Exception):
+        """
+        Reconnect after a failed read, backing off from backoff[0] to backoff[1] seconds between attempts
+        until it works or the reader is stopped. The recording carries on: the first lost scan becomes
+        a NaN row (flagged skipped) and the scan index jumps by the length of the outage, so the
+        timestamps after it stay on the same time axis.
+        """
+        lost = time.monotonic()
+        self.connected.set(0)
+        READINESS.set(self.name, "reconnecting", str(error))
+        logger.error(f"Stream read failed on {self.name}, reconnecting: {error}")
+        if self.notify is not None:
+            self.notify(f"LabJack stream lost ({error}), reconnecting...")
+        # when the last scan we got was sampled, going by what was still queued behind it
+        last_scan = self.last_read_time - (self.device_backlog + self.ljm_backlog) / self.scan_rate
+        delay, attempts = self.backoff[0], 0
+        while self.running:
+            attempts += 1
+            try:
+                self.handle, started = self.reconnect()
+                break
+            except Exception as e:
+                logger.warning(f"Reconnect attempt {attempts} on {self.name} failed: {e}, retrying in {delay:.1f} s")
+            self.wake.wait(delay)
+            delay = min(delay * 2, self.backoff[1])
+        else:
+            return
+        missing = max(1, round((started - last_scan) * self.scan_rate) - 1)
+        self.ring.push(np.full((1, self.ring.num_channels), np.nan), self.scan_index)
+        self.gaps.append((self.scan_index, missing))
+        self.scan_index += missing
+        self.gap_scans += missing
+        self.reconnects += 1
+        self.device_backlog = self.ljm_backlog = 0
+        self.last_scan_skipped = False
+        took = time.monotonic() - lost
+        self.recovery_time.observe(took)
+        self.connected.set(1)
+        READINESS.set(self.name, "ready")
+        message = f"LabJack stream recovered after {took:.2f} s ({attempts} attempts), {missing} scans lost"
+        logger.warning(message)
+        if self.notify is not None:
+            self.notify(message)
+
+    def _copy_block(self, values) -> np.ndarray:
+        # LJM hands back a flat list of the same length every read, copy it into the same buffer each time
+        if self.scratch is None or self.scratch.size != len(values):
+            self.scratch = np.empty(len(values))
+        self.scratch[:] = values
+        return self.scratch.reshape(-1, self.ring.num_channels)
+
+    def _mark_skipped(self, block: np.ndarray, skipped: np.ndarray):
+        count = int(skipped.sum())
+        # each run of skipped scans is one event, which may have started in the previous block
+        starts = skipped & ~np.concatenate(([self.last_scan_skipped], skipped[:-1]))
+        if starts.any():
+            self.skip_events += int(starts.sum())
+            logger.warning(f"Device skipped {count} scans around scan {self.scan_index} "
+                           f"(device backlog {self.device_backlog}), {self.skipped_scans + count} skipped so far")
+        block[skipped] = np.nan
+        self.skipped_scans += count
+        self.skipped_total.inc(count)
+
+    def stats(self):
+        return {
+            "reads": self.reads,
+            "scans": self.scans,
+            "scan_index": self.scan_index,
+            "skipped_scans": self.skipped_scans,
+            "skip_events": self.skip_events,
+            "overruns": self.ring.overruns,
+            "ring_fill": len(self.ring),
+            "device_backlog": self.device_backlog,
+            "max_device_backlog": self.max_device_backlog,
+            "ljm_backlog": self.ljm_backlog,
+            "max_ljm_backlog": self.max_ljm_backlog,
+            "reconnects": self.reconnects,
+            "gap_scans": self.gap_scans,
+        }
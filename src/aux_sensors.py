@@ -0,0 +1,144 @@
+"""
+Auxiliary (non-LabJack) sensors. Each one is polled on its own thread at its own rate, so slow
+buses like SPI never touch the event loop. Readings are stamped on the LabJack stream's time axis:
+seconds since the stream started, measured on the monotonic clock.
+
+Sensors are listed in [aux_sensors] as `name = type key=value ...`, e.g.
+    rtd_external = max31865 rate_hz=10 cs_pin=D5 wires=3
+"""
+
+from configparser import ConfigParser
+from readiness import READINESS
+from collections import deque
+from typing import Dict
+import numpy as np
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+AUX_SENSORS = {}
+
+def register_aux_sensor(kind: str):
+    def wrap(cls):
+        AUX_SENSORS[kind] = cls
+        return cls
+    return wrap
+
+class AuxSensor(threading.Thread):
+    """
+    Base class for polled sensors- subclasses implement setup() for hardware init and read() for one sample.
+    """
+    def __init__(self, name: str, options: Dict[str, str], clock):
+        super().__init__(name=f"aux-{name}", daemon=True)
+        self.sensor_name = name
+        self.options = options
+        self.rate_hz = float(options.get("rate_hz", 10))
+        self.clock = clock
+        self.running = False
+        self.latest = None # (time, value)
+        self.pending = deque(maxlen=int(self.rate_hz * 600))
+        self.failures = 0
+
+    def setup(self):
+        pass
+
+    def read(self) -> float:
+        raise NotImplementedError
+
+    def start(self):
+        self.running = True
+        super().start()
+
+    def stop(self, timeout: float = 1.0):
+        self.running = False
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        READINESS.set(f"aux:{self.sensor_name}", "starting")
+        try:
+            self.setup()
+        except Exception as e:
+            logger.error(f"Failed to set up aux sensor {self.sensor_name}: {e}")
+            READINESS.set(f"aux:{self.sensor_name}", "failed", str(e))
+            return
+        READINESS.set(f"aux:{self.sensor_name}", "ready")
+        period = 1 / self.rate_hz
+        deadline = time.monotonic()
+        while self.running:
+            try:
+                value = self.read()
+                reading = (self.clock(), value)
+                self.latest = reading
+                self.pending.append(reading)
+                if self.failures:
+                    logger.info(f"Aux sensor {self.sensor_name} recovered after {self.failures} failed reads")
+                self.failures = 0
+            except Exception as e:
+                if self.failures == 0:
+                    logger.error(f"Failed to read aux sensor {self.sensor_name}: {e}")
+                self.failures += 1
+            deadline += period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                deadline = time.monotonic()
+
+    def drain(self) -> np.ndarray:
+        """
+        Returns every reading since the last drain as a (rows, 2) array of (time, value).
+        """
+        rows = []
+        while self.pending:
+            rows.append(self.pending.popleft())
+        readings = np.array(rows, dtype=np.float64).reshape(-1, 2)
+        np.round(readings[:, 0], 5, out=readings[:, 0])
+        return readings
+
+@register_aux_sensor("max31865")
+class Max31865Sensor(AuxSensor):
+    def setup(self):
+        # imported here so hosts without the Blinka stack can still run everything else
+        import board
+        from digitalio import DigitalInOut
+        import adafruit_max31865
+        cs = DigitalInOut(getattr(board, self.options.get("cs_pin", "D5")))
+        self.sensor = adafruit_max31865.MAX31865(board.SPI(), cs, wires=int(self.options.get("wires", 3)))
+
+    def read(self) -> float:
+        return self.sensor.temperature
+
+class AuxSensors():
+    """
+    Owns every configured auxiliary sensor. `time_origin` is moved to the LabJack stream start so
+    aux timestamps share the stream's time axis.
+    """
+    def __init__(self, config: ConfigParser):
+        self.time_origin = time.monotonic()
+        self.sensors: Dict[str, AuxSensor] = {}
+        if not config.has_section("aux_sensors"):
+            return
+        for name, spec in config["aux_sensors"].items():
+            kind, *opts = spec.split()
+            if kind not in AUX_SENSORS:
+                raise Exception(f"Unknown aux sensor type '{kind}' for {name}")
+            options = dict(opt.split("=", 1) for opt in opts)
+            self.sensors[name] = AUX_SENSORS[kind](name, options, self.clock)
+
+    def clock(self) -> float:
+        return time.monotonic() - self.time_origin
+
+    def start(self):
+        for sensor in self.sensors.values():
+            sensor.start()
+
+    def stop(self):
+        for sensor in self.sensors.values():
+            sensor.stop()
+
+    def latest(self, name: str):
+        reading = self.sensors[name].latest if name in self.sensors else None
+        return None if reading is None else reading[1]
@@ -0,0 +1,310 @@
+"""
+Benchmarks for the acquisition -> calibration -> recording -> telemetry pipeline, run against the
+simulated LabJack (mock_ljm.py), so they work on the Pi or any other machine.
+
+Each stage is timed on its own, then the whole LabjackInterface + DataSender stack is run against a
+real-time simulated stream, across every combination of sample rate, channel count and client count:
+
+    python benchmark.py --rates 300,1000,5000 --channels 14,28 --clients 1,4 --out bench.json
+    python benchmark.py --stages pipeline --rates 2000 --compare bench.json
+
+Results are tagged with the git commit, so runs from different commits can be compared with --compare.
+"""
+
+from unittest.mock import patch
+from configparser import ConfigParser
+import mock_ljm
+import numpy as np
+import subprocess
+import itertools
+import argparse
+import platform
+import resource
+import tempfile
+import asyncio
+import logging
+import json
+import time
+import os
+
+STAGES = ["ring", "calibration", "csv", "binary", "telemetry", "pipeline"]
+CLIENT_MODES = [("json", "latest"), ("compact", "latest"), ("json", "envelope"), ("json", "lttb")]
+
+sim = mock_ljm.SimLJM()
+
+def bench_config(sample_rate: int, channels: int, reads_per_sec: int) -> ConfigParser:
+    """
+    config_sim.ini with `channels` streamed sensors- extra ones are thermocouples on further AINs.
+    """
+    config = ConfigParser()
+    config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config_sim.ini"))
+    mapping = dict(config["sensor_channel_mapping"])
+    for i in range(len(mapping), channels):
+        mapping[f"thermo_{i + 1}"] = f"AIN{i}"
+    mapping = dict(list(mapping.items())[:channels])
+    for section in config.sections():
+        if section.startswith("sequence_") or section == "aux_sensors":
+            config.remove_section(section)
+    config.remove_section("sensor_channel_mapping")
+    config.read_dict({
+        "general": {"sample_rate": str(sample_rate), "reads_per_sec": str(reads_per_sec)},
+        "sensor_channel_mapping": mapping,
+        "sensor_negative_channels": {chan: ain for chan, ain in config["sensor_negative_channels"].items() if chan in mapping},
+        "sim": {"speed": "1"},
+    })
+    return config
+
+def summarize(latencies, rows: int, channels: int, elapsed: float, cpu: float):
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "scans_per_sec": rows / elapsed,
+        "samples_per_sec": rows * channels / elapsed,
+        "batches": int(latencies.size),
+        "p50_ms": float(np.percentile(latencies, 50)) if latencies.size else None,
+        "p95_ms": float(np.percentile(latencies, 95)) if latencies.size else None,
+        "p99_ms": float(np.percentile(latencies, 99)) if latencies.size else None,
+        "max_ms": float(latencies.max()) if latencies.size else None,
+        "cpu_percent": 100 * cpu / elapsed,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def timed_batches(func, batches):
+    """
+    Call func on every batch as fast as possible, returning the stats of the run.
+    """
+    latencies = []
+    rows = 0
+    wall, cpu = time.perf_counter(), time.process_time()
+    for batch in batches:
+        start = time.perf_counter()
+        func(batch)
+        latencies.append(time.perf_counter() - start)
+        rows += batch.shape[0]
+    return latencies, rows, time.perf_counter() - wall, time.process_time() - cpu
+
+def make_batches(config: ConfigParser, secs: float):
+    sample_rate = int(config["general"]["sample_rate"])
+    rows = max(1, sample_rate // int(config["general"]["reads_per_sec"]))
+    channels = list(config["sensor_channel_mapping"].keys())
+    source = mock_ljm.SimSource(config, channels, sample_rate)
+    count = max(1, int(secs * sample_rate / rows))
+    return [source.scans(i * rows, rows) for i in range(count)]
+
+def bench_ring(config, secs, clients):
+    from acquisition import ScanRingBuffer
+    batches = make_batches(config, secs)
+    ring = ScanRingBuffer(batches[0].shape[0] * 64, batches[0].shape[1])
+    out = np.empty((batches[0].shape[0], batches[0].shape[1] + 2))
+    def step(batch):
+        ring.push(batch)
+        ring.pop_into(out[:, 1:-1], out[:, 0])
+    return timed_batches(step, batches)
+
+def bench_calibration(config, secs, clients):
+    from calibration import Calibration
+    calibration = Calibration.from_config(config)
+    return timed_batches(lambda batch: calibration.apply(batch.copy()), make_batches(config, secs))
+
+def bench_recorder(fmt):
+    def bench(config, secs, clients):
+        from recorder import make_recorder
+        config.read_dict({"recording": {"format": fmt}})
+        columns = ["Time (s)"] + list(config["sensor_channel_mapping"].keys()) + ["Skipped"]
+        batches = [np.column_stack((np.zeros(b.shape[0]), b, np.zeros(b.shape[0]))) for b in make_batches(config, secs)]
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = make_recorder(config, columns, directory=directory, stem="bench")
+            result = timed_batches(recorder.write, batches)
+            recorder.close()
+        return result
+    return bench
+
+class NullWebsocket():
+    """
+    Client connection that accepts everything instantly, so only our own encoding cost is measured.
+    """
+    def __init__(self, id):
+        self.id = id
+        self.messages = 0
+        self.bytes = 0
+
+    async def send(self, message):
+        self.messages += 1
+        self.bytes += len(message)
+
+def bench_telemetry(config, secs, clients):
+    from data_to_dash import ClientStream, DataSender, TelemetryFrame
+    from aux_sensors import AuxSensors
+    from calibration import Calibration
+    calibration = Calibration.from_config(config)
+    data_buf, valve_buf = [None], [[0] * 7]
+    sender = DataSender(config, data_buf, valve_buf, AuxSensors(config))
+    streams = []
+    for i in range(clients):
+        fmt, mode = CLIENT_MODES[i % len(CLIENT_MODES)]
+        stream = ClientStream(NullWebsocket(i), 0, 0, sender.keyframe_every, sender.window, sender.channels)
+        stream.format, stream.mode, stream.points = fmt, mode, 200
+        streams.append(stream)
+    # one frame per dash_send_delay_ms, with the scans streamed in between pushed to the window
+    sample_rate = int(config["general"]["sample_rate"])
+    per_frame = max(1, int(sample_rate * int(config["general"]["dash_send_delay_ms"]) / 1000))
+    source = mock_ljm.SimSource(config, sender.channels, sample_rate)
+    frames = max(1, int(secs * 1000 / int(config["general"]["dash_send_delay_ms"])))
+    batches = []
+    for i in range(frames):
+        block = calibration.apply(source.scans(i * per_frame, per_frame))
+        batches.append(np.column_stack((np.arange(i * per_frame, (i + 1) * per_frame) / sample_rate, block)))
+    def step(batch):
+        sender.push_samples(batch)
+        data_buf[0] = batch[-1, 1:].tolist()
+        frame = TelemetryFrame(sender._construct_message())
+        for stream in streams:
+            stream._encode(frame) if stream.mode == "latest" else stream._encode_window(frame)
+    return timed_batches(step, batches)
+
+async def run_pipeline(config, secs, clients):
+    from labjack_interface import LabjackInterface
+    from data_to_dash import DataSender
+    from aux_sensors import AuxSensors
+    data_buf, valve_buf = [None], [None]
+    latencies, lags = [], []
+    async with DataSender(config, data_buf, valve_buf, AuxSensors(config)) as sender:
+        async with LabjackInterface(config, sender, data_buf, valve_buf) as ljm_int:
+            await ljm_int.wait_ready()
+            for i in range(clients):
+                websocket = NullWebsocket(i)
+                await sender.add_client(websocket)
+                fmt, mode = CLIENT_MODES[i % len(CLIENT_MODES)]
+                await sender.configure_client(websocket, {"format": fmt, "mode": mode, "points": 200})
+            write = ljm_int._write_data_to_sd
+            timebase = ljm_int.timebase
+            async def timed_write(batch):
+                block, rows = batch
+                # column 0 holds scan indices until the write stamps them, and the block is reused after
+                last_index = block[rows - 1, 0]
+                start = time.perf_counter()
+                await write(batch)
+                latencies.append(time.perf_counter() - start)
+                # sample to recorder hand-off, the last scan of the batch was due at this time
+                lags.append(time.monotonic() - timebase.start_monotonic - (last_index + 1) / timebase.scan_rate)
+            ljm_int._write_data_to_sd = timed_write
+            wall, cpu = time.perf_counter(), time.process_time()
+            await asyncio.sleep(secs)
+            elapsed, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            stream = ljm_int.stream_stats()
+            rows = ljm_int.total_samples_read
+    lags = np.asarray(lags) * 1000
+    extra = {
+        "skipped_scans": stream["skipped_scans"],
+        "ring_overruns": stream["overruns"],
+        "recorder": ljm_int.writer.stats(),
+        "lag_p50_ms": float(np.percentile(lags, 50)) if lags.size else None,
+        "lag_p99_ms": float(np.percentile(lags, 99)) if lags.size else None,
+        "frames_sent": sum(s.frames_sent for s in sender.clients.values()),
+    }
+    return latencies, rows, elapsed, cpu, extra
+
+def bench_pipeline(config, secs, clients):
+    sim.config = config
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        # LabjackInterface records to ../data
+        os.makedirs(os.path.join(directory, "work"))
+        os.makedirs(os.path.join(directory, "data"))
+        os.chdir(os.path.join(directory, "work"))
+        try:
+            return asyncio.run(run_pipeline(config, secs, clients))
+        finally:
+            os.chdir(cwd)
+
+BENCHES = {
+    "ring": bench_ring,
+    "calibration": bench_calibration,
+    "csv": bench_recorder("csv"),
+    "binary": bench_recorder("binary"),
+    "telemetry": bench_telemetry,
+    "pipeline": bench_pipeline,
+}
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    results = []
+    for stage, rate, channels, clients in itertools.product(args.stages, args.rates, args.channels, args.clients):
+        if stage not in ("telemetry", "pipeline") and clients != args.clients[0]:
+            continue # client count only matters to telemetry
+        config = bench_config(rate, channels, args.reads_per_sec)
+        out = BENCHES[stage](config, args.secs, clients)
+        latencies, rows, elapsed, cpu = out[:4]
+        result = {"stage": stage, "sample_rate": rate, "channels": channels, "clients": clients}
+        result.update(summarize(latencies, rows, channels, elapsed, cpu))
+        if len(out) > 4:
+            result.update(out[4])
+            # the pipeline runs in real time, so it keeps up if nothing was lost along the way
+            result["keeps_up"] = (out[4]["skipped_scans"] == 0 and out[4]["ring_overruns"] == 0
+                                  and out[4]["recorder"]["dropped_rows"] == 0 and out[4]["recorder"]["decimated_rows"] == 0)
+        results.append(result)
+        print_result(result)
+    return results
+
+def key(result):
+    return (result["stage"], result["sample_rate"], result["channels"], result["clients"])
+
+def print_result(result, baseline=None):
+    line = (f"{result['stage']:<12} {result['sample_rate']:>7} Hz {result['channels']:>4} ch {result['clients']:>3} cl "
+            f"{result['samples_per_sec']:>14,.0f} samples/s  p50 {result['p50_ms'] or 0:8.3f} ms  p99 {result['p99_ms'] or 0:8.3f} ms  "
+            f"cpu {result['cpu_percent']:5.1f}%  rss {result['max_rss_mb']:6.1f} MB")
+    if "keeps_up" in result:
+        line += f"  lag p99 {result['lag_p99_ms'] or 0:7.2f} ms  {'ok' if result['keeps_up'] else 'FALLS BEHIND'}"
+    if baseline is not None and baseline["samples_per_sec"]:
+        line += f"  ({result['samples_per_sec'] / baseline['samples_per_sec']:.2f}x)"
+    print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ints = lambda text: [int(x) for x in text.split(",")]
+    parser.add_argument("--stages", type=lambda text: text.split(","), default=STAGES, help=f"comma separated, from {STAGES}")
+    parser.add_argument("--rates", type=ints, default=[300, 1000, 5000], help="sample rates, Hz")
+    parser.add_argument("--channels", type=ints, default=[14], help="streamed channel counts (at least 14)")
+    parser.add_argument("--clients", type=ints, default=[1], help="telemetry client counts")
+    parser.add_argument("--reads-per-sec", type=int, default=100, help="stream reads (and batches) per second")
+    parser.add_argument("--secs", type=float, default=5, help="seconds of data per run")
+    parser.add_argument("--out", help="write results as JSON")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+    for stage in args.stages:
+        if stage not in BENCHES:
+            parser.error(f"unknown stage {stage}")
+    if min(args.channels) < 14:
+        parser.error("telemetry frames index the first 14 channels, use at least 14")
+    logging.basicConfig(level=logging.ERROR, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    with patch("labjack.ljm", new=sim):
+        results = run(args)
+    report = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "numpy": np.__version__,
+                    "cpus": os.cpu_count()},
+        "args": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        "results": results,
+    }
+    if args.compare:
+        with open(args.compare) as fd:
+            old = json.load(fd)
+        print(f"\nCompared with {old.get('commit')} ({old.get('created')}):")
+        baseline = {key(result): result for result in old["results"]}
+        for result in results:
+            print_result(result, baseline.get(key(result)))
+    if args.out:
+        with open(args.out, "w") as fd:
+            json.dump(report, fd, indent=2)
+        print(f"Results written to {args.out}")
+
+if __name__ == "__main__":
+    main()
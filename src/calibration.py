@@ -0,0 +1,129 @@
+from configparser import ConfigParser
+from typing import Dict
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+# sensor name prefix -> key prefix of its offset/scale pair in [conversion]
+LINEAR_KEY_PREFIXES = {
+    "thermo": "thermo",
+    "b_load": "big_lc",
+    "k_load": "k_lc",
+    "s_load": "small_lc",
+    "strain": "strain",
+}
+
+CALIBRATIONS = {}
+
+def register_calibration(kind: str):
+    """
+    Register a nonlinear calibration factory under `kind`. The factory takes the list of
+    arguments from the channel's [nonlinear_calibration] entry and returns a function
+    mapping a column of voltages to engineering values.
+    """
+    def wrap(factory):
+        CALIBRATIONS[kind] = factory
+        return factory
+    return wrap
+
+@register_calibration("polynomial")
+def _polynomial(args):
+    # coefficients highest order first, e.g. "polynomial 0.02 -1.3 4.1" -> 0.02v^2 - 1.3v + 4.1
+    coeffs = [float(a) for a in args]
+    return lambda col: np.polyval(coeffs, col)
+
+@register_calibration("table")
+def _lookup_table(args):
+    # "table 0.0:-270 1.25:0 2.5:250" - piecewise linear voltage:value pairs,
+    # used for thermocouple amplifiers and other tabulated transfer curves
+    pairs = sorted(tuple(float(x) for x in a.split(":")) for a in args)
+    volts = np.array([p[0] for p in pairs])
+    values = np.array([p[1] for p in pairs])
+    return lambda col: np.interp(col, volts, values)
+
+class Calibration():
+    """
+    Voltage to engineering value conversion for every streamed channel, compiled once from
+    [sensor_channel_mapping] and [conversion] into offset and scale vectors.
+    """
+    def __init__(self, channels, offset, scale, nonlinear=None, decimals=5):
+        self.channels = list(channels)
+        self.offset = np.asarray(offset, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.gain = 1 / self.scale
+        self.nonlinear = nonlinear or [] # (column index, kind, args, function)
+        self.decimals = decimals
+
+    @classmethod
+    def from_config(cls, config: ConfigParser):
+        channels = list(config["sensor_channel_mapping"].keys())
+        conversion = config["conversion"]
+        nonlinear_section = config["nonlinear_calibration"] if config.has_section("nonlinear_calibration") else {}
+        offset = np.zeros(len(channels))
+        scale = np.ones(len(channels))
+        nonlinear = []
+        for i, chan in enumerate(channels):
+            if chan in nonlinear_section:
+                kind, *args = nonlinear_section[chan].replace(",", " ").split()
+                if kind not in CALIBRATIONS:
+                    raise Exception(f"Unknown calibration type '{kind}' for sensor {chan}")
+                nonlinear.append((i, kind, args, CALIBRATIONS[kind](args)))
+                continue
+            if chan + "_offset" in conversion:
+                key_prefix = chan
+            elif chan[:4] == "pres":
+                key_prefix = chan[:6]
+            else:
+                key_prefix = LINEAR_KEY_PREFIXES.get(chan[:6])
+            if key_prefix is None:
+                continue
+            if key_prefix + "_offset" not in conversion or key_prefix + "_scale" not in conversion:
+                raise Exception(f"Missing '{key_prefix}_offset'/'{key_prefix}_scale' in [conversion] for sensor {chan}")
+            offset[i] = float(conversion[key_prefix + "_offset"])
+            scale[i] = float(conversion[key_prefix + "_scale"])
+        return cls(channels, offset, scale, nonlinear)
+
+    def apply(self, block: np.ndarray) -> np.ndarray:
+        """
+        Convert a (rows, channels) block of voltages in place and return it.
+        """
+        if block.size == 0:
+            return block
+        np.subtract(block, self.offset, out=block)
+        np.multiply(block, self.gain, out=block)
+        for i, _, _, func in self.nonlinear:
+            block[..., i] = func(block[..., i])
+        np.round(block, self.decimals, out=block)
+        return block
+
+    def convert(self, values: np.ndarray, index: int) -> np.ndarray:
+        """
+        Calibrated copy of one channel's voltages, without rounding.
+        """
+        for i, _, _, func in self.nonlinear:
+            if i == index:
+                return func(values)
+        return (values - self.offset[index]) * self.gain[index]
+
+    def tare(self, readings: Dict[int, float], target: float = 0.0) -> "Calibration":
+        """
+        New Calibration with offsets moved so that channels currently reading `readings[index]` read `target`.
+        Only linear channels can be tared.
+        """
+        offset = self.offset.copy()
+        nonlinear = {i for i, _, _, _ in self.nonlinear}
+        for index, reading in readings.items():
+            if index in nonlinear:
+                raise Exception(f"Sensor {self.channels[index]} has a nonlinear calibration and can't be tared")
+            # value = (v - offset) / scale, so v = value * scale + offset
+            offset[index] += (reading - target) * self.scale[index]
+        return Calibration(self.channels, offset, self.scale, self.nonlinear, self.decimals)
+
+    def describe(self):
+        desc = {}
+        for i, chan in enumerate(self.channels):
+            desc[chan] = {"offset": float(self.offset[i]), "scale": float(self.scale[i])}
+        for i, kind, args, _ in self.nonlinear:
+            desc[self.channels[i]] = {"type": kind, "args": args}
+        return desc
@@ -1,76 +1,244 @@
 import json
-from websockets.asyncio.server import ServerConnection
+from websockets.asyncio.server import ServerConnection, serve
 from data_to_dash import DataSender
 from configparser import ConfigParser
 from labjack_interface import LabjackInterface
+from metrics import REGISTRY, SamplingProfiler
+from dispatcher import CommandDispatcher, CommandRejected, send_soon
+from logconfig import apply_config as apply_log_config, dropped_records, set_levels
+from runtime_config import ConfigWatcher, RuntimeConfig
+from readiness import READINESS
 from typing import Dict
 import logging
 from websockets.exceptions import ConnectionClosedError
+import numpy as np
 import asyncio
+import signal
+import time
 
 logger = logging.getLogger(__name__)
 
 class CmdListener:
-    def __init__(self, config: ConfigParser, data_sender: DataSender, ljm_int: LabjackInterface):
+    def __init__(self, config: ConfigParser, data_sender: DataSender, ljm_int: LabjackInterface, runtime: RuntimeConfig = None):
         self.config = config
         self.data_sender = data_sender
         self.ljm_int = ljm_int
+        # password, driver names etc.- replaced by reload_config
+        self.runtime = runtime or RuntimeConfig(config)
+        # stream time of the last calibration change, tares only average samples after it
+        self.calibrated_since = float("-inf")
+        self.profiler = None
+        self.dispatcher = CommandDispatcher(self.process_command)
+        self.watcher = ConfigWatcher(self.runtime.files, self.runtime.mtimes, self.reload_config,
+                                     config["general"].getfloat("config_watch_secs", fallback=2.0))
+        self.actuation_latency = REGISTRY.histogram("command_to_actuation_seconds",
+                                                    "From receiving an Actuate command to the valve write completing")
     
     async def __aenter__(self):
         logger.debug("Listening...")
         logger.debug(f"{self.ljm_int=}")
+        await self.dispatcher.__aenter__()
+        await self.watcher.__aenter__()
         return self
     
     async def __aexit__(self, exc_type, exc_value, traceback):
         logger.debug("Exiting command listener context...")
+        await self.watcher.__aexit__(exc_type, exc_value, traceback)
+        await self.dispatcher.__aexit__(exc_type, exc_value, traceback)
 
     async def recv_cmd(self, websocket: ServerConnection):
         logger.info(websocket)
         try:
             async for cmd in websocket:
+                received = time.perf_counter()
                 try:
                     cmd = json.loads(cmd)
-                except:
+                except ValueError:
                     await self.data_sender.send_message(websocket, "Invalid command syntax received!")
-                asyncio.create_task(self.process_command(cmd, websocket))
+                    await self.dispatcher.reject(None, websocket, "Invalid command syntax", received)
+                    continue
+                if not isinstance(cmd, dict) or not isinstance(cmd.get("type"), str):
+                    await self.dispatcher.reject(cmd, websocket, "Command has no type", received)
+                    continue
+                self.dispatcher.submit(cmd, websocket, received)
         except ConnectionClosedError as e:
             logger.error(f"Connection closed unexpectedly: {e}\n{e.__traceback__}")
 
-    async def process_command(self, cmd: Dict, websocket: ServerConnection):
-        logger.debug("Received command: " + str(cmd))
-        try:
-            if "type" not in cmd:
-                return
-            if cmd["type"] == "close":
-                logger.info("No longer listening for commands")
-                exit(0)
-            elif cmd["type"] == "Actuate" and (("driver_id") in cmd) and (("value") in cmd):
-                logger.error(cmd["password"])
-                logger.error(self.config["general"]["password"])
-                if ("password" not in cmd) or (cmd["password"] != self.config["general"]["password"]):
-                    await self.data_sender.send_message(websocket, "Actuate failed: Invalid password")
-                    return
-                logger.info("Setting driver " + self.config["driver_mapping"][str(cmd["driver_id"])] + " to " + str(cmd["value"]))
-                await self.data_sender.broadcast_message(f"Actuating driver id {cmd['driver_id']} - {cmd['value']}")
-                await self.ljm_int.actuate(self.config["driver_mapping"][str(cmd["driver_id"])], cmd["value"])
-            elif cmd["type"] == "Ignition":
-                if ("password" not in cmd) or (cmd["password"] != self.config["general"]["password"]):
-                    await self.data_sender.send_message(websocket, "Ignition failed: Invalid password")
-                    return
-                if (cmd["engine"] == "proxima"):
-                    await self.data_sender.send_message(websocket, "proxima ign seq")
-                    await self.ljm_int.proxima_ignition_sequence()
-                else:
-                    await self.data_sender.send_message(websocket, "sphinx ign seq")
-                    await self.ljm_int.sphinx_ignition_sequence_short()
-            elif cmd["type"] == "Proxima Ignition":
-                if ("password" not in cmd) or (cmd["password"] != self.config["general"]["password"]):
-                    await self.data_sender.send_message(websocket, "Ignition failed: Invalid password")
-                    return
+    async def process_command(self, cmd: Dict, websocket: ServerConnection, received: float = None):
+        # run by the dispatcher, see dispatcher.py for ordering and acknowledgements
+        logger.debug(f"Received command: {cmd.get('type')}")
+        if cmd["type"] == "close":
+            logger.info("No longer listening for commands")
+            exit(0)
+        elif cmd["type"] == "Actuate" and (("driver_id") in cmd) and (("value") in cmd):
+            await self._check_password(cmd, websocket, "Actuate failed: Invalid password")
+            driver = int(cmd["driver_id"])
+            if driver not in self.runtime.driver_names:
+                raise CommandRejected(f"Unknown driver {driver}")
+            # actuations of one valve happen in the order they arrived, whichever dashboard sent them
+            async with self.dispatcher.lock(("valve", driver)):
+                logger.info("Setting driver " + self.runtime.driver_names[driver] + " to " + str(cmd["value"]))
+                await self.ljm_int.actuate(driver, cmd["value"])
+            if received is not None:
+                self.actuation_latency.observe(time.perf_counter() - received)
+            await self.data_sender.broadcast_message(f"Actuating driver id {cmd['driver_id']} - {cmd['value']}")
+        elif cmd["type"] == "Ignition":
+            await self._check_password(cmd, websocket, "Ignition failed: Invalid password")
+            if (cmd["engine"] == "proxima"):
+                await self.data_sender.send_message(websocket, "proxima ign seq")
                 await self.ljm_int.proxima_ignition_sequence()
-            elif cmd["type"] == "CancelIgnition":
-                await self.ljm_int.cancel_ignition()
             else:
-                await self.data_sender.send_message(websocket, "Unknown command type: " + cmd["type"])
+                await self.data_sender.send_message(websocket, "sphinx ign seq")
+                await self.ljm_int.sphinx_ignition_sequence_short()
+        elif cmd["type"] == "Proxima Ignition":
+            await self._check_password(cmd, websocket, "Ignition failed: Invalid password")
+            await self.ljm_int.proxima_ignition_sequence()
+        elif cmd["type"] == "CancelIgnition":
+            await self.ljm_int.cancel_ignition()
+        elif cmd["type"] == "Abort":
+            await self.ljm_int.abort()
+        elif cmd["type"] == "Subscribe":
+            await self.data_sender.configure_client(websocket, cmd)
+        elif cmd["type"] == "History":
+            await self.data_sender.send_history(websocket, cmd)
+        elif cmd["type"] == "Tare":
+            await self._check_password(cmd, websocket, "Tare failed: Invalid password")
+            await self.tare(cmd, websocket)
+        elif cmd["type"] == "ReloadConfig":
+            await self._check_password(cmd, websocket, "Reload failed: Invalid password")
+            live, restart = await self.reload_config()
+            send_soon(websocket, json.dumps({"type": "ReloadConfig", "id": cmd.get("id"), "applied": live, "restart_needed": restart}))
+        elif cmd["type"] == "LogLevel":
+            await self.log_level(cmd, websocket)
+        elif cmd["type"] == "Status":
+            # which subsystems are up yet- the server takes connections before the LabJack is streaming
+            send_soon(websocket, json.dumps({"type": "Status", "id": cmd.get("id"), "subsystems": READINESS.snapshot(),
+                                             "first_connection_secs": READINESS.first_connection}))
+        elif cmd["type"] == "Metrics":
+            send_soon(websocket, json.dumps({"type": "Metrics", "metrics": REGISTRY.snapshot()}))
+        elif cmd["type"] == "Profile":
+            await self.profile(cmd, websocket)
+        else:
+            await self.data_sender.send_message(websocket, "Unknown command type: " + str(cmd["type"]))
+            raise CommandRejected("Unknown command type")
+
+    async def _check_password(self, cmd: Dict, websocket: ServerConnection, message: str):
+        if ("password" not in cmd) or (cmd["password"] != self.runtime.password):
+            await self.data_sender.send_message(websocket, message)
+            raise CommandRejected("Invalid password")
+
+    async def reload_config(self):
+        """
+        Load the config files again and apply whatever can change without a restart (see runtime_config.py).
+        Returns the changed settings that were applied and the ones that need a restart.
+        """
+        if not self.runtime.files:
+            raise CommandRejected("Not started from a config file")
+        async with self.dispatcher.lock("config"):
+            runtime = RuntimeConfig.load(self.runtime.files)
+            live, restart = self.runtime.changes(runtime)
+            applied = []
+            if live:
+                applied = await self.ljm_int.apply_config(runtime.sections)
+                if "calibration" in applied:
+                    self.calibrated_since = self._latest_time()
+                self.data_sender.apply_runtime(runtime)
+                if "logging" in live:
+                    apply_log_config(runtime.config)
+            self.runtime = runtime
+        message = f"Config reloaded- applied {', '.join(live) or 'no changes'}"
+        if restart:
+            message += f", restart to apply {', '.join(restart)}"
+        logger.info(message + (f" ({', '.join(applied)} updated)" if applied else ""))
+        await self.data_sender.broadcast_message(message)
+        return live, restart
+
+    def _latest_time(self) -> float:
+        times, _ = self.data_sender.window.since(self.calibrated_since)
+        return float(times[-1]) if times.shape[0] else self.calibrated_since
+
+    async def tare(self, cmd: Dict, websocket: ServerConnection):
+        """
+        {"type": "Tare", "sensors": ["b_load_1", "s_load_1"], "secs": 1, "target": 0} - shift the offsets of
+        the given sensors so the mean of their last `secs` seconds of readings reads `target` (default 0).
+        Lasts until the next restart or calibration reload.
+        """
+        sensors = cmd.get("sensors")
+        if not isinstance(sensors, list) or not sensors:
+            raise CommandRejected("Tare needs a list of sensors")
+        unknown = [sensor for sensor in sensors if sensor not in self.data_sender.channels]
+        if unknown:
+            raise CommandRejected(f"Unknown sensors {unknown}")
+        times, values = self.data_sender.window.since(self.calibrated_since)
+        if times.shape[0]:
+            first = np.searchsorted(times, times[-1] - float(cmd.get("secs", 1)), side="right")
+            times, values = times[first:], values[first:]
+        if times.shape[0] == 0:
+            raise CommandRejected("No readings to tare on yet")
+        columns = [self.data_sender.channels.index(sensor) for sensor in sensors]
+        means = values[:, columns].mean(axis=0)
+        target = float(cmd.get("target", 0))
+        async with self.dispatcher.lock("config"):
+            offsets = await self.ljm_int.tare(dict(zip(sensors, means.tolist())), target)
+            # the window still holds readings calibrated the old way
+            self.calibrated_since = float(times[-1])
+        send_soon(websocket, json.dumps({"type": "Tare", "id": cmd.get("id"), "means": dict(zip(sensors, means.tolist())),
+                                         "offsets": offsets, "scans": int(times.shape[0])}))
+        await self.data_sender.broadcast_message(f"Tared {', '.join(sensors)} to {target:g} over {times.shape[0]} scans")
+
+    async def log_level(self, cmd: Dict, websocket: ServerConnection):
+        """
+        {"type": "LogLevel", "levels": {"data_to_dash": "DEBUG", "root": "INFO"}} - set the level of any
+        logger (module) at runtime. Replies with the current levels, so send no "levels" to just read them.
+        """
+        try:
+            levels = set_levels(cmd.get("levels", {}))
         except Exception as e:
-            logger.error(f"Exception raised in processing command:\n{e}")
+            raise CommandRejected(str(e))
+        send_soon(websocket, json.dumps({"type": "LogLevel", "levels": levels, "dropped_records": dropped_records()}))
+
+    async def profile(self, cmd: Dict, websocket: ServerConnection):
+        """
+        {"type": "Profile", "action": "start"|"stop"} - sample every thread's stack until stopped,
+        then save the collapsed stacks to ../logs and reply with the hottest frames.
+        """
+        if cmd.get("action", "start") == "start":
+            if self.profiler is not None:
+                await self.data_sender.send_message(websocket, "Profiler already running")
+                return
+            self.profiler = SamplingProfiler(self.config.getfloat("metrics", "profile_hz", fallback=100))
+            self.profiler.start()
+            await self.data_sender.send_message(websocket, "Profiler started")
+            return
+        if self.profiler is None:
+            await self.data_sender.send_message(websocket, "Profiler is not running")
+            return
+        profiler, self.profiler = self.profiler, None
+        await asyncio.to_thread(profiler.stop)
+        path = await asyncio.to_thread(profiler.save)
+        logger.info(f"Profile of {profiler.samples} samples saved to {path}")
+        send_soon(websocket, json.dumps({"type": "Profile", "path": path, "samples": profiler.samples, "top": profiler.top()}))
+
+async def serve_dashboard(config: ConfigParser, data_sender: DataSender, ljm_int: LabjackInterface, runtime: RuntimeConfig = None):
+    """
+    Serve dashboard websockets until SIGTERM- telemetry from `data_sender`, commands run against `ljm_int`.
+    """
+    async with CmdListener(config, data_sender, ljm_int, runtime) as cmd_listener:
+        async def ws_handle(websocket: ServerConnection):
+            logger.info(f"Incoming connection from {websocket.id}")
+            READINESS.connected()
+            await data_sender.add_client(websocket)
+            await cmd_listener.recv_cmd(websocket)
+        
+        loop = asyncio.get_event_loop()
+        stop = loop.create_future()
+        loop.add_signal_handler(signal.SIGTERM, lambda: stop.done() or stop.set_result(None))
+        async with serve(
+            ws_handle, 
+            config["general"]["HOST"], 
+            int(config["general"]["PORT"])
+        ):
+            logger.info("Starting websocket server...")
+            READINESS.set("dashboard", "ready", f"listening on port {config['general']['PORT']}")
+            await stop
+        READINESS.set("dashboard", "stopped")
@@ -1,4 +1,5 @@
 import json
+import numpy as np
 from typing import List, Dict
 import asyncio
 from websockets.asyncio.server import ServerConnection, broadcast
@@ -6,25 +7,181 @@ import websockets
 from configparser import ConfigParser
 import time
 import logging
-import board
-from digitalio import DigitalInOut, Direction
-import adafruit_max31865
+from aux_sensors import AuxSensors
+from downsample import HistoryStore, SampleWindow, envelope, lttb
+from dispatcher import send_soon
+from metrics import REGISTRY
+from logconfig import LogSummary
+from runtime_config import RuntimeConfig
+from devices import max_sample_rate
 
 logger = logging.getLogger(__name__)
+# per-frame events are logged as counts every 10 s
+frame_log = LogSummary(logger)
+
+class TelemetryFrame():
+    """
+    One telemetry sample shared by every client. The JSON payload and the flattened
+    value list for compact clients are each built at most once per frame.
+    """
+    def __init__(self, message: Dict):
+        self.message = message
+        self._payload = None
+        self._schema = None
+        self._values = None
+
+    @property
+    def payload(self) -> str:
+        if self._payload is None:
+            self._payload = json.dumps(self.message)
+        return self._payload
+
+    def _flatten(self):
+        schema = []
+        values = []
+        for group, content in self.message.items():
+            if "readings" in content:
+                for reading in content["readings"]:
+                    schema.append([group, reading["sensor_id"]])
+                    values.append(reading["reading"])
+            elif "values" in content:
+                for i, value in enumerate(content["values"]):
+                    schema.append([group, i])
+                    values.append(value)
+        self._schema = schema
+        self._values = values
+
+    @property
+    def schema(self) -> List:
+        if self._schema is None:
+            self._flatten()
+        return self._schema
+
+    @property
+    def values(self) -> List:
+        if self._values is None:
+            self._flatten()
+        return self._values
+
+class ClientStream():
+    """
+    Per-client sender holding only the latest frame. A slow client backs its own send interval off
+    (up to max_interval) and skips the frames it could not keep up with, instead of delaying everyone.
+    In the compact format the schema is sent once, then value arrays- full keyframes every
+    `keyframe_every` frames and [index, value] deltas in between.
+    """
+    def __init__(self, websocket: ServerConnection, min_interval: float, max_interval: float, keyframe_every: int,
+                 window: SampleWindow = None, channels: List[str] = None):
+        self.websocket = websocket
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.keyframe_every = keyframe_every
+        self.format = "json"
+        self.schema = None
+        self.last_values = None
+        self.since_keyframe = 0
+        self.mode = "latest"
+        self.points = 0
+        self.window = window
+        self.channels = channels
+        self.window_time = 0.0
+        self.window_schema_sent = False
+        self.frame = None
+        self.ready = asyncio.Event()
+        self.task = None
+        self.frames_sent = 0
+        self.frames_coalesced = 0
+        self.send_time = REGISTRY.histogram("telemetry_send_seconds", "Time to encode and send one frame to a client",
+                                            {"client": str(websocket.id)})
+
+    def offer(self, frame: TelemetryFrame):
+        if self.frame is not None:
+            self.frames_coalesced += 1
+        self.frame = frame
+        self.ready.set()
+
+    def _encode(self, frame: TelemetryFrame) -> List[str]:
+        if self.format == "json":
+            return [frame.payload]
+        out = []
+        if self.schema != frame.schema:
+            self.schema = frame.schema
+            self.last_values = None
+            out.append(json.dumps({"type": "Schema", "fields": self.schema}))
+        values = frame.values
+        if self.last_values is None or self.since_keyframe >= self.keyframe_every:
+            out.append(json.dumps({"v": values}))
+            self.since_keyframe = 0
+        else:
+            deltas = [[i, v] for i, (v, last) in enumerate(zip(values, self.last_values)) if v != last]
+            out.append(json.dumps({"d": deltas}))
+            self.since_keyframe += 1
+        self.last_values = values
+        return out
+
+    def _encode_window(self, frame: TelemetryFrame) -> List[str]:
+        # Streaming mode: everything since the last send, reduced to `points` per channel
+        times, values = self.window.since(self.window_time)
+        if times.shape[0] == 0:
+            return []
+        self.window_time = times[-1]
+        message = {"type": "Window", "mode": self.mode, "states": frame.message["driver"]["values"]}
+        if self.mode == "envelope":
+            t, mins, maxs, means = envelope(times, values, self.points)
+            message.update({"t": t.tolist(), "min": np.round(mins.T, 5).tolist(), "max": np.round(maxs.T, 5).tolist(), "mean": np.round(means.T, 5).tolist()})
+        else:
+            t, v = lttb(times, values, self.points)
+            message.update({"t": t.T.tolist(), "v": v.T.tolist()})
+        if not self.window_schema_sent:
+            message["channels"] = self.channels
+            self.window_schema_sent = True
+        return [json.dumps(message)]
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            frame, self.frame = self.frame, None
+            start = loop.time()
+            frame_log.count(f"Sent {{n}} frames to {self.websocket.id}")
+            messages = self._encode(frame) if self.mode == "latest" else self._encode_window(frame)
+            for message in messages:
+                await self.websocket.send(message)
+            self.frames_sent += 1
+            took = loop.time() - start
+            self.send_time.observe(took)
+            # back off quickly while sends are slow relative to the interval, recover gradually
+            if took > self.interval / 2:
+                self.interval = min(self.max_interval, self.interval * 2)
+            else:
+                self.interval = max(self.min_interval, self.interval * 0.9)
+            await asyncio.sleep(max(0, self.interval - took))
 
 class DataSender:
-    def __init__(self, config: ConfigParser, data_buf: List[List[int]], valve_state_buf: List[List[int]]):
+    def __init__(self, config: ConfigParser, data_buf: List[List[int]], valve_state_buf: List[List[int]], aux_sensors: AuxSensors):
         self.config        = config
         self.delay         = int(config["general"]["dash_send_delay_ms"])
         self.data_buf = data_buf
-        self.clients: Dict[int, ServerConnection] = {}
+        self.max_delay     = int(config["general"].get("dash_max_send_delay_ms", 5000))
+        self.keyframe_every = int(config["general"].get("dash_keyframe_every", 20))
+        self.clients: Dict[int, ClientStream] = {}
+        self.channels = list(config["sensor_channel_mapping"].keys())
+        self.max_points = int(config["general"].get("dash_max_window_points", 1000))
+        # recent calibrated samples for streaming-mode clients, filled by LabjackInterface
+        self.window = SampleWindow(max_sample_rate(config) * int(config["general"].get("dash_window_secs", 10)),
+                                   len(self.channels))
+        # minutes of calibrated samples for History queries, e.g. to backfill after a reconnect. Sized for the
+        # standby rate, so it covers fewer seconds while streaming at the ignition rate
+        self.history = HistoryStore(int(config["general"]["sample_rate"]), len(self.channels),
+                                    float(config["general"].get("dash_history_secs", 600)),
+                                    int(config["general"].get("dash_history_factor", 10)))
+        self.history_query_time = REGISTRY.histogram("history_query_seconds", "Time to answer one History query")
         self.VALVE_RESET_SECS = int(self.config['general']['reset_valves_min']) * 60
         self.running = False
         self.valve_state_buf = valve_state_buf
-        spi = board.SPI()
-        cs = DigitalInOut(board.D5)  
-        self.rtd_sensor = adafruit_max31865.MAX31865(spi, cs,wires=3)
-        self.latest_rtd_temp = None
+        self.aux_sensors = aux_sensors
         
     async def __aenter__(self):
         self.running = True
@@ -34,34 +191,119 @@ class DataSender:
     async def __aexit__(self, exc_type, exc_value, traceback):
         self.running = False
         await self.task
+        for stream in list(self.clients.values()):
+            stream.task.cancel()
 
     async def _sample_data_to_operator(self):
-        message = self._construct_message()
-        message = json.dumps(message)
-        for client in list(self.clients.values()):
-            logger.info(f"Sending data to {client.id}")
-            try:
-                await client.send(message)
-            except websockets.ConnectionClosed as e:
-                print(f"Connection closed: {e.code} - {e.reason}")
-                await self._remove_client(client)
-            except Exception as e:
-                logger.error(e)
-        logger.debug(f"Sent: {str(message)[:40]}")
+        frame = TelemetryFrame(self._construct_message())
+        for stream in list(self.clients.values()):
+            stream.offer(frame)
 
     async def add_client(self, client: ServerConnection):
         logger.info(f"Added client {client.id}")
-        self.clients[client.id] = client
+        stream = ClientStream(client, self.delay / 1000, self.max_delay / 1000, self.keyframe_every,
+                              self.window, self.channels)
+        self.clients[client.id] = stream
+        stream.task = asyncio.create_task(self._run_client(stream))
 
     async def _remove_client(self, client: ServerConnection):
-        del self.clients[client.id]
+        stream = self.clients.pop(client.id, None)
+        REGISTRY.remove("telemetry_send_seconds", {"client": str(client.id)})
+        if stream is not None and stream.task is not asyncio.current_task():
+            stream.task.cancel()
+
+    async def _run_client(self, stream: "ClientStream"):
+        try:
+            await stream.run()
+        except websockets.ConnectionClosed as e:
+            logger.info(f"Connection closed: {e.code} - {e.reason}")
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(e)
+        await self._remove_client(stream.websocket)
+
+    async def configure_client(self, client: ServerConnection, cmd: Dict):
+        """
+        Handle a Subscribe command- a client may pick the 'compact' frame format, its own max rate,
+        and a streaming mode ('envelope' or 'lttb') with a per-channel point budget instead of the latest sample.
+        """
+        stream = self.clients.get(client.id)
+        if stream is None:
+            return
+        if "mode" in cmd:
+            if cmd["mode"] not in ("latest", "envelope", "lttb"):
+                await self.send_message(client, f"Unknown telemetry mode: {cmd['mode']}")
+                return
+            stream.mode = cmd["mode"]
+            stream.points = max(3, min(int(cmd.get("points", 50)), self.max_points))
+            stream.window_time = self.window.since(float("-inf"))[0].max(initial=stream.window_time)
+            stream.window_schema_sent = False
+        if "format" in cmd:
+            if cmd["format"] not in ("json", "compact"):
+                await self.send_message(client, f"Unknown telemetry format: {cmd['format']}")
+                return
+            stream.format = cmd["format"]
+            stream.schema = None
+        if "rate_hz" in cmd:
+            stream.min_interval = max(self.delay / 1000, 1 / float(cmd["rate_hz"]))
+            stream.interval = stream.min_interval
+        logger.info(f"Client {client.id} subscribed: mode={stream.mode}, format={stream.format}, interval={stream.min_interval}s")
+
+    def apply_runtime(self, runtime: RuntimeConfig):
+        """
+        Take up reloaded telemetry settings, existing clients included.
+        """
+        old_delay = self.delay / 1000
+        self.delay = round(runtime.send_delay * 1000)
+        self.max_delay = round(runtime.max_send_delay * 1000)
+        self.keyframe_every = runtime.keyframe_every
+        self.max_points = runtime.max_window_points
+        for stream in self.clients.values():
+            # clients that asked for their own rate keep it, if it's still allowed
+            stream.min_interval = runtime.send_delay if stream.min_interval == old_delay else max(runtime.send_delay, stream.min_interval)
+            stream.max_interval = max(stream.min_interval, runtime.max_send_delay)
+            stream.interval = stream.min_interval
+            stream.keyframe_every = runtime.keyframe_every
+            stream.points = min(stream.points, runtime.max_window_points)
+
+    def push_samples(self, block: np.ndarray):
+        """
+        Calibrated (time, channels...) rows from the stream, for streaming clients and History queries.
+        """
+        self.window.push(block)
+        self.history.push(block)
+
+    async def send_history(self, client: ServerConnection, cmd: Dict):
+        """
+        Handle a History command- {"start": t0, "end": t1} in stream time or {"last": seconds}, with up
+        to "points" buckets (default 500) of min/max/mean per channel.
+        """
+        start = time.perf_counter()
+        end = float(cmd["end"]) if "end" in cmd else self.history.latest_time()
+        begin = end - float(cmd["last"]) if "last" in cmd else float(cmd.get("start", float("-inf")))
+        points = max(1, min(int(cmd.get("points", 500)), self.max_points))
+        scans, t, mins, maxs, means = self.history.query(begin, end, points)
+        message = {
+            "type": "History",
+            "id": cmd.get("id"),
+            "channels": self.channels,
+            "scans_per_point": scans,
+            "t": t.tolist(),
+            "min": np.round(mins.T.astype(np.float64), 5).tolist(),
+            "max": np.round(maxs.T.astype(np.float64), 5).tolist(),
+            "mean": np.round(means.T.astype(np.float64), 5).tolist(),
+        }
+        payload = json.dumps(message)
+        self.history_query_time.observe(time.perf_counter() - start)
+        send_soon(client, payload)
 
     async def _start_sending(self):
         while self.running:
             if self.data_buf[0] and self.valve_state_buf[0]:
                 await self._sample_data_to_operator()
             else:
-                logger.debug("Nothing in buffer")
+                frame_log.count("{n} frames skipped with nothing in the buffer")
             await asyncio.sleep(self.delay / 1000)
 
     async def send_message(self, websocket: ServerConnection, message: str):
@@ -72,7 +314,7 @@ class DataSender:
         }
         payload = json.dumps(data)
         logger.info(f"Sending message: '{message}'")
-        await websocket.send(payload)
+        send_soon(websocket, payload)
         
     async def broadcast_message(self, message: str):
         data = {
@@ -82,35 +324,24 @@ class DataSender:
         }
         payload = json.dumps(data)
         logger.info(f"Broadcasting message: '{message}'")
-        broadcast(self.clients.values(), payload)
-
-    def get_latest_rtd_temperature(self):
-        temp = 0
-        if (self.latest_rtd_temp != None):
-            temp = round(self.latest_rtd_temp,3)
-        return temp
-
-    def _read_rtd_temperature(self):
-        try:
-            self.latest_rtd_temp = self.rtd_sensor.temperature
-        except Exception as e:
-            logger.error(f"Failed to read RTD temperature: {e}")
-        return self.latest_rtd_temp
+        broadcast([stream.websocket for stream in self.clients.values()], payload)
 
     def _construct_message(self):
         buf_data = self.data_buf[0]
         states = self.valve_state_buf[0]
-        temp = self._read_rtd_temperature()
+        # aux sensors are polled on their own threads, this only picks up their latest values
+        rtd_readings = []
+        for i, name in enumerate(self.aux_sensors.sensors):
+            temp = self.aux_sensors.latest(name)
+            rtd_readings.append({
+                "sensor_id": i,
+                "reading": None if temp is None else round(temp, 3),
+            })
         return {
             "rtds": {
                 "type": "SensorValue",
                 "group_id": 0,
-                "readings": [
-                    {
-                        "sensor_id": 0,
-                        "reading": temp,
-                    }
-                ]
+                "readings": rtd_readings
             },
             "pts": {
                 "type": "SensorValue",
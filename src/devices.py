@@ -0,0 +1,320 @@
+"""
+LabJack devices and the merged channel table across them.
+
+With no [devices] section there is one T7 on USB streaming [sensor_channel_mapping], as always.
+Otherwise each device is listed as `name = <identifier> key=value ...`, e.g.
+    main   = ANY
+    second = 470012345 connection=ETHERNET
+and streams the channels in its own [sensor_channel_mapping_<name>] (plus optional
+[sensor_negative_channels_<name>]). The first device also drives the valves. Sensor names must be
+unique across devices- the merged table is their concatenation in device order. The `type=` option
+(T7 by default) picks the device class registered for it with register_device_backend.
+"""
+
+from configparser import ConfigParser
+from acquisition import ScanRingBuffer, StreamReader, StreamTimebase
+from typing import Dict, List, Tuple
+import numpy as np
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+DEVICE_BACKENDS = {}
+
+def register_device_backend(*device_types: str):
+    """
+    Register a device class for the `type=` option in [devices], e.g. @register_device_backend("T7").
+    """
+    def wrap(cls):
+        for device_type in device_types:
+            DEVICE_BACKENDS[device_type] = cls
+        return cls
+    return wrap
+
+@register_device_backend("T4", "T7", "T8")
+class LabjackDevice():
+    """
+    One T7 with its own stream, ring buffer and StreamReader thread. Nothing touches the hardware
+    until open().
+    """
+    def __init__(self, name: str, identifier: str, channels: Dict[str, str], negative_channels: Dict[str, str],
+                 options: Dict[str, str] = None):
+        self.name = name
+        self.identifier = identifier
+        self.channels = dict(channels)
+        self.negative_channels = dict(negative_channels)
+        self.options = options or {}
+        self.device_type = self.options.get("type", "T7")
+        self.connection = self.options.get("connection", "USB")
+        # a shared external scan clock or trigger keeps several devices' scans in lockstep
+        self.clock_source = int(self.options.get("clock_source", 0))
+        self.trigger_index = int(self.options.get("trigger_index", 0))
+        self.handle = None
+        self.timebase = None
+        self.ring = None
+        self.reader = None
+        self.stream_args = None
+        # called with the device after a reconnect gave it a new handle
+        self.on_reopen = None
+
+    @property
+    def num_channels(self) -> int:
+        return len(self.channels)
+
+    def open(self):
+        # ljm is imported where it's used, so hosts without the LJM library can still load this module
+        from labjack import ljm
+        self.handle = ljm.openS(self.device_type, self.connection, self.identifier)
+        return self.handle
+
+    def stream_setup(self, sample_rate: int, reads_per_sec: int, anchor: str = "stream"):
+        self.stream_args = (sample_rate, reads_per_sec)
+        scan_rate, start_monotonic = self._start_stream(sample_rate, reads_per_sec)
+        core_timer = None
+        if anchor == "core_timer":
+            from labjack import ljm
+            # read right after the stream starts, so it's late by about one USB round trip
+            core_timer = int(ljm.eReadName(self.handle, "CORE_TIMER"))
+        # the device's actual scan rate can differ slightly from the one asked for
+        self.timebase = StreamTimebase(scan_rate, anchor, start_monotonic, core_timer)
+        logger.info(f"Stream started on {self.name} at {scan_rate} scans/s, timestamps anchored to {anchor}")
+        return self.timebase
+
+    def _start_stream(self, sample_rate: int, reads_per_sec: int):
+        from labjack import ljm
+        aScanListNames = list(self.channels.values())
+        aScanList = ljm.namesToAddresses(self.num_channels, aScanListNames)[0]
+        scansPerRead = sample_rate // reads_per_sec
+
+        reg_names = ["STREAM_TRIGGER_INDEX", "STREAM_CLOCK_SOURCE", "STREAM_RESOLUTION_INDEX", "STREAM_SETTLING_US"]
+        reg_values = [self.trigger_index, self.clock_source, 0, 0]
+        for chan in self.negative_channels.keys():
+            reg_names.append(self.channels[chan] + "_NEGATIVE_CH")
+            reg_values.append(int(self.negative_channels[chan][3:]))
+            reg_names.append(self.channels[chan] + "_RANGE")
+            reg_values.append(1)
+            """
+            Differential inputs (load cells and strain gauges) require amplification.
+            Setting to "1" sets a gain of 10x- increasing this will improve the precision of these
+            values, at the expense of sample rate.
+            """
+        numFrames = len(reg_names)
+        try:
+            ljm.eWriteNames(self.handle, numFrames, reg_names, reg_values)
+        except Exception as e:
+            logger.error(f"Writing the stream registers on {self.name} failed: {e}")
+            # the handle is closed now- starting the stream on it would only fail with a less useful error
+            self.close()
+            raise Exception(f"Failed to configure LabJack data stream on {self.name}!") from e
+        scan_rate = ljm.eStreamStart(self.handle, scansPerRead, self.num_channels, aScanList, sample_rate)
+        start_monotonic = time.monotonic()
+        if round(scan_rate) != sample_rate:
+            raise Exception(f"Failed to configure LabJack data stream on {self.name}!")
+        return scan_rate, start_monotonic
+
+    def restart_stream(self, sample_rate: int, reads_per_sec: int):
+        """
+        Restart the stream on the same handle at another rate, e.g. for a rate profile change.
+        Returns (scan rate, time.monotonic() at stream start). If it fails, stream_args still hold the
+        rate the stream had, for reopen().
+        """
+        from labjack import ljm
+        ljm.eStreamStop(self.handle)
+        scan_rate, start_monotonic = self._start_stream(sample_rate, reads_per_sec)
+        self.stream_args = (sample_rate, reads_per_sec)
+        logger.info(f"Stream restarted on {self.name} at {scan_rate} scans/s")
+        return scan_rate, start_monotonic
+
+    def reopen(self):
+        """
+        Close what's left of the handle, open the device again and restart its stream with the same setup.
+        The timebase is kept, the reader works out where the new stream's scans fall on it.
+        Returns (handle, time.monotonic() at stream start), for StreamReader.
+        """
+        self.close()
+        self.open()
+        _, start_monotonic = self._start_stream(*self.stream_args)
+        if self.on_reopen is not None:
+            self.on_reopen(self)
+        return self.handle, start_monotonic
+
+    def start_reader(self, ring_secs: int, monitors=None, data_ready: threading.Event = None, notify=None, backoff=(0.1, 5.0),
+                     max_scan_rate: float = 0):
+        # sized for the fastest rate profile, the stream may be switched to it later
+        self.ring = ScanRingBuffer(int(max(self.timebase.scan_rate, max_scan_rate) * ring_secs), self.num_channels)
+        self.reader = StreamReader(self.handle, self.ring, monitors, data_ready, name=f"labjack-stream-{self.name}",
+                                   scan_rate=self.timebase.scan_rate, reconnect=self.reopen, notify=notify, backoff=backoff,
+                                   restart=self.restart_stream, timebase=self.timebase)
+        self.reader.start()
+
+    def stop_reader(self):
+        if self.reader is not None:
+            self.reader.stop()
+
+    def close(self):
+        from labjack import ljm
+        # either may fail on a device that's gone, the other still has to happen
+        for release in (ljm.eStreamStop, ljm.close):
+            try:
+                release(self.handle)
+            except Exception as e:
+                logger.debug(f"{release.__name__} on {self.name}: {e}")
+
+def _make_device(name: str, identifier: str, channels, negative_channels, options: Dict[str, str] = None):
+    device_type = (options or {}).get("type", "T7")
+    if device_type not in DEVICE_BACKENDS:
+        raise Exception(f"Device {name} has unknown type {device_type}, known types are {', '.join(DEVICE_BACKENDS)}")
+    return DEVICE_BACKENDS[device_type](name, identifier, channels, negative_channels, options)
+
+def load_devices(config: ConfigParser) -> List[LabjackDevice]:
+    if not config.has_section("devices"):
+        negative = config["sensor_negative_channels"] if config.has_section("sensor_negative_channels") else {}
+        return [LabjackDevice("main", "ANY", config["sensor_channel_mapping"], negative)]
+    devices = []
+    for name, spec in config["devices"].items():
+        identifier, *opts = spec.split()
+        options = dict(opt.split("=", 1) for opt in opts)
+        section = f"sensor_channel_mapping_{name}"
+        if not config.has_section(section):
+            raise Exception(f"Device {name} has no [{section}] section")
+        negative = f"sensor_negative_channels_{name}"
+        devices.append(_make_device(name, identifier, config[section],
+                                    config[negative] if config.has_section(negative) else {}, options))
+    if not devices:
+        raise Exception("[devices] lists no devices")
+    return devices
+
+def load_rate_profiles(config: ConfigParser) -> Dict[str, Tuple[int, int]]:
+    """
+    {profile: (sample_rate, reads_per_sec)}. "standby" is [general] sample_rate and reads_per_sec, the
+    others are listed in [rate_profiles] as `name = <sample_rate> <reads_per_sec>`.
+    """
+    profiles = {"standby": (int(config["general"]["sample_rate"]), int(config["general"]["reads_per_sec"]))}
+    if not config.has_section("rate_profiles"):
+        return profiles
+    for name, spec in config["rate_profiles"].items():
+        try:
+            sample_rate, reads_per_sec = (int(value) for value in spec.split())
+        except ValueError:
+            raise Exception(f"Rate profile {name} should be '<sample_rate> <reads_per_sec>', not '{spec}'")
+        if not 0 < reads_per_sec <= sample_rate:
+            raise Exception(f"Rate profile {name} reads more often than it samples")
+        profiles[name] = (sample_rate, reads_per_sec)
+    return profiles
+
+def max_sample_rate(config: ConfigParser) -> int:
+    # what buffers sized in seconds of scans have to hold
+    return max(sample_rate for sample_rate, _ in load_rate_profiles(config).values())
+
+def merge_device_channels(config: ConfigParser):
+    """
+    Build [sensor_channel_mapping] and [sensor_negative_channels] from the per-device sections, so
+    calibration, telemetry and the abort rules all see one logical channel table.
+    """
+    if not config.has_section("devices"):
+        return
+    if config.has_section("sensor_channel_mapping"):
+        raise Exception("Use either [devices] with per-device channel sections or a single [sensor_channel_mapping], not both")
+    merged, negative = {}, {}
+    for device in load_devices(config):
+        for chan, ain in device.channels.items():
+            if chan in merged:
+                raise Exception(f"Sensor {chan} is mapped on more than one device")
+            merged[chan] = ain
+        negative.update(device.negative_channels)
+    config.read_dict({"sensor_channel_mapping": merged, "sensor_negative_channels": negative})
+
+class StreamMerger(threading.Thread):
+    """
+    Time-aligns the scan blocks of several devices into rows of the merged channel table, on its
+    own thread so the safety monitors still see every block without involving the event loop.
+
+    All devices stream at the same rate. A device's scan i lines up with scan i + offset of the first
+    device, where the offset comes from the difference in stream start times (or is zero when the
+    streams share a trigger). Rows are only emitted once every device has delivered them; a scan one
+    device is missing, e.g. lost to a ring overrun, comes out as NaN for that device's channels.
+    """
+    def __init__(self, devices: List[LabjackDevice], ring: ScanRingBuffer, monitors=None, data_ready: threading.Event = None):
+        super().__init__(name="labjack-merger", daemon=True)
+        self.devices = devices
+        self.ring = ring
+        self.monitors = monitors or []
+        self.data_ready = data_ready or threading.Event()
+        self.running = False
+        self.error = None
+        primary = devices[0].timebase
+        triggered = any(device.trigger_index for device in devices)
+        self.offsets = [0 if triggered else int(round((device.timebase.start_monotonic - primary.start_monotonic) * primary.scan_rate))
+                        for device in devices]
+        self.columns = np.cumsum([0] + [device.num_channels for device in devices])
+        self.pending = [(np.empty(0, dtype=np.int64), np.empty((0, device.num_channels))) for device in devices]
+        self.cursor = None # next merged scan index to emit
+        self.merged_scans = 0
+        self.missing_scans = 0 # device scans filled with NaN because the device never delivered them
+        for device, offset in zip(devices, self.offsets):
+            logger.info(f"Device {device.name} scans aligned with offset {offset}")
+
+    def start(self):
+        self.running = True
+        super().start()
+
+    def stop(self, timeout: float = 1.0):
+        self.running = False
+        self.data_ready.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while self.running:
+            self.data_ready.wait(0.1)
+            self.data_ready.clear()
+            try:
+                self.merge()
+            except Exception as e:
+                self.error = e
+                logger.error(f"Stream merge failed, acquisition stopped: {e}")
+                break
+
+    def merge(self):
+        for i, device in enumerate(self.devices):
+            indices, block = device.ring.pop_indexed()
+            if indices.size:
+                old_indices, old_block = self.pending[i]
+                self.pending[i] = (np.concatenate((old_indices, indices + self.offsets[i])), np.concatenate((old_block, block)))
+        if any(indices.size == 0 for indices, _ in self.pending):
+            return
+        if self.cursor is None:
+            # scans from before the last device started have nothing to line up with
+            self.cursor = max(int(indices[0]) for indices, _ in self.pending)
+        end = min(int(indices[-1]) for indices, _ in self.pending) + 1
+        if end <= self.cursor:
+            return
+        rows = end - self.cursor
+        merged = np.full((rows, self.columns[-1]), np.nan)
+        for i, (indices, block) in enumerate(self.pending):
+            keep = (indices >= self.cursor) & (indices < end)
+            merged[indices[keep] - self.cursor, self.columns[i]:self.columns[i + 1]] = block[keep]
+            self.missing_scans += rows - int(keep.sum())
+            later = indices >= end
+            self.pending[i] = (indices[later], block[later])
+        read_time = time.monotonic()
+        for monitor in self.monitors:
+            try:
+                monitor.check(merged, read_time, 0)
+            except Exception as e:
+                logger.error(f"Safety monitor failed: {e}")
+        self.ring.push(merged, self.cursor)
+        self.merged_scans += rows
+        self.cursor = end
+
+    def stats(self):
+        return {
+            "merged_scans": self.merged_scans,
+            "missing_scans": self.missing_scans,
+            "offsets": self.offsets,
+            "overruns": self.ring.overruns,
+            "ring_fill": len(self.ring),
+            "devices": {device.name: device.reader.stats() for device in self.devices},
+        }
@@ -0,0 +1,171 @@
+"""
+Ordered, prioritized execution of dashboard commands.
+
+Every command gets an acknowledgement once it finishes:
+    {"type": "Ack", "id": <the command's "id", if it had one>, "command": "Actuate", "status": "done",
+     "received": ..., "started": ..., "done": ..., "queued_ms": ..., "exec_ms": ..., "total_ms": ...}
+with server side wall clock timestamps (seconds since the epoch) and durations from the monotonic clock.
+`status` is done, rejected (e.g. a bad password, with `message`) or error.
+
+Replies and acks go out through send_soon, so the worker only ever waits on running commands- never on
+a slow or stalled dashboard's socket.
+"""
+
+from websockets.asyncio.server import ServerConnection
+from websockets.exceptions import ConnectionClosed
+from metrics import REGISTRY
+from typing import Dict
+import itertools
+import logging
+import asyncio
+import json
+import time
+
+logger = logging.getLogger(__name__)
+
+# lower runs first. Urgent commands skip the queue altogether
+URGENT = 0
+PRIORITY = {
+    "Abort": URGENT,
+    "CancelIgnition": URGENT,
+    "Actuate": 1,
+}
+DEFAULT_PRIORITY = 2
+# these run alongside the queue instead of holding it up- sequences take seconds, actuations are
+# ordered by their valve lock
+BACKGROUND = {"Actuate", "Ignition", "Proxima Ignition"}
+# a reply a client hasn't taken by then is given up on
+SEND_TIMEOUT_SECS = 5.0
+
+_sends = set()
+
+def send_soon(websocket: ServerConnection, payload: str):
+    """
+    Send `payload` to one client on its own task. Each send writes its frame before it first waits, so a
+    client still gets its replies in the order they were sent.
+    """
+    task = asyncio.create_task(_send(websocket, payload))
+    _sends.add(task)
+    task.add_done_callback(_sends.discard)
+
+async def _send(websocket: ServerConnection, payload: str):
+    try:
+        await asyncio.wait_for(websocket.send(payload), SEND_TIMEOUT_SECS)
+    except ConnectionClosed:
+        pass
+    except asyncio.TimeoutError:
+        logger.warning(f"Gave up sending to {websocket.remote_address} after {SEND_TIMEOUT_SECS:g} s")
+
+class CommandRejected(Exception):
+    pass
+
+class Command():
+    def __init__(self, cmd: Dict, websocket: ServerConnection, received: float):
+        self.cmd = cmd
+        self.websocket = websocket
+        self.type = cmd.get("type")
+        self.priority = PRIORITY.get(self.type, DEFAULT_PRIORITY)
+        self.received = received # perf_counter
+        self.received_wall = time.time() - (time.perf_counter() - received)
+        self.started = None
+
+class CommandDispatcher():
+    """
+    Commands are queued by priority (then arrival) and run one at a time by a single worker, so a client's
+    commands take effect in the order it sent them. Abort and CancelIgnition never wait in the queue,
+    and long running commands (see BACKGROUND) run next to it. `execute(cmd, websocket, received)` does the work
+    and raises CommandRejected to refuse a command.
+    """
+    def __init__(self, execute):
+        self.execute = execute
+        self.queue = asyncio.PriorityQueue()
+        self.order = itertools.count()
+        self.tasks = set()
+        self.locks: Dict[object, asyncio.Lock] = {}
+        self.worker = None
+        self.queue_depth = REGISTRY.gauge("command_queue_depth", "Commands waiting to run")
+
+    async def __aenter__(self):
+        self.worker = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.worker.cancel()
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(self.worker, *self.tasks, return_exceptions=True)
+
+    def lock(self, key) -> asyncio.Lock:
+        """
+        Lock serializing commands on one resource, e.g. ("valve", driver). Waiters are served in order.
+        """
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+        return self.locks[key]
+
+    def submit(self, cmd: Dict, websocket: ServerConnection, received: float = None):
+        command = Command(cmd, websocket, time.perf_counter() if received is None else received)
+        if command.priority == URGENT:
+            self._spawn(command)
+            return
+        self.queue.put_nowait((command.priority, next(self.order), command))
+        self.queue_depth.set(self.queue.qsize())
+
+    async def reject(self, cmd, websocket: ServerConnection, message: str, received: float = None):
+        # for messages that never made it to a command, e.g. invalid JSON
+        command = Command(cmd if isinstance(cmd, dict) else {}, websocket, time.perf_counter() if received is None else received)
+        command.started = command.received
+        await self._ack(command, "rejected", message)
+
+    def _spawn(self, command: Command):
+        task = asyncio.create_task(self._run_command(command))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self):
+        while True:
+            _, _, command = await self.queue.get()
+            self.queue_depth.set(self.queue.qsize())
+            if command.type in BACKGROUND:
+                self._spawn(command)
+            else:
+                await self._run_command(command)
+
+    async def _run_command(self, command: Command):
+        command.started = time.perf_counter()
+        status, message = "done", None
+        try:
+            await self.execute(command.cmd, command.websocket, command.received)
+        except CommandRejected as e:
+            status, message = "rejected", str(e)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Exception raised in processing command:\n{e}")
+            status, message = "error", str(e)
+        await self._ack(command, status, message)
+
+    async def _ack(self, command: Command, status: str, message: str = None):
+        done = time.perf_counter()
+        if status != "rejected":
+            # rejected ones include unknown types, which would make a metric per typo
+            labels = {"command": command.type}
+            REGISTRY.histogram("command_queue_seconds", "From receiving a command to starting it", labels).observe(command.started - command.received)
+            REGISTRY.histogram("command_seconds", "From receiving a command to finishing it", labels).observe(done - command.received)
+        ack = {
+            "type": "Ack",
+            "id": command.cmd.get("id"),
+            "command": command.type,
+            "status": status,
+            "received": command.received_wall,
+            "started": command.received_wall + command.started - command.received,
+            "done": command.received_wall + done - command.received,
+            "queued_ms": (command.started - command.received) * 1000,
+            "exec_ms": (done - command.started) * 1000,
+            "total_ms": (done - command.received) * 1000,
+        }
+        if message is not None:
+            ack["message"] = message
+        if command.priority == URGENT:
+            logger.info(f"{command.type} done in {ack['total_ms']:.2f} ms ({status})")
+        send_soon(command.websocket, json.dumps(ack))
@@ -0,0 +1,180 @@
+import numpy as np
+
+class SampleWindow():
+    """
+    Rolling buffer of the most recent calibrated samples, one row of (time, channels...) per scan.
+    Filled by LabjackInterface and read by DataSender, both on the event loop.
+    """
+    def __init__(self, capacity: int, num_channels: int):
+        self.capacity = capacity
+        self.buf = np.zeros((capacity, num_channels + 1))
+        self.head = 0
+
+    def push(self, block: np.ndarray):
+        block = block[-self.capacity:]
+        n = block.shape[0]
+        start = self.head % self.capacity
+        first = min(n, self.capacity - start)
+        self.buf[start:start + first] = block[:first]
+        self.buf[:n - first] = block[first:]
+        self.head += n
+
+    def since(self, t: float):
+        """
+        Returns (times, values) for every buffered scan newer than `t`, oldest first.
+        """
+        n = min(self.head, self.capacity)
+        start = (self.head - n) % self.capacity
+        rows = np.roll(self.buf, -start, axis=0)[:n] if start + n > self.capacity else self.buf[start:start + n]
+        first = np.searchsorted(rows[:, 0], t, side="right")
+        return rows[first:, 0], rows[first:, 1:]
+
+def envelope(times: np.ndarray, values: np.ndarray, points: int):
+    """
+    Split (n, channels) samples into `points` bins and return (bin start times, min, max, mean) per bin.
+    """
+    n = times.shape[0]
+    bins = min(points, n)
+    edges = (np.arange(bins) * n) // bins
+    counts = np.diff(np.append(edges, n))
+    mins = np.minimum.reduceat(values, edges, axis=0)
+    maxs = np.maximum.reduceat(values, edges, axis=0)
+    means = np.add.reduceat(values, edges, axis=0) / counts[:, None]
+    return times[edges], mins, maxs, means
+
+def lttb(times: np.ndarray, values: np.ndarray, points: int):
+    """
+    Largest-Triangle-Three-Buckets downsampling, run for every channel at once.
+    Returns (times, values), each (points, channels)- the chosen sample differs per channel.
+    """
+    n, channels = values.shape
+    cols = np.arange(channels)
+    if points >= n or points < 3:
+        return np.repeat(times[:, None], channels, axis=1), values.copy()
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    chosen = np.zeros((points, channels), dtype=int)
+    chosen[-1] = n - 1
+    prev = chosen[0]
+    for i in range(points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < len(edges) else n
+        avg_t = times[hi:next_hi].mean()
+        avg_v = values[hi:next_hi].mean(axis=0)
+        prev_t = times[prev]
+        prev_v = values[prev, cols]
+        area = np.abs((prev_t - avg_t) * (values[lo:hi] - prev_v)
+                      - (prev_t - times[lo:hi, None]) * (avg_v - prev_v))
+        prev = lo + np.argmax(area, axis=0)
+        chosen[i + 1] = prev
+    return times[chosen], values[chosen, cols]
+
+class HistoryLevel():
+    """
+    One level of a HistoryStore: a ring of buckets, each the (min, max, mean) of `scans` consecutive
+    scans and stamped with the first one's time. The raw level (scans=1) only stores the values.
+    """
+    def __init__(self, capacity: int, num_channels: int, scans: int):
+        self.capacity = capacity
+        self.scans = scans
+        self.times = np.zeros(capacity)
+        self.mean = np.zeros((capacity, num_channels), dtype=np.float32)
+        self.min = self.mean if scans == 1 else np.zeros((capacity, num_channels), dtype=np.float32)
+        self.max = self.mean if scans == 1 else np.zeros((capacity, num_channels), dtype=np.float32)
+        self.head = 0
+
+    def push(self, times: np.ndarray, mins: np.ndarray, maxs: np.ndarray, means: np.ndarray):
+        n = min(times.shape[0], self.capacity)
+        start = self.head % self.capacity
+        first = min(n, self.capacity - start)
+        arrays = [(self.times, times), (self.mean, means)]
+        if self.scans > 1:
+            arrays += [(self.min, mins), (self.max, maxs)]
+        for dest, src in arrays:
+            src = src[-n:] if n else src[:0]
+            dest[start:start + first] = src[:first]
+            dest[:n - first] = src[first:]
+        self.head += times.shape[0]
+
+    def between(self, t0: float, t1: float):
+        """
+        (times, min, max, mean) of the buckets starting in [t0, t1], oldest first.
+        """
+        n = min(self.head, self.capacity)
+        start = (self.head - n) % self.capacity
+        # the buffered buckets are at most two sorted runs, search each without reordering the ring
+        runs = [(start, min(start + n, self.capacity)), (0, max(0, start + n - self.capacity))]
+        picked = []
+        for lo, hi in runs:
+            a = lo + np.searchsorted(self.times[lo:hi], t0, side="left")
+            b = lo + np.searchsorted(self.times[lo:hi], t1, side="right")
+            if b > a:
+                picked.append(slice(a, b))
+        if len(picked) == 1:
+            s = picked[0]
+            return self.times[s], self.min[s], self.max[s], self.mean[s]
+        return tuple(np.concatenate([arr[s] for s in picked]) if picked else arr[:0]
+                     for arr in (self.times, self.min, self.max, self.mean))
+
+class HistoryStore():
+    """
+    The last `secs` seconds of calibrated samples as float32, plus a decimation pyramid where each
+    level summarizes `factor` buckets of the one below. A query over any range reads the coarsest level
+    that still gives at least `points` buckets, so its cost depends on `points`, not on the range.
+    Filled and read on the event loop, like SampleWindow.
+    """
+    def __init__(self, sample_rate: int, num_channels: int, secs: float = 600, factor: int = 10, min_buckets: int = 100):
+        capacity = int(sample_rate * secs)
+        self.factor = factor
+        self.levels = [HistoryLevel(capacity, num_channels, 1)]
+        while capacity // (self.levels[-1].scans * factor) >= min_buckets:
+            scans = self.levels[-1].scans * factor
+            self.levels.append(HistoryLevel(capacity // scans, num_channels, scans))
+        # buckets of the level below that don't make up a whole bucket of this level yet
+        self.pending = [None] + [None] * (len(self.levels) - 1)
+        self.num_channels = num_channels
+
+    def push(self, block: np.ndarray):
+        """
+        Add (time, channels...) rows, the same rows SampleWindow takes.
+        """
+        times, values = block[:, 0], block[:, 1:].astype(np.float32)
+        self.levels[0].push(times, values, values, values)
+        rows = (times, values, values, values)
+        for k in range(1, len(self.levels)):
+            if self.pending[k] is not None:
+                rows = tuple(np.concatenate((old, new)) for old, new in zip(self.pending[k], rows))
+            whole = rows[0].shape[0] // self.factor * self.factor
+            self.pending[k] = tuple(arr[whole:].copy() for arr in rows)
+            if whole == 0:
+                break
+            t, mins, maxs, means = (arr[:whole] for arr in rows)
+            shape = (-1, self.factor, self.num_channels)
+            rows = (t[::self.factor], mins.reshape(shape).min(axis=1), maxs.reshape(shape).max(axis=1),
+                    means.reshape(shape).mean(axis=1, dtype=np.float64).astype(np.float32))
+            self.levels[k].push(*rows)
+
+    def latest_time(self) -> float:
+        level = self.levels[0]
+        return float(level.times[(level.head - 1) % level.capacity]) if level.head else 0.0
+
+    def query(self, t0: float, t1: float, points: int):
+        """
+        Returns (scans per bucket, times, min, max, mean) for [t0, t1] in at most `points` buckets.
+        """
+        points = max(1, points)
+        level = self.levels[0]
+        for candidate in self.levels:
+            t, mins, maxs, means = candidate.between(t0, t1)
+            level = candidate
+            if t.shape[0] <= points * self.factor:
+                break
+        if t.shape[0] <= points:
+            return level.scans, t, mins, maxs, means
+        # a finer level than needed- merge the same number of its buckets into each point, so points stay
+        # evenly spaced. Only the newest point may have fewer behind it
+        stride = -(-t.shape[0] // points)
+        edges = np.arange(0, t.shape[0], stride)
+        counts = np.diff(np.append(edges, t.shape[0]))
+        return (level.scans * stride, t[edges], np.minimum.reduceat(mins, edges, axis=0),
+                np.maximum.reduceat(maxs, edges, axis=0),
+                (np.add.reduceat(means, edges, axis=0, dtype=np.float64) / counts[:, None]).astype(np.float32))
@@ -1,334 +1,541 @@
-from labjack import ljm
 from configparser import ConfigParser
 import logging
 import asyncio
 from data_to_dash import DataSender
+from aux_sensors import AuxSensors
+from acquisition import BlockPool, ScanRingBuffer
+from devices import StreamMerger, load_devices, load_rate_profiles, max_sample_rate
+from calibration import Calibration
+from runtime_config import CALIBRATION_SECTIONS, RULE_SECTIONS, RuntimeConfig
+from recorder import make_recorder, make_writer
+from safety import SafetyMonitor
+from valve_io import ValveIO
+from sequencer import SequenceRunner, load_sequences
+from metrics import REGISTRY
+from readiness import READINESS
 import numpy as np
-from typing import List
-import csv
+from typing import Dict, List
 import datetime as dt
+import threading
+import time
 
 
 logger = logging.getLogger(__name__)
 
 class LabjackInterface():
-    def __init__(self, config: ConfigParser, data_sender: DataSender, data_buf: List[List[int]], valve_state_buf = List[int]):
-        self.handle = ljm.openS("T7", "USB", "ANY")
-        # try:
-        #     ljm.eStreamStop(self.handle)
-        #     ljm.close(self.handle)
-        # finally:
-        #     self.handle = ljm.openS("T7", "USB", "ANY")
+    def __init__(self, config: ConfigParser, data_sender: DataSender, data_buf: List[List[int]], valve_state_buf = List[int],
+                 aux_sensors: AuxSensors = None):
+        # nothing here touches the hardware- the devices are brought up in the background once entered, see _bring_up
+        self.devices = load_devices(config)
+        self.handle = None
         self.config = config
         self.sample_rate = int(self.config["general"]["sample_rate"])
         self.reads_per_sec = int(self.config["general"]["reads_per_sec"])
         self.num_channels = len(self.config["sensor_channel_mapping"].keys())
+        # the stream starts at standby ([general] sample_rate) and is switched to the ignition profile while a
+        # sequence runs, see set_rate_profile
+        self.rate_profiles = load_rate_profiles(self.config)
+        if len(self.devices) > 1 and len(self.rate_profiles) > 1:
+            logger.warning("Rate profiles need a single LabJack, streaming at [general] sample_rate throughout")
+            self.rate_profiles = {"standby": self.rate_profiles["standby"]}
+        self.rate_profile = "standby"
+        self.rate_hold_secs = self.config["general"].getfloat("rate_hold_secs", fallback=5)
+        self.standby_task = None
+        self.rate_lock = asyncio.Lock()
+        self.scan_rate_gauge = REGISTRY.gauge("stream_scan_rate", "Scans per second the stream currently runs at")
+        # compiled live settings, swapped as a whole by apply_config
+        self.runtime = RuntimeConfig(self.config)
+        self.calibration: Calibration = self.runtime.calibration
+        self.calibration_changes = []
         self.data_sender = data_sender
-        self._clear_drivers()
-        self._stream_setup()
+        self.aux_sensors = aux_sensors
+        self.valve_io = None
+        self.timebase = None
         self.running = False
+        self.ready = asyncio.Event()
+        self.bring_up_task = None
         self.task = None
         self.data_buf = data_buf
         self.valve_state_buf = valve_state_buf
-        self.e_index = self._get_emergency_sensor_index() 
         self.total_samples_read = 0
-        self.csv_writer = None
-        self.csv_fd = None
+        self.recorder = None
+        self.writer = None
+        self.aux_writers = {}
         self.ignition_in_progress = False
-        
-
-        # TODO: Why was the emergency check commented out earlier?
+        self.sequences = load_sequences(self.config)
+        self.sequence_runner = None
+        self.safety_monitor = None
+        self.ring = None
+        self.pool = None
+        self.merger = None
+        self.loop = None
+        # lost devices are retried, and lost streams reopened, waiting from backoff[0] doubling up to backoff[1]
+        self.backoff = (self.config["general"].getfloat("reconnect_initial_ms", fallback=100) / 1000,
+                        self.config["general"].getfloat("reconnect_max_secs", fallback=5))
+        self.batch_rows = REGISTRY.histogram("batch_rows", "Scans drained from the ring per event loop pass",
+                                             buckets=[0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 20000])
+        self.calibration_time = REGISTRY.histogram("calibration_seconds", "Time to calibrate one batch")
+        self.submit_time = REGISTRY.histogram("record_submit_seconds", "Time to hand one batch to the recorder and telemetry")
+        self.actuation_time = REGISTRY.histogram("valve_write_seconds", "Time for one valve write")
         
     async def __aenter__(self):
         self.running = True
-        filename = f"../data/{dt.datetime.now().strftime('%m_%d_%Y_%H:%M:%S')}.csv"
-        self.csv_fd = open(filename, "x")
-        self.csv_writer = csv.writer(self.csv_fd)
-        logger.info(f"Created new file: {filename}")
+        self.loop = asyncio.get_running_loop()
+        READINESS.set("labjack", "starting")
+        self.bring_up_task = asyncio.create_task(self._bring_up())
+        return self
+
+    async def wait_ready(self):
+        """
+        Wait for the devices to be streaming, raising if bring-up was stopped first.
+        """
+        ready = asyncio.create_task(self.ready.wait())
+        await asyncio.wait([ready, self.bring_up_task], return_when=asyncio.FIRST_COMPLETED)
+        if not ready.done():
+            ready.cancel()
+            self.bring_up_task.result()
+            raise Exception("LabJack bring-up stopped before it was ready")
+
+    async def _bring_up(self):
+        # the devices are opened and their streams started concurrently, then retried until they all are
+        delay = self.backoff[0]
+        anchor = self.config["general"].get("timestamp_anchor", "stream")
+        while True:
+            try:
+                await asyncio.gather(*(asyncio.to_thread(self._open_device, device, anchor) for device in self.devices))
+                break
+            except Exception as e:
+                READINESS.set("labjack", "retrying", f"{e}, next attempt in {delay:.1f} s")
+                for device in self.devices:
+                    await asyncio.to_thread(device.close)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.backoff[1])
+        try:
+            self._start_streaming()
+        except Exception as e:
+            READINESS.set("labjack", "failed", str(e))
+            await self.data_sender.broadcast_message(f"LabJack failed to start: {e}")
+            raise
+        READINESS.set("labjack", "ready", f"{len(self.devices)} device(s) at {self.timebase.scan_rate} scans/s")
+        await self.data_sender.broadcast_message("LabJack ready")
+
+    def _open_device(self, device, anchor: str):
+        # on a worker thread, one per device
+        device.open()
+        device.stream_setup(self.sample_rate, self.reads_per_sec, anchor)
+
+    def _start_streaming(self):
+        # the first device drives the valves
+        self.handle = self.devices[0].handle
+        self.valve_io = ValveIO(self.config, self.handle)
+        self._clear_drivers()
+        # merged rows are stamped on the first device's timebase
+        self.timebase = self.devices[0].timebase
+        if self.aux_sensors is not None:
+            # put aux sensor timestamps on the same axis as the stream's scans
+            self.aux_sensors.time_origin = self.timebase.start_monotonic - self.timebase.origin
+        self.safety_monitor = SafetyMonitor(self.runtime.config, self.calibration, self.valve_io, self.timebase.scan_rate,
+                                            self._emergency_notify)
         cols = ["Time (s)"]
         for sensors in self.config["sensor_channel_mapping"]:
             cols.append(sensors)
-        cols.append("rtd_external")
-        self.csv_writer.writerow(cols)
+        # 1 for scans the device skipped, their sensor values are NaN (nan in csv)
+        cols.append("Skipped")
+        stem = dt.datetime.now().strftime('%m_%d_%Y_%H:%M:%S')
+        self.writer = self._open_writer(cols, stem)
+        # aux sensors are recorded at their native rate, one file per sensor next to the main one
+        for name in (self.aux_sensors.sensors if self.aux_sensors else {}):
+            aux_recorder = make_recorder(self.config, ["Time (s)", name], self._recording_meta(), stem=f"{stem}_{name}")
+            self.aux_writers[name] = make_writer(self.config, aux_recorder)
+        self._start_readers()
         self.task = asyncio.create_task(self._read_labjack_data())
-        return self
+        self.task.add_done_callback(self._reading_stopped)
+        self.scan_rate_gauge.set(self.timebase.scan_rate)
+        self.ready.set()
     
     async def __aexit__(self, exc_type, exc_value, traceback):
         self.running = False
         if exc_type != None:
             logger.error(f"Labjack interface closed, exception:\n{exc_value}\n\n{traceback}")
-        await self.task
+        if not self.ready.is_set():
+            # still bringing the devices up, stop trying
+            self.bring_up_task.cancel()
+            await asyncio.gather(self.bring_up_task, return_exceptions=True)
+            if self.task is None:
+                for device in self.devices:
+                    device.stop_reader()
+                    device.close()
+                if self.writer is not None:
+                    self.writer.close()
+                READINESS.set("labjack", "stopped")
+                return
+        if self.standby_task is not None:
+            self.standby_task.cancel()
+        # a failure was already reported by _reading_stopped, the files still get closed
+        await asyncio.gather(self.task, return_exceptions=True)
+        if self.merger is not None:
+            self.merger.stop()
+        for device in self.devices:
+            device.stop_reader()
+        stream_stats = self.stream_stats()
+        logger.info(f"Stream stopped - {stream_stats}, safety: {self.safety_monitor.stats()}")
         try:
             self._clear_drivers()
         except:
             pass
-        ljm.eStreamStop(self.handle)
-        ljm.close(self.handle)
-        self.csv_fd.close()
+        for device in self.devices:
+            device.close()
+        READINESS.set("labjack", "stopped")
+        final_meta = {key: stream_stats[key] for key in ("scan_index", "skipped_scans", "skip_events", "overruns", "missing_scans",
+                                                          "reconnects", "gap_scans") if key in stream_stats}
+        gaps = [list(gap) for device in self.devices for gap in device.reader.gaps]
+        if gaps:
+            # [scan index, scans lost] per reconnect
+            final_meta["stream_gaps"] = gaps[-10:]
+        segments = self.timebase.describe_segments()
+        if segments:
+            # [first scan index, its time, scan rate] per rate change
+            final_meta["rate_changes"] = segments[-10:]
+        if self.calibration_changes:
+            # just where they happened, the header has little room- the new values are in the log
+            final_meta["calibration_changes"] = [[change["scan"], change["reason"]] for change in self.calibration_changes[-10:]]
+        self.writer.close(meta=final_meta)
+        logger.info(f"Recorder closed - {self.writer.stats()}")
+        for writer in self.aux_writers.values():
+            writer.close()
+        READINESS.set("recorder", "stopped")
         
+    def _reading_stopped(self, task: asyncio.Task):
+        # otherwise a reader or merger failure would only surface at shutdown
+        if task.cancelled() or task.exception() is None:
+            return
+        error = task.exception()
+        logger.critical(f"Acquisition stopped, no more data is recorded: {error!r}")
+        READINESS.set("labjack", "failed", str(error))
+        asyncio.create_task(self.data_sender.broadcast_message(f"ACQUISITION STOPPED: {error}"))
+
     async def _read_labjack_data(self):
+        poll_interval = 1 / max(reads_per_sec for _, reads_per_sec in self.rate_profiles.values())
         while self.running:
-            await self._write_data_to_sd(await self._sample_data())
-            await asyncio.sleep(0.001)
+            batch = await self._sample_data()
+            # a backlog bigger than one block is drained in the same pass
+            while batch is not None:
+                await self._write_data_to_sd(batch)
+                batch = await self._sample_data() if batch[1] == self.pool.max_rows else None
+            self._write_aux_data()
+            await asyncio.sleep(poll_interval)
             
     async def _sample_data(self):
-        max_reads = 15 # In case of extreme loopback lag allow max of 15 new rows
-        new_rows = []
-        for i in range(max_reads):
-            read_val = ljm.eStreamRead(self.handle)
-            new_rows += list(read_val[0])
-            samples_in_ljm_buff = read_val[2]
-            # print(samples_in_ljm_buff)
-            # self.check_for_emergency(new_rows)
-            self.total_samples_read += 1
-            if self.total_samples_read % 1000 == 0: logger.info(f"{self.total_samples_read} samples obtained")
-            if samples_in_ljm_buff == 0:
-                break
+        # Stream reads happen on the StreamReader thread, here we only drain what it has buffered
+        for thread in [device.reader for device in self.devices] + [self.merger]:
+            if thread is not None and thread.error is not None and not thread.is_alive():
+                raise thread.error
+        if len(self.ring) == 0:
+            return None
+        # pool blocks are laid out like the recording: time (scan index until stamped), channels, skipped
+        block = self.pool.acquire()
+        rows = self.ring.pop_into(block[:, 1:-1], block[:, 0])
+        self.total_samples_read += rows
         await self._update_valve_states()
-        return new_rows
+        return block, rows
 
     def _voltages_to_values(self, sensor_vals: np.ndarray):
-        if sensor_vals.size == 0: return []
-        n_sensors = sensor_vals.copy()
-        sensor_keys = list(self.config['sensor_channel_mapping'].keys())
-        for i, chan in enumerate(sensor_keys):
-            key_prefix = chan[:6]
-            is_two_dim = len(n_sensors.shape) == 2
-            sensor_index = (slice(None), i) if is_two_dim else i
-            offset_key = None
-            scale_key = None
-
-            if key_prefix == "thermo":
-                offset_key = 'thermo_offset'
-                scale_key = 'thermo_scale'
-            elif key_prefix == "b_load":
-                offset_key = 'big_lc_offset'
-                scale_key = 'big_lc_scale'
-            elif key_prefix == "k_load":
-                offset_key = 'k_lc_offset'
-                scale_key = 'k_lc_scale'
-            elif key_prefix == "s_load":
-                offset_key = 'small_lc_offset'
-                scale_key = 'small_lc_scale'
-            elif key_prefix == "strain":
-                offset_key = 'strain_offset'
-                scale_key = 'strain_scale'
-            elif key_prefix[:4] == "pres":
-                pt_num = chan[:6]
-                offset_key = pt_num + '_offset'
-                scale_key = pt_num + '_scale'
-
-            if offset_key and scale_key:
-                n_sensors[sensor_index] = np.round((sensor_vals[sensor_index] - float(self.config['conversion'][offset_key])) /\
-                                                float(self.config['conversion'][scale_key]), 5)
-    
-        return n_sensors.tolist()
+        # Calibrates in place- the caller's voltage block is overwritten
+        return self.calibration.apply(sensor_vals)
     
-    async def _write_data_to_sd(self, data: List[int]):
-        num_new_rows = int(len(data) / self.num_channels)
-        if num_new_rows == 0:
-            return
-        start_time   = (self.total_samples_read - num_new_rows) / self.sample_rate
-        end_time     = (self.total_samples_read - 1) / self.sample_rate
-        timestamps   = np.round(np.linspace(start_time, end_time, num_new_rows), 5)
+    async def _write_data_to_sd(self, batch):
+        block, rows = batch
+        write_data   = block[:rows]
+        data         = write_data[:, 1:-1]
+        skipped      = write_data[:, -1]
+        # the stream reader turns skipped scans into NaN rows, and NaN survives the row sum
+        np.add.reduce(data, axis=1, out=skipped)
+        np.isnan(skipped, out=skipped)
+        # timestamps come from each scan's place in the stream, so late or uneven reads can't shift them
+        self.timebase.stamp(write_data[:, 0])
 
-        dataR        = np.asarray(data).reshape(num_new_rows, self.num_channels)
+        start        = time.perf_counter()
         try:
-            write_data   = np.column_stack((np.transpose(timestamps), self._voltages_to_values(dataR)))
+            self._voltages_to_values(data)
         except Exception as e:
             logger.error(e)
+            self.pool.release(block)
             return
-        
-        self.data_buf[0] = write_data[-1].tolist()[-self.num_channels:]
-        latest_rtd = self.data_sender.get_latest_rtd_temperature()
-        rtd_col = np.full((num_new_rows, 1), 0.0 if latest_rtd is None else latest_rtd)
-        write_data = np.column_stack((write_data, rtd_col))
-        self.csv_writer.writerows(write_data)
+        calibrated   = time.perf_counter()
+        self.batch_rows.observe(rows)
+        self.calibration_time.observe(calibrated - start)
+
+        live = write_data[:, :-1]
+        if skipped.any():
+            live = live[skipped == 0]
+        if live.shape[0]:
+            self.data_buf[0] = live[-1, 1:].tolist()
+            self.data_sender.push_samples(live)
+        # the recorder thread hands the block back to the pool once it's written
+        self.writer.submit(write_data, release=lambda: self.pool.release(block))
+        self.submit_time.observe(time.perf_counter() - calibrated)
+
+    def _open_writer(self, cols, stem: str):
+        self.recorder = make_recorder(self.config, cols, self._recording_meta(), stem=stem)
+        logger.info(f"Created new file: {self.recorder.path}")
+        READINESS.set("recorder", "ready", self.recorder.path)
+        return make_writer(self.config, self.recorder)
+
+    def _write_aux_data(self):
+        for name, writer in self.aux_writers.items():
+            readings = self.aux_sensors.sensors[name].drain()
+            if readings.shape[0]:
+                writer.submit(readings)
+
+    def _recording_meta(self):
+        return {
+            "created": dt.datetime.now().isoformat(),
+            "sample_rate": self.sample_rate,
+            **self.timebase.describe(),
+            "sensor_channel_mapping": dict(self.config["sensor_channel_mapping"]),
+            "devices": {device.name: device.identifier for device in self.devices},
+            "calibration": self.calibration.describe(),
+            "rate_profiles": {name: sample_rate for name, (sample_rate, _) in self.rate_profiles.items()},
+        }
     
     def _clear_drivers(self):
-        for driver in self.config["driver_mapping"]:
-            ljm.eWriteName(self.handle, self.config["driver_mapping"][driver], 0)
+        self.valve_io.clear()
     
-    def _stream_setup(self):
-        
-        aScanListNames = list(self.config["sensor_channel_mapping"].values())
-        aScanList = ljm.namesToAddresses(self.num_channels, aScanListNames)[0]
-        scansPerRead = self.sample_rate // self.reads_per_sec
-
-        reg_names = ["STREAM_TRIGGER_INDEX", "STREAM_CLOCK_SOURCE", "STREAM_RESOLUTION_INDEX", "STREAM_SETTLING_US"]
-        reg_values = [0, 0, 0, 0]
-        for chan in self.config["sensor_negative_channels"].keys():
-            reg_names.append(self.config["sensor_channel_mapping"][chan] + "_NEGATIVE_CH")
-            reg_values.append(int(self.config["sensor_negative_channels"][chan][3:]))
-            reg_names.append(self.config["sensor_channel_mapping"][chan] + "_RANGE")
-            reg_values.append(1)
-            """
-            Differential inputs (load cells and strain gauges) require amplification.
-            Setting to "1" sets a gain of 10x- increasing this will improve the precision of these
-            values, at the expense of sample rate.
-            """
-        numFrames = len(reg_names)
+    def _start_readers(self):
+        ring_secs = self.config["general"].getint("ring_buffer_secs", fallback=10)
+        # one block holds up to batch_max_reads reads worth of scans, plus the time and skipped columns
+        max_reads = self.config["general"].getint("batch_max_reads", fallback=32)
+        scans_per_read = max(sample_rate // reads_per_sec for sample_rate, reads_per_sec in self.rate_profiles.values())
+        self.pool = BlockPool(max(1, scans_per_read) * max_reads, self.num_channels + 2,
+                              self.config["general"].getint("batch_pool_blocks", fallback=16))
+        # lost streams are reopened by their reader, backing off between attempts
+        backoff = self.backoff
+        self.devices[0].on_reopen = self._on_valve_device_reopened
+        if len(self.devices) == 1:
+            device = self.devices[0]
+            device.start_reader(ring_secs, [self.safety_monitor], notify=self._notify_threadsafe, backoff=backoff,
+                                max_scan_rate=max_sample_rate(self.config))
+            self.ring = device.ring
+            return
+        # several devices: the merger lines their scans up and runs the safety check on merged rows
+        data_ready = threading.Event()
+        for device in self.devices:
+            device.start_reader(ring_secs, data_ready=data_ready, notify=self._notify_threadsafe, backoff=backoff)
+        self.ring = ScanRingBuffer(int(self.timebase.scan_rate * ring_secs), self.num_channels)
+        self.merger = StreamMerger(self.devices, self.ring, [self.safety_monitor], data_ready)
+        self.merger.start()
+
+    def stream_stats(self):
+        readers = [device.reader.stats() for device in self.devices]
+        if self.merger is None:
+            return readers[0]
+        stats = {key: sum(reader[key] for reader in readers) for key in ("skipped_scans", "skip_events", "overruns", "reconnects", "gap_scans")}
+        merger = self.merger.stats()
+        stats.update({
+            "scan_index": self.merger.cursor or 0,
+            "overruns": stats["overruns"] + self.ring.overruns,
+            "missing_scans": merger["missing_scans"],
+            "offsets": merger["offsets"],
+            "devices": merger["devices"],
+        })
+        return stats
+
+    async def apply_config(self, sections: Dict[str, Dict[str, str]]) -> List[str]:
+        """
+        Apply the live parts of a reloaded config (see runtime_config.py) without stopping the stream,
+        `sections` being {section: {key: value}}. Returns what changed.
+        """
+        runtime = RuntimeConfig.from_sections(sections)
+        changed = set(self.runtime.changes(runtime)[0])
+        applied = []
+        if changed & CALIBRATION_SECTIONS:
+            # replaces any tare as well
+            self._set_calibration(runtime.calibration, "reload", runtime.config)
+            applied.append("calibration")
+        elif changed & RULE_SECTIONS and self.safety_monitor is not None:
+            self.safety_monitor.configure(runtime.config, self.calibration)
+        if changed & RULE_SECTIONS:
+            applied.append("abort rules")
+        if any(name.startswith("sequence_") for name in changed):
+            # a sequence already running keeps the steps it started with
+            self.sequences = load_sequences(runtime.config)
+            applied.append("sequences")
+        self.runtime = runtime
+        return applied
+
+    async def tare(self, readings: Dict[str, float], target: float = 0.0) -> Dict[str, float]:
+        """
+        Move the offsets of the sensors in `readings` so that the calibrated values they read now (e.g. means
+        over the last few seconds) read `target` from the next block on. Returns the new offsets in volts.
+        """
+        indices = {}
+        for sensor, reading in readings.items():
+            if sensor not in self.calibration.channels:
+                raise Exception(f"Unknown sensor {sensor}")
+            indices[self.calibration.channels.index(sensor)] = float(reading)
+        calibration = self.calibration.tare(indices, target)
+        self._set_calibration(calibration, "tare")
+        return {self.calibration.channels[i]: float(calibration.offset[i]) for i in indices}
+
+    def _set_calibration(self, calibration: Calibration, reason: str, config: ConfigParser = None):
+        # _write_data_to_sd picks the new one up on its next batch and the safety monitor on its next block,
+        # neither ever sees a half-updated calibration
+        old = self.calibration.describe()
+        if self.safety_monitor is not None:
+            self.safety_monitor.configure(config or self.runtime.config, calibration)
+        self.calibration = calibration
+        change = {"scan": self.total_samples_read, "reason": reason,
+                  "sensors": {chan: desc for chan, desc in calibration.describe().items() if old.get(chan) != desc}}
+        self.calibration_changes.append(change)
+        logger.info(f"Calibration changed ({reason}) from scan {change['scan']}: {change['sensors']}")
+
+    async def run_sequence(self, name: str):
+        """
+        Run the [sequence_<name>] step table on its own timer thread and wait for it to finish.
+        """
+        self._require_ready()
+        if name not in self.sequences:
+            await self.data_sender.broadcast_message(f"Sequence {name} is not configured")
+            return
+        if self._sequence_busy():
+            await self.data_sender.broadcast_message(f"Sequence {self.sequence_runner.sequence.name} already running")
+            return
+        # claims the slot before the rate switch below yields- a cancel or abort meanwhile cancels this runner,
+        # and a second sequence sees it as running
+        runner = self.sequence_runner = SequenceRunner(self.sequences[name], self.valve_io, self._notify_threadsafe,
+                                                       self.config["general"].getint("sequence_rt_priority", fallback=50))
+        self.ignition_in_progress = True
         try:
-            ljm.eWriteNames(self.handle, numFrames, reg_names, reg_values)
+            if "ignition" in self.rate_profiles:
+                if self.standby_task is not None:
+                    self.standby_task.cancel()
+                try:
+                    await self.set_rate_profile("ignition")
+                except Exception as e:
+                    # the sequence still runs, just not at the higher rate
+                    logger.error(f"Switching to the ignition rate failed: {e}")
+                    await self.data_sender.broadcast_message(f"Switching to the ignition rate failed: {e}")
+            if runner.canceled.is_set():
+                await self.data_sender.broadcast_message(f"Sequence {name} canceled before it started")
+                return
+            runner.start()
+            await asyncio.to_thread(runner.join)
+        finally:
+            # a sequence that claimed the slot since takes care of this when it ends
+            if runner is self.sequence_runner:
+                self.ignition_in_progress = False
+                if self.rate_profile != "standby":
+                    self.standby_task = asyncio.create_task(self._return_to_standby())
+
+    def _sequence_busy(self) -> bool:
+        # running, or created by run_sequence and about to start unless canceled first
+        runner = self.sequence_runner
+        return runner is not None and (runner.is_alive() or (runner.ident is None and not runner.canceled.is_set()))
+
+    async def set_rate_profile(self, name: str):
+        """
+        Restart the stream at the sample rate of rate profile `name`. Recording and telemetry carry on in
+        the same file- scans after the switch are stamped at the new rate (see StreamTimebase).
+        """
+        self._require_ready()
+        if name not in self.rate_profiles:
+            raise Exception(f"Unknown rate profile {name}")
+        # one restart at a time, the reader only holds one request
+        async with self.rate_lock:
+            if name == self.rate_profile:
+                return
+            reader = self.devices[0].reader
+            done = reader.request_rate(*self.rate_profiles[name])
+            if not await asyncio.to_thread(done.wait, 5):
+                raise Exception("Stream did not restart within 5 s")
+            if reader.rate_error is not None:
+                raise reader.rate_error
+            self.rate_profile = name
+        self.scan_rate_gauge.set(reader.scan_rate)
+        await self.data_sender.broadcast_message(f"Streaming at {reader.scan_rate:g} scans/s ({name})")
+
+    async def _return_to_standby(self):
+        # keeps the high rate for the tail end, e.g. chamber pressure decay after the valves close
+        await asyncio.sleep(self.rate_hold_secs)
+        if self._sequence_busy():
+            return
+        try:
+            await self.set_rate_profile("standby")
         except Exception as e:
-            ljm.eStreamStop(self.handle)
-            ljm.close(self.handle)
-        if (int(ljm.eStreamStart(self.handle, scansPerRead, self.num_channels, aScanList, self.sample_rate))\
-            != self.sample_rate):
-            raise Exception("Failed to configure LabJack data stream!")
-        
+            logger.error(f"Switching back to the standby rate failed: {e}")
+
     async def ignition_sequence(self):
-        self.ignition_in_progress = True
-        for countdown in range(10, 0, -1):
-            if not self.ignition_in_progress:
-                break
-            await self.data_sender.broadcast_message(f"Ignition in {countdown}...")
-            await asyncio.sleep(1)
-        if self.ignition_in_progress:
-            await self.data_sender.broadcast_message(f"IGNITION IN PROGRESS")
-            ljm.eWriteName(self.handle, self.config["driver_mapping"][str(6)],1)
-            for countdown in range(10, 0, -1):
-                if not self.ignition_in_progress:
-                    break
-                await self.data_sender.broadcast_message(f"IGNITING FOR {countdown} MORE SECONDS")
-                await asyncio.sleep(1)
-        if not self.ignition_in_progress:
-            await self.data_sender.broadcast_message(f"IGNITION CANCELED")
-            logger.warning("Ignition canceled")
-        ljm.eWriteName(self.handle, self.config["driver_mapping"][str(6)],0)
+        await self.run_sequence("ignition")
 
     async def sphinx_ignition_sequence_short(self):
-        self.ignition_in_progress = True
-        #TODO: Change countdown if needed
-        for countdown in range(5, -1, -1):
-            if not self.ignition_in_progress:
-                break
-            await self.data_sender.broadcast_message(f"Ignition in {countdown}...")
-            await asyncio.sleep(1)
-        #open nitrous/ox run
-
-        ljm.eWriteName(self.handle, self.config["driver_mapping"]["5"], True)
-        #open ethanol valve
-        ljm.eWriteName(self.handle, self.config["driver_mapping"]["4"], True)
-        #time delay of 0.2s
-        #TODO: change delay if needed
-        for delay in range(1,0,-1):
-            await asyncio.sleep(0.2)
-        # fire for 2 seconds
-        await self.data_sender.broadcast_message(f"IGNITION IN PROGRESS")
-        ljm.eWriteName(self.handle, self.config["driver_mapping"][str(6)],1)
-        for countdown in range(1, 0, -1):
-                if not self.ignition_in_progress:
-                    break
-                await self.data_sender.broadcast_message(f"IGNITING FOR {countdown} MORE SECONDS")
-                await asyncio.sleep(1.5)
-        if not self.ignition_in_progress:
-            await self.data_sender.broadcast_message(f"IGNITION CANCELED")
-            logger.warning("Ignition canceled")
-        
-        #closes all ethanol, lower servovale, and ignition
-        ljm.eWriteName(self.handle, self.config["driver_mapping"]["4"], False)
-        ljm.eWriteName(self.handle, self.config["driver_mapping"]["5"], False)
-        ljm.eWriteName(self.handle, self.config["driver_mapping"][str(6)],0)
-    
+        await self.run_sequence("sphinx_short")
+
     async def sphinx_ignition_sequence_long(self):
-        self.ignition_in_progress = True
-        #TODO: Change countdown if needed
-        for countdown in range(5, -1, -1):
-            if not self.ignition_in_progress:
-                break
-            await self.data_sender.broadcast_message(f"Ignition in {countdown}...")
-            await asyncio.sleep(1)
-        #open ethanol and nitrous fill valve and turn on igniters
-        await self.data_sender.broadcast_message(f"IGNITION IN PROGRESS")
-        ljm.eWriteName(self.handle, self.config["driver_mapping"]["4"], True)
-        ljm.eWriteName(self.handle, self.config["driver_mapping"]["5"], True)
-        #TODO: change delay if needed
-        for delay in range(1,0,-1):
-            await asyncio.sleep(0.2)
-        ljm.eWriteName(self.handle, self.config["driver_mapping"][str(6)],1)
-        for countdown in range(4, -1, -1):
-                if not self.ignition_in_progress:
-                    break
-                await self.data_sender.broadcast_message(f"IGNITING FOR {countdown} MORE SECONDS")
-                await asyncio.sleep(1)
-        if not self.ignition_in_progress:
-            await self.data_sender.broadcast_message(f"IGNITION CANCELED")
-            logger.warning("Ignition canceled")
-        #closes all ethanol, lower servovalve, and ignition
-        ljm.eWriteName(self.handle, self.config["driver_mapping"]["4"], False)
-        ljm.eWriteName(self.handle, self.config["driver_mapping"]["5"], False)
-        ljm.eWriteName(self.handle, self.config["driver_mapping"][str(6)],0)
+        await self.run_sequence("sphinx_long")
 
     async def proxima_ignition_sequence(self):
-        self.ignition_in_progress = True
-        for countdown in range(10, -1, -1):
-            if not self.ignition_in_progress:
-                break
-            await self.data_sender.broadcast_message(f"Ignition in {countdown}...")
-            await asyncio.sleep(1)
-        if self.ignition_in_progress:
-            #opens ox fill for 0.2 seconds
-            await self.data_sender.broadcast_message(f"Opening ox fill")
-            ljm.eWriteName(self.handle, self.config["driver_mapping"]["0"], True)
-            for valve_delay in range(0,-1,-1):
-                await self.data_sender.broadcast_message("Waiting for 0.2 seconds")
-                await asyncio.sleep(0.2)
-                
-            await self.data_sender.broadcast_message(f"IGNITION IN PROGRESS")
-
-            #turns on igniters
-            ljm.eWriteName(self.handle, self.config["driver_mapping"][str(6)],1)
-            for countdown in range(10, -1, -1):
-                if not self.ignition_in_progress:
-                    break
-                await self.data_sender.broadcast_message(f"IGNITING FOR {countdown} MORE SECONDS")
-                await asyncio.sleep(1)
-        if not self.ignition_in_progress:
-            await self.data_sender.broadcast_message(f"IGNITION CANCELED")
-            logger.warning("Ignition canceled")
-        #closes nitrous feed valve (ox fill)
-        ljm.eWriteName(self.handle, self.config["driver_mapping"]["0"], False)
-        ljm.eWriteName(self.handle, self.config["driver_mapping"][str(6)],0)
-        #closes ops pneumatic valve
-        ljm.eWriteName(self.handle, self.config["driver_mapping"]["5"], False)
+        await self.run_sequence("proxima")
 
     async def cancel_ignition(self):
         self.ignition_in_progress = False
-        await self.data_sender.broadcast_message(f"Canceling ignition...")
+        if self.sequence_runner is not None:
+            self.sequence_runner.cancel()
+        await self.data_sender.broadcast_message("Canceling ignition...")
+
+    async def abort(self):
+        """
+        Cancel any running sequence and put the emergency shutdown valve in its shutdown state.
+        """
+        self.ignition_in_progress = False
+        if self.sequence_runner is not None:
+            self.sequence_runner.cancel()
+        self._require_ready()
+        if not self.safety_monitor.enabled:
+            await self.data_sender.broadcast_message("Abort: sequence canceled, no shutdown valve configured")
+            return
+        self.valve_io.write({self.safety_monitor.valve: self.safety_monitor.shutdown_state})
+        await self.data_sender.broadcast_message(f"Abort: shutdown valve {self.safety_monitor.valve} set to {self.safety_monitor.shutdown_state}")
 
     async def actuate(self, driver: int, value: bool):
-        ljm.eWriteName(self.handle, driver, value)
+        self._require_ready()
+        start = time.perf_counter()
+        # off the event loop, so a slow USB transfer doesn't hold up telemetry or other commands
+        await asyncio.to_thread(self.valve_io.write, {driver: value})
+        self.actuation_time.observe(time.perf_counter() - start)
         
-    async def check_for_emergency(self, sensor_readings):
-        if sensor_readings[-self.num_channels:][self.e_index] > int(self.config["proxima_emergency_shutdown"]["max_pressure"]):
-            '''TODO: we probably need to bound this condition so invalid readings from the sensor being
-               unplugged dont falsely trigger emergency'''
-            self.strikes += 1
-            if (self.strikes >= 3):
-                # 3 bad values in a row -> emergency shutdown
-                ljm.eWriteName(self.handle, self.config["proxima_emergency_shutoff"]["shutdown_valve"], 0)
-                await self.data_sender.send("Emergency shutdown executed!")
-        else:
-            self.strikes = 0
-            
-    """
-    Get the index to refer to the emergency shutdown indicating sensor by
-    """
-    def _get_emergency_sensor_index(self):
-        idx = 0
-        for sensor in self.config["sensor_channel_mapping"]:
-            if sensor == self.config['proxima_emergency_shutdown']['sensor_name']:
-                return idx
-            idx += 1
-        raise Exception("'sensor name' field of emergency config not found in sensors list")
+    def _require_ready(self):
+        # commands can arrive as soon as the dashboard server is up, before the devices are
+        if not self.ready.is_set():
+            raise Exception(f"LabJack is not ready yet ({READINESS.snapshot().get('labjack', {}).get('state', 'starting')})")
+
+    def _emergency_notify(self, message: str):
+        # Called from the stream thread after the shutdown valve has already been written
+        if self.sequence_runner is not None:
+            self.sequence_runner.cancel()
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self._on_emergency, message)
+
+    def _on_emergency(self, message: str):
+        self.ignition_in_progress = False
+        asyncio.create_task(self.data_sender.broadcast_message(message))
+
+    def _notify_threadsafe(self, message: str):
+        self.loop.call_soon_threadsafe(lambda: asyncio.create_task(self.data_sender.broadcast_message(message)))
 
     async def _update_valve_states(self):
-        states = []
-        statebin = format(int(ljm.eReadName(self.handle,"EIO_STATE")),'06b')
-        for char in statebin:
-            states.append(int(char))
-        statebin = format(int(ljm.eReadName(self.handle,"CIO_STATE")),'04b')
-        states = [(int(statebin[1]))] + states
-        self.valve_state_buf[0] = states[::-1]
-        print(self.valve_state_buf[0])
+        try:
+            self.valve_state_buf[0] = self.valve_io.read_states()
+        except Exception as e:
+            # e.g. the device is reconnecting- the dashboard keeps the last known states meanwhile
+            logger.debug(f"Reading valve states failed: {e}")
+
+    def _on_valve_device_reopened(self, device):
+        # runs on the stream reader thread, before the new stream's first read
+        self.handle = device.handle
+        self.valve_io.handle = device.handle
+        try:
+            states = self.valve_io.read_states(force=True)
+            logger.info(f"Valve states after reconnecting: {states}")
+        except Exception as e:
+            logger.error(f"Reading valve states after reconnecting failed: {e}")
@@ -0,0 +1,141 @@
+"""
+Logging that stays off the hot paths.
+
+Records are put on a queue by whichever thread logs them and written to stdout and ../logs by a
+QueueListener thread, so slow SD card or terminal writes never stall the event loop or the stream
+readers. Per-iteration messages go through LogSummary, which logs one aggregated line per interval
+instead. Levels are set per logger (i.e. per module) from [logging] and can be changed at runtime with
+the websocket LogLevel command.
+"""
+
+from logging.handlers import QueueHandler, QueueListener
+from configparser import ConfigParser
+from typing import Dict
+import datetime as dt
+import logging
+import atexit
+import queue
+import time
+import sys
+import os
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+QUEUE_RECORDS = 10000
+
+logger = logging.getLogger(__name__)
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Never blocks the caller- if the listener falls a whole queue behind, records are counted and dropped.
+    """
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_listener = None
+_handler = None
+
+def setup_logging(level=logging.DEBUG, directory: str = "../logs"):
+    """
+    Route the root logger through a queue to stdout and a new file in `directory`.
+    """
+    global _listener, _handler
+    formatter = logging.Formatter(LOG_FORMAT, datefmt="%Y-%m-%d %H:%M:%S")
+    outputs = [
+        logging.StreamHandler(sys.stdout),
+        logging.FileHandler(f"{directory}/log_{dt.datetime.now().strftime('%m_%d_%Y_%H:%M:%S')}.log"),
+    ]
+    for output in outputs:
+        output.setFormatter(formatter)
+    root = logging.getLogger()
+    root.setLevel(level)
+    _handler = DroppingQueueHandler(queue.Queue(QUEUE_RECORDS))
+    root.addHandler(_handler)
+    _listener = QueueListener(_handler.queue, *outputs, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    # a forked child (see multiproc.py) gets the queue but not the listener thread, start its own
+    os.register_at_fork(after_in_child=_restart_listener)
+    return _listener
+
+def _restart_listener():
+    global _listener
+    if _listener is None:
+        return
+    _handler.queue = queue.Queue(QUEUE_RECORDS)
+    _listener = QueueListener(_handler.queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+def stop_logging():
+    # flushes whatever is still queued
+    if _listener is not None:
+        _listener.stop()
+
+def dropped_records() -> int:
+    return _handler.dropped if _handler is not None else 0
+
+def set_levels(levels: Dict[str, str]) -> Dict[str, str]:
+    """
+    Set logger levels from {logger name: level name}, "root" for the root logger. Raises on an unknown
+    level before changing anything. Returns the levels of the root and every configured logger.
+    """
+    parsed = {}
+    for name, level in levels.items():
+        value = logging.getLevelName(str(level).upper())
+        if not isinstance(value, int):
+            raise Exception(f"Unknown log level '{level}'")
+        parsed[name] = value
+    for name, value in parsed.items():
+        logging.getLogger(None if name == "root" else name).setLevel(value)
+        logger.info(f"Log level of {name} set to {logging.getLevelName(value)}")
+    return current_levels()
+
+def current_levels() -> Dict[str, str]:
+    levels = {"root": logging.getLevelName(logging.getLogger().level)}
+    for name, item in sorted(logging.root.manager.loggerDict.items()):
+        if isinstance(item, logging.Logger) and item.level != logging.NOTSET:
+            levels[name] = logging.getLevelName(item.level)
+    return levels
+
+def apply_config(config: ConfigParser):
+    """
+    [logging] level sets the root level, any other key sets the level of the logger it names.
+    """
+    if not config.has_section("logging"):
+        return
+    levels = dict(config["logging"])
+    if "level" in levels:
+        levels["root"] = levels.pop("level")
+    set_levels(levels)
+
+class LogSummary():
+    """
+    Counts hot-path events and logs them as one line per `interval` seconds, e.g.
+    "Sent 48 frames to client 3 in the last 10 s". Counting is a dict update and a clock read.
+    """
+    def __init__(self, log: logging.Logger, interval: float = 10.0, level=logging.INFO):
+        self.log = log
+        self.interval = interval
+        self.level = level
+        self.counts: Dict[str, int] = {}
+        self.last = time.monotonic()
+
+    def count(self, event: str, n: int = 1):
+        self.counts[event] = self.counts.get(event, 0) + n
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.flush(now)
+
+    def flush(self, now: float = None):
+        now = time.monotonic() if now is None else now
+        if self.counts and self.log.isEnabledFor(self.level):
+            summary = ", ".join(event.format(n=n) for event, n in self.counts.items())
+            self.log.log(self.level, f"{summary} in the last {now - self.last:.0f} s")
+        self.counts = {}
+        self.last = now
@@ -24,66 +24,71 @@ Run-on-startup config at: /home/eclipsepi/.config/systemd/user/labjack.service
 """
 
 from data_to_dash import DataSender
-from cmd_from_dash import CmdListener
+from cmd_from_dash import serve_dashboard
 from configparser import ConfigParser
-from websockets.asyncio.server import ServerConnection, serve
 import asyncio
-import signal
 from labjack_interface import LabjackInterface
+from aux_sensors import AuxSensors
+from devices import merge_device_channels
+from metrics import MetricsServer
+from multiproc import ProcessSupervisor
+from logconfig import apply_config as apply_log_config, setup_logging
+from runtime_config import RuntimeConfig
 import logging
-import sys
-import datetime as dt
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(
-    
-    level=logging.DEBUG,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler(f"../logs/log_{dt.datetime.now().strftime('%m_%d_%Y_%H:%M:%S')}.log")
-    ]
-)
+# the queue keeps stdout and SD card writes off the event loop- see logconfig.py
+setup_logging(logging.DEBUG, "../logs")
 
 class ServiceDirector():
     def __init__(self, config_file: str):
         self.config = ConfigParser()
-        self.config.read(config_file)
+        files = self.config.read(config_file)
         self._validate_config()
+        # the parts that can be reloaded while running, see runtime_config.py
+        self.runtime = RuntimeConfig(self.config, files)
         self.data_buf = [None]
         self.valve_state_buf = [None]
+        self.aux_sensors = AuxSensors(self.config)
         
     def _validate_config(self):
-        pass
+        apply_log_config(self.config)
+        # several LabJacks are presented to everything else as one channel table
+        merge_device_channels(self.config)
     
     async def run(self):
         logger.info("Running...")
-        async with DataSender(self.config, self.data_buf, self.valve_state_buf) as data_sender:
-            async with LabjackInterface(self.config, data_sender, self.data_buf, self.valve_state_buf) as ljm_int:
-                async with CmdListener(self.config, data_sender, ljm_int) as cmd_listener:
-                    async def ws_handle(websocket: ServerConnection):
-                        logger.info(f"Incoming connection from {websocket.id}")
-                        await data_sender.add_client(websocket)
-                        await cmd_listener.recv_cmd(websocket)
-                    
-                    loop = asyncio.get_event_loop()
-                    stop = loop.create_future()
-                    loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
-                    async with serve(
-                        ws_handle, 
-                        self.config["general"]["HOST"], 
-                        int(self.config["general"]["PORT"])
-                    ):
-                        logger.info("Starting websocket server...")
-                        await stop
+        self.aux_sensors.start()
+        try:
+            await self._serve()
+        finally:
+            self.aux_sensors.stop()
+
+    async def _serve(self):
+        async with MetricsServer(self.config):
+            await self._serve_dashboard()
+
+    async def _serve_dashboard(self):
+        async with DataSender(self.config, self.data_buf, self.valve_state_buf, self.aux_sensors) as data_sender:
+            async with LabjackInterface(self.config, data_sender, self.data_buf, self.valve_state_buf, self.aux_sensors) as ljm_int:
+                await serve_dashboard(self.config, data_sender, ljm_int, self.runtime)
+
+    def run_processes(self):
+        logger.info("Running as separate acquisition, recorder and server processes...")
+        ProcessSupervisor(self.config, self.aux_sensors, self.runtime).run()
         
 def main():
-    asyncio.run(ServiceDirector("config.ini").run())
+    director = ServiceDirector("config.ini")
+    if director.config["general"].get("processes", "single") == "multi":
+        director.run_processes()
+    else:
+        asyncio.run(director.run())
 
-print("\n===============================================================\
+# sim.py imports this module and calls main() itself
+if __name__ == "__main__":
+    print("\n===============================================================\
 \nData Acquisition and Remote Control for Eclipse Hybrid Engines\
 \nSoftware version 2.0.0\
 \n===============================================================")
-main()
-print("[I] Stopping program")
+    main()
+    print("[I] Stopping program")
@@ -0,0 +1,257 @@
+"""
+Runtime metrics and an on-demand sampling profiler.
+
+Counters, gauges and histograms live in the module-level REGISTRY and are cheap enough for the
+stream hot path: an observation is a bisect and two additions, no locks and no allocation. They can
+be read with the websocket `Metrics` command or as Prometheus text from the HTTP endpoint
+configured in [metrics]. The `Profile` command starts/stops a SamplingProfiler.
+"""
+
+from configparser import ConfigParser
+from collections import Counter as StackCounter
+from typing import Dict, List, Tuple
+import datetime as dt
+import threading
+import traceback
+import asyncio
+import logging
+import bisect
+import time
+import sys
+
+logger = logging.getLogger(__name__)
+
+# seconds, 50 us to 5 s
+LATENCY_BUCKETS = [0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+
+class Counter():
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name + "_total", self.labels, self.value)]
+
+    def snapshot(self):
+        return self.value
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [(self.name, self.labels, self.value)]
+
+class Histogram():
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple = (), buckets: List[float] = None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = list(buckets or LATENCY_BUCKETS)
+        self.counts = [0] * (len(self.buckets) + 1) # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float):
+        # upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + [self.max], self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def samples(self):
+        out = []
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            out.append((self.name + "_bucket", self.labels + (("le", repr(bound)),), seen))
+        out.append((self.name + "_bucket", self.labels + (("le", "+Inf"),), self.count))
+        out.append((self.name + "_sum", self.labels, self.sum))
+        out.append((self.name + "_count", self.labels, self.count))
+        return out
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+class Registry():
+    def __init__(self):
+        self.metrics: Dict[Tuple, object] = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name: str, help: str, labels: Dict[str, str] = None, **kwargs):
+        labels = tuple(sorted((labels or {}).items()))
+        key = (name, labels)
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(key, cls(name, help, labels, **kwargs))
+        return metric
+
+    def counter(self, name: str, help: str, labels: Dict[str, str] = None) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: Dict[str, str] = None) -> Gauge:
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str, labels: Dict[str, str] = None, buckets: List[float] = None) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def remove(self, name: str, labels: Dict[str, str] = None):
+        self.metrics.pop((name, tuple(sorted((labels or {}).items()))), None)
+
+    def snapshot(self) -> Dict:
+        out = {}
+        for (name, labels), metric in list(self.metrics.items()):
+            key = name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else "")
+            out[key] = metric.snapshot()
+        return out
+
+    def render_prometheus(self) -> str:
+        lines = []
+        described = set()
+        for (name, _), metric in sorted(list(self.metrics.items()), key=lambda item: item[0]):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {metric.help}")
+                lines.append(f"# TYPE {name} {metric.kind}")
+            for sample, labels, value in metric.samples():
+                label_text = "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+                lines.append(f"{sample}{label_text} {value}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+async def watch_loop_lag(interval: float = 0.05):
+    """
+    Measures how late the event loop wakes up from a sleep- anything blocking the loop shows up here.
+    """
+    lag = REGISTRY.histogram("event_loop_lag_seconds", "How late the event loop ran a timer")
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag.observe(max(0.0, loop.time() - start - interval))
+
+class MetricsServer():
+    """
+    Minimal HTTP endpoint serving REGISTRY as Prometheus text on GET /metrics.
+    """
+    def __init__(self, config: ConfigParser):
+        self.host = config.get("metrics", "http_host", fallback="127.0.0.1")
+        self.port = config.getint("metrics", "http_port", fallback=0)
+        self.server = None
+        self.lag_task = None
+
+    async def __aenter__(self):
+        self.lag_task = asyncio.create_task(watch_loop_lag())
+        if self.port:
+            self.server = await asyncio.start_server(self._handle, self.host, self.port)
+            logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.lag_task.cancel()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            path = request.split(b" ")[1] if request.count(b" ") >= 2 else b""
+            if path.split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", REGISTRY.render_prometheus().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+class SamplingProfiler(threading.Thread):
+    """
+    Samples the stacks of every thread `rate_hz` times a second while running. Costs nothing when
+    stopped- the thread only exists between start and stop. Results are in the collapsed-stack format
+    flamegraph tools read (`frame;frame;frame count` per line).
+    """
+    def __init__(self, rate_hz: float = 100):
+        super().__init__(name="sampling-profiler", daemon=True)
+        self.interval = 1 / rate_hz
+        self.stacks = StackCounter()
+        self.samples = 0
+        self.started = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.started = time.monotonic()
+        super().start()
+
+    def stop(self):
+        self.running = False
+        if self.is_alive():
+            self.join(1.0)
+
+    def run(self):
+        me = threading.get_ident()
+        names = {}
+        while self.running:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = [f"{f.name} ({f.filename.rsplit('/', 1)[-1]}:{f.lineno})" for f in traceback.extract_stack(frame)]
+                self.stacks[";".join([names.get(ident, str(ident))] + stack)] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+    def top(self, n: int = 15):
+        # innermost frames by share of samples, per thread
+        leaves = StackCounter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            leaves[f"{frames[0]}: {frames[-1]}"] += count
+        return [(leaf, count / max(1, self.samples)) for leaf, count in leaves.most_common(n)]
+
+    def save(self, directory: str = "../logs") -> str:
+        path = f"{directory}/profile_{dt.datetime.now().strftime('%m_%d_%Y_%H:%M:%S')}.folded"
+        with open(path, "w") as fd:
+            fd.write(self.collapsed())
+        return path
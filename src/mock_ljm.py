@@ -1,38 +1,348 @@
+"""
+Stand-in for labjack.ljm used by sim.py.
+
+Streams are paced by the scan rate and scansPerRead passed to eStreamStart and report a device and
+LJM scan backlog like the real library. A device whose stream outruns USB (`max_samples_per_sec`)
+fills its buffer and skips scans, which come back as -9999 the way LJM auto-recovery reports them.
+`disconnect_every_secs` unplugs the device now and then: reads fail and it can't be opened until it's back.
+Scan values come from a recording replayed through the inverse of the configured calibration, or
+from waveforms synthesized per sensor- see the [sim] and [sim_waveforms] sections of config_sim.ini.
+"""
+
+from configparser import ConfigParser
+import numpy as np
+import threading
+import logging
 import random
-import datetime as dt
 import time
+import csv
+import re
+
+logger = logging.getLogger(__name__)
+
+SKIP_MARKER = -9999.0
+CORE_TIMER_HZ = 40e6
+DIO_RE = re.compile(r"^(FIO|EIO|CIO|MIO)(\d+)$")
+
+class LJMError(Exception):
+    def __init__(self, errorCode=None, errorAddress=None, errorString=""):
+        super().__init__(errorString)
+        self.errorCode = errorCode
+        self.errorAddress = errorAddress
+        self.errorString = errorString
+
+WAVEFORMS = {}
+
+def waveform(kind: str):
+    def wrap(func):
+        WAVEFORMS[kind] = func
+        return func
+    return wrap
+
+@waveform("constant")
+def _constant(t, value):
+    return np.full(t.shape, value)
+
+@waveform("noise")
+def _noise(t, mean, sd):
+    return np.random.normal(mean, sd, t.shape)
+
+@waveform("sine")
+def _sine(t, mean, amplitude, hz):
+    return mean + amplitude * np.sin(2 * np.pi * hz * t)
+
+@waveform("ramp")
+def _ramp(t, start_value, end_value, start, secs):
+    # holds start_value until `start`, ramps over `secs`, then holds end_value
+    return start_value + (end_value - start_value) * np.clip((t - start) / secs, 0, 1)
+
+@waveform("spike")
+def _spike(t, base, peak, every, width):
+    # a `width` second pulse up to `peak` every `every` seconds
+    return np.where(np.mod(t, every) < width, peak, base)
+
+def parse_waveform(spec: str):
+    """
+    `ramp 0 800 5 10 + noise 0 3` -> function of scan times. Terms separated by + are summed.
+    """
+    terms = []
+    for term in spec.split(" + "):
+        kind, *args = term.split()
+        if kind not in WAVEFORMS:
+            raise Exception(f"Unknown sim waveform '{kind}', expected one of {list(WAVEFORMS)}")
+        terms.append((WAVEFORMS[kind], [float(a) for a in args]))
+    return lambda t: sum(func(t, *args) for func, args in terms)
+
+class SimSource():
+    """
+    Engineering values for one stream's channels, converted to volts with the inverse calibration.
+    """
+    def __init__(self, config: ConfigParser, channels, scan_rate: float, time_offset: float = 0.0):
+        self.channels = channels
+        self.scan_rate = scan_rate
+        # seconds since the sim started, so a restarted stream carries on with the same waveforms
+        self.time_offset = time_offset
+        self.calibration = None
+        self.recording = None
+        waveforms = config["sim_waveforms"] if config is not None and config.has_section("sim_waveforms") else {}
+        default = waveforms.get("default", "noise 0 1")
+        self.waveforms = [parse_waveform(waveforms.get(chan, default)) for chan in channels]
+        if config is None:
+            return
+        self.calibration = self._calibration(config)
+        self.cal_index = [self.calibration.channels.index(chan) if chan in self.calibration.channels else None
+                          for chan in channels]
+        source = config.get("sim", "source", fallback="synth")
+        if source != "synth":
+            self.recording = self._load_recording(source)
+
+    def _calibration(self, config: ConfigParser):
+        from calibration import Calibration
+        merged = ConfigParser()
+        merged.read_dict(config)
+        if not merged.has_section("sensor_channel_mapping"):
+            mapping = {}
+            for section in merged.sections():
+                if section.startswith("sensor_channel_mapping_"):
+                    mapping.update(merged[section])
+            merged.read_dict({"sensor_channel_mapping": mapping})
+        return Calibration.from_config(merged)
+
+    def _load_recording(self, path: str):
+        if path.endswith(".ljr"):
+            from recorder import read_recording
+            header, records = read_recording(path)
+            columns, values = header["columns"], np.column_stack([records[name] for name in records.dtype.names])
+        else:
+            with open(path, newline="") as fd:
+                columns = next(csv.reader(fd))
+            values = np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+        # channels the recording doesn't have keep their synthesized waveform
+        self.replayed = [columns.index(chan) if chan in columns else None for chan in self.channels]
+        logger.info(f"Replaying {values.shape[0]} scans from {path}")
+        return values
+
+    def scans(self, first: int, count: int) -> np.ndarray:
+        indices = np.arange(first, first + count)
+        t = self.time_offset + indices / self.scan_rate
+        block = np.empty((count, len(self.channels)))
+        for i, func in enumerate(self.waveforms):
+            col = self.replayed[i] if self.recording is not None else None
+            if col is None:
+                block[:, i] = func(t)
+            else:
+                # replay loops once the recording runs out
+                block[:, i] = self.recording[indices % self.recording.shape[0], col]
+        return self._to_volts(block)
+
+    def _to_volts(self, block: np.ndarray) -> np.ndarray:
+        if self.calibration is None:
+            return block
+        cal = self.calibration
+        volts = np.empty_like(block)
+        nonlinear = {i: func for i, _, _, func in cal.nonlinear}
+        for col, index in enumerate(self.cal_index):
+            if index is None:
+                volts[:, col] = block[:, col]
+            elif index in nonlinear:
+                # invert numerically over the T7's input range
+                grid = np.linspace(-11, 11, 4096)
+                curve = nonlinear[index](grid)
+                order = np.argsort(curve)
+                volts[:, col] = np.interp(block[:, col], curve[order], grid[order])
+            else:
+                volts[:, col] = block[:, col] * cal.scale[index] + cal.offset[index]
+        # skipped scans in a replayed recording are skipped again
+        volts[np.isnan(volts).any(axis=1)] = SKIP_MARKER
+        return volts
+
+class SimStream():
+    def __init__(self, source: SimSource, scans_per_read: int, num_addresses: int, scan_rate: float, options):
+        self.source = source
+        self.scans_per_read = scans_per_read
+        self.num_addresses = num_addresses
+        self.scan_rate = scan_rate
+        self.speed = options.getfloat("speed", fallback=1.0)
+        self.start = time.monotonic()
+        # device -> LJM transfer limit, and the buffers on each side of it
+        self.usb_scans_per_sec = options.getfloat("max_samples_per_sec", fallback=100000) / num_addresses
+        self.device_buffer_scans = options.getint("device_buffer_samples", fallback=16384) // num_addresses
+        self.ljm_buffer_scans = int(options.getfloat("ljm_buffer_secs", fallback=20) * scan_rate)
+        self.skip_every_secs = options.getfloat("skip_every_secs", fallback=0)
+        self.skip_burst = options.getint("skip_burst", fallback=10)
+        self.produced = 0 # scans the device has sampled
+        self.lost = 0 # scans dropped because the device buffer was full
+        self.sent = 0 # scans moved from the device to the LJM buffer
+        self.consumed = 0 # scans returned by eStreamRead
+        self.skips = [] # (first scan, count) ranges returned as SKIP_MARKER
+        self.last_update = self.start
+
+    def _update(self, now: float):
+        if self.speed <= 0:
+            # as fast as the reader can take them
+            self.produced = self.sent = max(self.produced, self.consumed + self.scans_per_read)
+            return
+        elapsed = (now - self.start) * self.speed
+        produced = int(elapsed * self.scan_rate)
+        new = produced - self.produced
+        self.produced = produced
+        if self.skip_every_secs and new and random.random() < new / (self.scan_rate * self.skip_every_secs):
+            self.skips.append((produced - new, min(new, self.skip_burst)))
+        sendable = int((now - self.last_update) * self.speed * self.usb_scans_per_sec)
+        self.last_update = now
+        self.sent += min(self.device_backlog(), sendable)
+        overflow = self.device_backlog() - self.device_buffer_scans
+        if overflow > 0:
+            # the device drops the newest scans, LJM fills the gap with placeholders on recovery
+            self.lost += overflow
+            self.skips.append((produced - overflow, overflow))
+
+    def device_backlog(self) -> int:
+        return self.produced - self.lost - self.sent
+
+    def ljm_backlog(self) -> int:
+        # placeholders for lost scans are returned along with the real ones
+        return self.sent + self.lost - self.consumed
+
+    def read(self):
+        n = self.scans_per_read
+        while True:
+            now = time.monotonic()
+            self._update(now)
+            if self.ljm_backlog() >= n:
+                break
+            missing = n - self.ljm_backlog()
+            time.sleep(max(missing / (self.scan_rate * max(self.speed, 1e-9)), 0.0002))
+        if self.ljm_backlog() > self.ljm_buffer_scans:
+            raise LJMError(1301, None, "LJME_LJM_BUFFER_FULL")
+        first = self.consumed
+        block = self.source.scans(first, n)
+        for start, count in self.skips:
+            lo, hi = max(start, first), min(start + count, first + n)
+            if lo < hi:
+                block[lo - first:hi - first] = SKIP_MARKER
+        self.skips = [(start, count) for start, count in self.skips if start + count > first + n]
+        self.consumed += n
+        return (block.ravel().tolist(), self.device_backlog(), self.ljm_backlog())
 
 class SimLJM:
-    def __init__(self):
-        self.last_stream_read = dt.datetime.now()
-        self.data = [random.randint(0, 10) for _ in range(14)]
-    
+    LJMError = LJMError
+
+    def __init__(self, config: ConfigParser = None):
+        self.config = config
+        self.lock = threading.Lock()
+        self.handles = 0
+        self.device_index = {} # handle -> position in [devices] of the device it was opened on
+        self.streams = {}
+        self.registers = {} # (handle, name) -> last written value
+        self.created = time.monotonic()
+        self.next_disconnect = None
+        # a device still enumerating at boot
+        self.unplugged_until = time.monotonic() + self._options().getfloat("plugged_in_after_secs", fallback=0)
+
+    def _options(self):
+        if self.config is not None and self.config.has_section("sim"):
+            return self.config["sim"]
+        empty = ConfigParser()
+        empty.add_section("sim")
+        return empty["sim"]
+
+    def _check_plugged_in(self):
+        options = self._options()
+        every = options.getfloat("disconnect_every_secs", fallback=0)
+        now = time.monotonic()
+        if every and self.next_disconnect is None:
+            self.next_disconnect = now + random.expovariate(1 / every)
+        if self.next_disconnect is not None and now >= self.next_disconnect:
+            self.unplugged_until = now + options.getfloat("disconnect_secs", fallback=2)
+            self.next_disconnect = self.unplugged_until + random.expovariate(1 / every)
+            self.streams.clear()
+        if now < self.unplugged_until:
+            raise LJMError(1227, None, "LJME_DEVICE_NOT_FOUND")
+
+    def _device_position(self, identifier) -> int:
+        """
+        Position in [devices] of the device opened as `identifier`, whatever order handles were opened
+        and closed in. Devices listed with the same identifier (e.g. ANY) get the first of them not open yet.
+        """
+        if self.config is None or not self.config.has_section("devices"):
+            return 0
+        candidates = [i for i, spec in enumerate(self.config["devices"].values()) if spec.split()[0] == str(identifier)]
+        if not candidates:
+            raise LJMError(1227, None, "LJME_DEVICE_NOT_FOUND")
+        opened = set(self.device_index.values())
+        return next((i for i in candidates if i not in opened), candidates[0])
+
+    def _channels(self, handle, addresses):
+        section = "sensor_channel_mapping"
+        if self.config is not None and self.config.has_section("devices"):
+            section = f"sensor_channel_mapping_{list(self.config['devices'])[self.device_index[handle]]}"
+        names = {}
+        if self.config is not None and self.config.has_section(section):
+            names = {ain.upper(): chan for chan, ain in self.config[section].items()}
+        return [names.get(f"AIN{address // 2}", f"AIN{address // 2}") for address in addresses]
+
+    def _dio_state(self, handle, name):
+        state = 0
+        for (h, reg), value in self.registers.items():
+            match = DIO_RE.match(reg)
+            if h == handle and match and match[1] + "_STATE" == name and value:
+                state |= 1 << int(match[2])
+        return state
+
     def eReadName(self, handle, name):
-        return random.randint(0, 32)
-    
+        if name == "CORE_TIMER":
+            return int(time.monotonic() * CORE_TIMER_HZ) & 0xFFFFFFFF
+        if name.endswith("_STATE"):
+            return self._dio_state(handle, name)
+        return self.registers.get((handle, name), 0)
+
+    def eReadNames(self, handle, numFrames, names):
+        self._check_plugged_in()
+        return [self.eReadName(handle, name) for name in names[:numFrames]]
+
     def eStreamRead(self, handle):
-        time.sleep(random.randint(3,10) / 50000)
-        return ([random.randint(0, 10) / 1000 for _ in range(14)], 0, 14)
-    
+        self._check_plugged_in()
+        if handle not in self.streams:
+            raise LJMError(2620, None, "STREAM_NOT_RUNNING")
+        return self.streams[handle].read()
+
     def eStreamStart(self, handle, scans, numAddresses, a, sample_rate):
+        self._check_plugged_in()
+        channels = self._channels(handle, list(a)[:numAddresses])
+        source = SimSource(self.config, channels, sample_rate, time.monotonic() - self.created)
+        self.streams[handle] = SimStream(source, scans, numAddresses, sample_rate, self._options())
         return sample_rate
-    
+
     def eStreamStop(self, handle):
-        return
-    
+        self.streams.pop(handle, None)
+
     def eWriteName(self, handle, driver, value):
-        return
-    
+        self.registers[(handle, driver)] = value
+
     def eWriteNames(self, handle, numFrames, reg_names, reg_values):
-        return
-    
+        self._check_plugged_in()
+        for name, value in zip(reg_names[:numFrames], reg_values[:numFrames]):
+            self.registers[(handle, name)] = value
+
     def openS(self, a, b, c):
-        return 0
-    
+        self._check_plugged_in()
+        with self.lock:
+            position = self._device_position(c)
+            handle = self.handles
+            self.handles += 1
+            self.device_index[handle] = position
+        return handle
+
     def namesToAddresses(self, num_channels, conf):
-        return ([], [])
-    
+        addresses, types = [], []
+        for name in conf[:num_channels]:
+            match = re.match(r"^AIN(\d+)$", name.upper())
+            # analog inputs are FLOAT32 at 2 * n, anything else is reported as a UINT16 DIO line
+            addresses.append(int(match[1]) * 2 if match else 2000)
+            types.append(3 if match else 0)
+        return (addresses, types)
+
     def close(self, handle):
-        return
-    
-    
\ No newline at end of file
+        self.streams.pop(handle, None)
+        self.device_index.pop(handle, None)
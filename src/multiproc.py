@@ -0,0 +1,484 @@
+"""
+Multi-process mode ([general] processes = multi). Acquisition, recording and the dashboard server each
+get a process of their own, so they run on separate cores and a crash in the web layer doesn't stop
+data capture:
+
+    acquisition  LJM handles, stream readers, safety monitor, valves, sequences, aux sensors, metrics
+    recorder     the main data file (aux sensor files are still written by acquisition)
+    server       websockets, telemetry and dashboard commands
+
+Scans go through shared memory rings (SharedScanRing), one per consumer. Control messages are small
+tuples on pipes- the recorder talks to acquisition directly, while everything between acquisition and
+the server is relayed by the supervising parent process, which restarts the server if it dies.
+Processes are forked, so they all start from the config the parent already loaded and validated.
+"""
+
+from multiprocessing import shared_memory, connection
+from configparser import ConfigParser
+from acquisition import BlockPool, ScanRingBuffer
+from aux_sensors import AuxSensors
+from data_to_dash import DataSender
+from devices import max_sample_rate
+from labjack_interface import LabjackInterface
+from metrics import MetricsServer
+from readiness import READINESS
+from logconfig import stop_logging
+from recorder import make_recorder, make_writer
+from runtime_config import RuntimeConfig
+import multiprocessing
+import numpy as np
+import itertools
+import logging
+import asyncio
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+# LabjackInterface methods the server may call in the acquisition process
+REMOTE_CALLS = {"actuate", "abort", "cancel_ignition", "proxima_ignition_sequence", "sphinx_ignition_sequence_short",
+                "apply_config", "tare"}
+SERVER_RESTART_SECS = 1.0
+
+class SharedScanRing(ScanRingBuffer):
+    """
+    ScanRingBuffer in a multiprocessing.shared_memory block, for one producer and one consumer process
+    forked after it was created. head, tail and overruns live in the shared block with the scans.
+    """
+    def __init__(self, capacity: int, num_channels: int):
+        self.capacity = capacity
+        self.num_channels = num_channels
+        self.shm = shared_memory.SharedMemory(create=True, size=8 * (3 + capacity * (1 + num_channels)))
+        self.counters = np.ndarray(3, dtype=np.int64, buffer=self.shm.buf)
+        self.index = np.ndarray(capacity, dtype=np.int64, buffer=self.shm.buf, offset=24)
+        self.buf = np.ndarray((capacity, num_channels), buffer=self.shm.buf, offset=8 * (3 + capacity))
+        self.counters[:] = 0
+
+    def _counter(i: int):
+        return property(lambda self: int(self.counters[i]), lambda self, value: self.counters.__setitem__(i, value))
+
+    head = _counter(0)
+    tail = _counter(1)
+    overruns = _counter(2)
+
+    def skip_to_head(self):
+        # a new consumer only wants scans from here on
+        self.tail = self.head
+
+    def unlink(self):
+        self.shm.unlink()
+
+def _send(conn: connection.Connection, message):
+    # the other end going away must never take this process down with it
+    try:
+        conn.send(message)
+    except (BrokenPipeError, EOFError, OSError):
+        pass
+
+def _child_signals(keep_sigterm: bool = False):
+    # Ctrl-C and systemd's SIGTERM reach the whole process group, the parent decides how everything shuts down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if not keep_sigterm:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+class TelemetryFeed():
+    """
+    Takes the DataSender's place in the acquisition process- calibrated scans go to the server's
+    ring and console messages to the parent, which relays them to the server.
+    """
+    def __init__(self, ring: SharedScanRing, conn: connection.Connection):
+        self.ring = ring
+        self.conn = conn
+
+    def push_samples(self, block: np.ndarray):
+        self.ring.push(block)
+
+    async def broadcast_message(self, message: str):
+        logger.info(f"Broadcasting message: '{message}'")
+        _send(self.conn, ("message", message))
+
+class RingWriter():
+    """
+    Takes the BackgroundWriter's place in the acquisition process- blocks are copied into the
+    recorder process's ring, which owns the file.
+    """
+    def __init__(self, ring: SharedScanRing, conn: connection.Connection, columns, meta, stem: str):
+        self.ring = ring
+        self.conn = conn
+        self.conn.send(("open", columns, meta, stem))
+        self.path = self.conn.recv()[1]
+        self.final_stats = None
+        self.dropping = False
+
+    def submit(self, block: np.ndarray, release=None):
+        overruns = self.ring.overruns
+        self.ring.push(block)
+        if release is not None:
+            release()
+        # logged when it starts and stops, a dead recorder process would otherwise log every block
+        if self.ring.overruns != overruns and not self.dropping:
+            self.dropping = True
+            logger.warning("Recorder ring full, dropping scans")
+        elif self.ring.overruns == overruns and self.dropping:
+            self.dropping = False
+            logger.warning(f"Recorder ring recovered, {self.ring.overruns} scans dropped so far")
+
+    def close(self, timeout: float = 10.0, meta=None):
+        _send(self.conn, ("close", meta))
+        try:
+            if self.conn.poll(timeout):
+                self.final_stats = self.conn.recv()[1]
+        except (EOFError, OSError):
+            logger.error("Recorder process went away before closing the file")
+
+    def stats(self):
+        if self.final_stats is not None:
+            return self.final_stats
+        return {"ring_fill": len(self.ring), "overruns": self.ring.overruns}
+
+class AcquisitionInterface(LabjackInterface):
+    def __init__(self, *args, record_ring: SharedScanRing = None, recorder_conn: connection.Connection = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.record_ring = record_ring
+        self.recorder_conn = recorder_conn
+
+    def _open_writer(self, cols, stem: str):
+        writer = RingWriter(self.record_ring, self.recorder_conn, cols, self._recording_meta(), stem)
+        logger.info(f"Created new file: {writer.path}")
+        READINESS.set("recorder", "ready", writer.path)
+        return writer
+
+def run_acquisition(config: ConfigParser, aux_sensors: AuxSensors, record_ring: SharedScanRing, live_ring: SharedScanRing,
+                    recorder_conn: connection.Connection, parent_conn: connection.Connection, unused):
+    _child_signals()
+    for conn in unused:
+        conn.close()
+    try:
+        asyncio.run(_acquire(config, aux_sensors, record_ring, live_ring, recorder_conn, parent_conn))
+    finally:
+        _send(recorder_conn, ("stop",))
+        # children leave through os._exit, which skips atexit
+        stop_logging()
+
+async def _acquire(config: ConfigParser, aux_sensors: AuxSensors, record_ring: SharedScanRing, live_ring: SharedScanRing,
+                   recorder_conn: connection.Connection, parent_conn: connection.Connection):
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    data_buf, valve_state_buf = [None], [None]
+    calls = set()
+    aux_sensors.start()
+    try:
+        async with MetricsServer(config):
+            async with AcquisitionInterface(config, TelemetryFeed(live_ring, parent_conn), data_buf, valve_state_buf, aux_sensors,
+                                            record_ring=record_ring, recorder_conn=recorder_conn) as ljm_int:
+                async def call(call_id, name, args):
+                    error, result = None, None
+                    try:
+                        result = await getattr(ljm_int, name)(*args)
+                    except Exception as e:
+                        error = str(e)
+                    _send(parent_conn, ("reply", call_id, error, result))
+
+                def on_message():
+                    try:
+                        while parent_conn.poll():
+                            message = parent_conn.recv()
+                            if message[0] == "stop" and not stop.done():
+                                stop.set_result(None)
+                            elif message[0] == "call" and message[2] in REMOTE_CALLS:
+                                # sequences take seconds, keep listening for a cancel meanwhile
+                                task = asyncio.create_task(call(*message[1:]))
+                                calls.add(task)
+                                task.add_done_callback(calls.discard)
+                    except (EOFError, OSError):
+                        loop.remove_reader(parent_conn.fileno())
+                        logger.critical("Lost the supervisor process, stopping acquisition")
+                        if not stop.done():
+                            stop.set_result(None)
+
+                loop.add_reader(parent_conn.fileno(), on_message)
+                delay = config["general"].getint("dash_send_delay_ms") / 1000
+                while not stop.done():
+                    # valve states and aux readings for the server's telemetry frames, and how far bring-up got for Status
+                    _send(parent_conn, ("status", valve_state_buf[0], {name: aux_sensors.latest(name) for name in aux_sensors.sensors},
+                                        READINESS.snapshot()))
+                    await asyncio.wait([stop], timeout=delay)
+                loop.remove_reader(parent_conn.fileno())
+                for task in list(calls):
+                    task.cancel()
+    finally:
+        aux_sensors.stop()
+
+def run_recorder(config: ConfigParser, ring: SharedScanRing, conn: connection.Connection, unused):
+    """
+    Writes what acquisition puts in `ring` through the usual recorder and BackgroundWriter.
+    """
+    _child_signals()
+    for other in unused:
+        other.close()
+    try:
+        _record(config, ring, conn)
+    finally:
+        stop_logging()
+
+def _record(config: ConfigParser, ring: SharedScanRing, conn: connection.Connection):
+    interval = 1 / int(config["general"]["reads_per_sec"])
+    pool = BlockPool(max_sample_rate(config), ring.num_channels)
+    indices = np.empty(pool.max_rows, dtype=np.int64)
+    writer = None
+
+    def drain():
+        drained = False
+        while len(ring) and writer is not None:
+            block = pool.acquire()
+            rows = ring.pop_into(block, indices)
+            writer.submit(block[:rows], release=lambda block=block: pool.release(block))
+            drained = True
+        return drained
+
+    while True:
+        try:
+            message = conn.recv() if conn.poll() else None
+        except (EOFError, OSError):
+            message = ("stop",)
+        if message is None:
+            if not drain():
+                time.sleep(interval)
+        elif message[0] == "open":
+            _, columns, meta, stem = message
+            recorder = make_recorder(config, columns, meta, stem=stem)
+            writer = make_writer(config, recorder)
+            ring.skip_to_head()
+            conn.send(("opened", recorder.path))
+        elif message[0] == "close" and writer is not None:
+            drain()
+            writer.close(meta=message[1])
+            _send(conn, ("closed", writer.stats()))
+            writer = None
+        elif message[0] == "stop":
+            if writer is not None:
+                drain()
+                writer.close()
+            return
+
+class RemoteAuxSensors():
+    """
+    Latest aux readings as last reported by the acquisition process, for the server's DataSender.
+    """
+    def __init__(self, names):
+        self.sensors = dict.fromkeys(names)
+        self.values = {}
+
+    def latest(self, name: str):
+        return self.values.get(name)
+
+class RemoteInterface():
+    """
+    Stands in for LabjackInterface in the server process- hardware commands are run by the
+    acquisition process and awaited here until it replies.
+    """
+    def __init__(self, conn: connection.Connection, data_sender: DataSender, valve_state_buf, aux_sensors: RemoteAuxSensors, on_lost):
+        self.conn = conn
+        self.data_sender = data_sender
+        self.valve_state_buf = valve_state_buf
+        self.aux_sensors = aux_sensors
+        self.on_lost = on_lost
+        self.ids = itertools.count()
+        self.pending = {}
+
+    async def _call(self, name: str, *args):
+        call_id = next(self.ids)
+        reply = asyncio.get_running_loop().create_future()
+        self.pending[call_id] = reply
+        _send(self.conn, ("call", call_id, name, args))
+        error, result = await reply
+        if error is not None:
+            raise Exception(error)
+        return result
+
+    async def actuate(self, driver: int, value: bool):
+        await self._call("actuate", driver, value)
+
+    async def abort(self):
+        await self._call("abort")
+
+    async def cancel_ignition(self):
+        await self._call("cancel_ignition")
+
+    async def proxima_ignition_sequence(self):
+        await self._call("proxima_ignition_sequence")
+
+    async def sphinx_ignition_sequence_short(self):
+        await self._call("sphinx_ignition_sequence_short")
+
+    async def apply_config(self, sections):
+        return await self._call("apply_config", sections)
+
+    async def tare(self, readings, target: float = 0.0):
+        return await self._call("tare", readings, target)
+
+    def on_message(self):
+        try:
+            while self.conn.poll():
+                message = self.conn.recv()
+                if message[0] == "reply":
+                    reply = self.pending.pop(message[1], None)
+                    if reply is not None and not reply.done():
+                        reply.set_result(message[2:])
+                elif message[0] == "message":
+                    asyncio.create_task(self.data_sender.broadcast_message(message[1]))
+                elif message[0] == "status":
+                    self.valve_state_buf[0] = message[1]
+                    self.aux_sensors.values = message[2]
+                    READINESS.merge(message[3])
+        except (EOFError, OSError):
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+            logger.critical("Lost the supervisor process, stopping the server")
+            self.on_lost()
+
+def run_server(config: ConfigParser, runtime: RuntimeConfig, live_ring: SharedScanRing, conn: connection.Connection, aux_names, unused):
+    # the server may stop whenever, SIGTERM closes its websockets
+    _child_signals(keep_sigterm=True)
+    for other in unused:
+        other.close()
+    try:
+        asyncio.run(_serve(config, runtime, live_ring, conn, aux_names))
+    finally:
+        stop_logging()
+
+async def _serve(config: ConfigParser, runtime: RuntimeConfig, live_ring: SharedScanRing, conn: connection.Connection, aux_names):
+    from cmd_from_dash import serve_dashboard
+    loop = asyncio.get_running_loop()
+    data_buf, valve_state_buf = [None], [None]
+    aux_sensors = RemoteAuxSensors(aux_names)
+    interval = 1 / int(config["general"]["reads_per_sec"])
+    out = np.empty((max_sample_rate(config), live_ring.num_channels))
+    indices = np.empty(out.shape[0], dtype=np.int64)
+    live_ring.skip_to_head()
+
+    async def drain_live():
+        while True:
+            rows = live_ring.pop_into(out, indices)
+            if rows:
+                data_sender.push_samples(out[:rows])
+                data_buf[0] = out[rows - 1, 1:].tolist()
+            if rows < out.shape[0]:
+                await asyncio.sleep(interval)
+
+    async with DataSender(config, data_buf, valve_state_buf, aux_sensors) as data_sender:
+        serving = asyncio.current_task()
+        remote = RemoteInterface(conn, data_sender, valve_state_buf, aux_sensors, serving.cancel)
+        loop.add_reader(conn.fileno(), remote.on_message)
+        draining = asyncio.create_task(drain_live())
+        try:
+            # a restarted server starts from the parent's runtime config, and its watcher catches up with any reload since
+            await serve_dashboard(config, data_sender, remote, runtime)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            draining.cancel()
+            loop.remove_reader(conn.fileno())
+
+class ProcessSupervisor():
+    """
+    Starts the three processes, relays messages between acquisition and the server, restarts the
+    server when it dies and shuts everything down in order on SIGTERM or Ctrl-C.
+    """
+    def __init__(self, config: ConfigParser, aux_sensors: AuxSensors, runtime: RuntimeConfig = None):
+        self.config = config
+        self.runtime = runtime
+        self.aux_sensors = aux_sensors
+        self.context = multiprocessing.get_context("fork")
+        num_channels = len(config["sensor_channel_mapping"])
+        # sized for the fastest rate profile
+        rows = max_sample_rate(config) * config["general"].getint("ring_buffer_secs", fallback=10)
+        # recorded rows carry time and the skipped flag, telemetry rows just time
+        self.record_ring = SharedScanRing(rows, num_channels + 2)
+        self.live_ring = SharedScanRing(rows, num_channels + 1)
+        self.stopping = False
+        self.server_restarts = 0
+        self.recording_down = False
+
+    def _start(self, target, name: str, *args):
+        process = self.context.Process(target=target, name=name, args=args, daemon=False)
+        process.start()
+        return process
+
+    def _start_server(self, acquisition_conn: connection.Connection):
+        parent_end, server_end = self.context.Pipe()
+        server = self._start(run_server, "server", self.config, self.runtime, self.live_ring, server_end,
+                             list(self.aux_sensors.sensors), [parent_end, acquisition_conn])
+        server_end.close()
+        return server, parent_end
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        recorder_end, acquisition_recorder_end = self.context.Pipe()
+        recorder = self._start(run_recorder, "recorder", self.config, self.record_ring, recorder_end, [acquisition_recorder_end])
+        acquisition_conn, acquisition_end = self.context.Pipe()
+        acquisition = self._start(run_acquisition, "acquisition", self.config, self.aux_sensors, self.record_ring, self.live_ring,
+                                  acquisition_recorder_end, acquisition_end, [recorder_end, acquisition_conn])
+        for conn in (recorder_end, acquisition_recorder_end, acquisition_end):
+            conn.close()
+        server, server_conn = self._start_server(acquisition_conn)
+        logger.info(f"Started acquisition (pid {acquisition.pid}), recorder (pid {recorder.pid}) and server (pid {server.pid})")
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        try:
+            while not self.stopping:
+                waiting = [acquisition_conn, server_conn, acquisition.sentinel, server.sentinel]
+                if not self.recording_down:
+                    waiting.append(recorder.sentinel)
+                ready = connection.wait(waiting, 0.5)
+                if acquisition.sentinel in ready:
+                    logger.critical(f"Acquisition process exited with code {acquisition.exitcode}, shutting down")
+                    break
+                if recorder.sentinel in ready:
+                    # reported once- its sentinel stays ready, so it's not waited on again
+                    recorder.join()
+                    self.recording_down = True
+                    logger.critical(f"Recorder process exited with code {recorder.exitcode}, data is no longer being recorded")
+                    _send(server_conn, ("message", "RECORDER DOWN- DATA IS NO LONGER BEING RECORDED"))
+                if acquisition_conn in ready:
+                    self._relay(acquisition_conn, server_conn)
+                if server_conn in ready:
+                    self._relay(server_conn, acquisition_conn)
+                if server.sentinel in ready and not self.stopping:
+                    # capture carries on, the dashboards just reconnect
+                    server.join()
+                    server_conn.close()
+                    self.server_restarts += 1
+                    logger.error(f"Server process exited with code {server.exitcode}, restarting it ({self.server_restarts} restarts)")
+                    time.sleep(SERVER_RESTART_SECS)
+                    server, server_conn = self._start_server(acquisition_conn)
+        finally:
+            self._shutdown(acquisition, acquisition_conn, recorder, server)
+
+    def _relay(self, source: connection.Connection, dest: connection.Connection):
+        try:
+            while source.poll():
+                message = source.recv()
+                if not dest.closed:
+                    _send(dest, message)
+        except (EOFError, OSError):
+            pass
+
+    def _shutdown(self, acquisition, acquisition_conn: connection.Connection, recorder, server):
+        logger.info("Stopping acquisition...")
+        _send(acquisition_conn, ("stop",))
+        acquisition.join(20)
+        if acquisition.is_alive():
+            logger.error("Acquisition did not stop, killing it")
+            acquisition.kill()
+        # the recorder stops once acquisition closes its file and hangs up
+        recorder.join(10)
+        if recorder.is_alive():
+            recorder.kill()
+        if server.is_alive():
+            server.terminate()
+            server.join(5)
+        self.record_ring.unlink()
+        self.live_ring.unlink()
+        logger.info("All processes stopped")
@@ -0,0 +1,72 @@
+"""
+Startup and health state of each subsystem, e.g. "dashboard", "labjack", "recorder", "aux:rtd_external".
+
+The dashboard server starts first and takes connections while the hardware comes up behind it, so
+"is it up" has a per-subsystem answer: starting, ready, reconnecting, failed or stopped. States are logged
+when they change, exported as subsystem_ready{subsystem=...} (1 when ready) and the seconds after start it
+took to get there, and reported by the websocket Status command.
+"""
+
+from metrics import REGISTRY
+from typing import Dict
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# set on first import, early in main's imports, so close enough to when the service started
+STARTED = time.monotonic()
+
+LOG_LEVELS = {"failed": logging.ERROR, "retrying": logging.WARNING, "reconnecting": logging.WARNING}
+
+class Readiness():
+    def __init__(self):
+        self.states: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+        self.first_connection = None
+
+    def set(self, subsystem: str, state: str, detail: str = None):
+        """
+        Record the state of `subsystem`. Safe from any thread.
+        """
+        with self.lock:
+            previous = self.states.get(subsystem, {})
+            if previous.get("state") == state and previous.get("detail") == detail:
+                return
+            since = time.monotonic() - STARTED
+            entry = {"state": state, "since": round(since, 3)}
+            if detail is not None:
+                entry["detail"] = detail
+            first_ready = state == "ready" and previous.get("ready_after") is None
+            ready_after = entry["since"] if first_ready else previous.get("ready_after")
+            if ready_after is not None:
+                entry["ready_after"] = ready_after
+            self.states[subsystem] = entry
+        REGISTRY.gauge("subsystem_ready", "1 while a subsystem is ready", {"subsystem": subsystem}).set(int(state == "ready"))
+        if first_ready:
+            REGISTRY.gauge("subsystem_ready_seconds", "Seconds after start a subsystem first became ready",
+                           {"subsystem": subsystem}).set(since)
+        message = f"{subsystem} {state} after {since:.2f} s" + (f": {detail}" if detail else "")
+        logger.log(LOG_LEVELS.get(state, logging.INFO), message)
+
+    def merge(self, states: Dict[str, Dict]):
+        # states reported by another process, see multiproc.py
+        with self.lock:
+            self.states.update(states)
+
+    def connected(self):
+        """
+        Call on every dashboard connection- the first one is timed from start.
+        """
+        if self.first_connection is not None:
+            return
+        self.first_connection = time.monotonic() - STARTED
+        REGISTRY.gauge("first_connection_seconds", "Seconds after start the first dashboard connected").set(self.first_connection)
+        logger.info(f"First dashboard connection {self.first_connection:.2f} s after start")
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self.lock:
+            return {name: dict(entry) for name, entry in self.states.items()}
+
+READINESS = Readiness()
@@ -0,0 +1,365 @@
+"""
+Data file backends for LabjackInterface.
+
+CsvRecorder writes the classic one-row-per-scan text file. BinaryRecorder appends fixed-width
+records to a preallocated, memory-mapped file, which avoids formatting every float on the Pi.
+Binary recordings can be converted after the test with:
+
+    python recorder.py export ../data/<recording>.ljr [out.csv]
+"""
+
+from configparser import ConfigParser
+from metrics import REGISTRY
+from readiness import READINESS
+import numpy as np
+import datetime as dt
+import threading
+import logging
+import queue
+import time
+import json
+import csv
+import sys
+import os
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"LJREC001"
+# magic, data offset (uint64), rows written (uint64), header length (uint64), then the JSON header
+PREAMBLE_SIZE = 32
+PAGE_SIZE = 4096
+# room left after the header so it can be rewritten with end-of-recording stats
+HEADER_SLACK = 1024
+
+class CsvRecorder():
+    extension = "csv"
+
+    def __init__(self, path: str, columns, meta=None):
+        self.path = path
+        self.columns = list(columns)
+        self.fd = open(path, "x", newline="")
+        self.writer = csv.writer(self.fd)
+        self.writer.writerow(self.columns)
+        self.rows = 0
+
+    def write(self, block: np.ndarray):
+        self.writer.writerows(block)
+        self.rows += block.shape[0]
+
+    def update_meta(self, meta):
+        # the CSV header is just the column names, per-scan flags live in their own column
+        pass
+
+    def flush(self):
+        self.fd.flush()
+
+    def sync(self):
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+
+    def close(self):
+        self.fd.close()
+
+class BinaryRecorder():
+    """
+    Records of (time float64, channels <dtype>) appended to a memory-mapped file that grows in
+    chunks of `chunk_rows`. The JSON header describes the columns and the calibration used.
+    """
+    extension = "ljr"
+
+    def __init__(self, path: str, columns, meta=None, dtype: str = "float32", chunk_rows: int = 18000):
+        self.path = path
+        self.columns = list(columns)
+        self.dtype = np.dtype([(self.columns[0], "<f8")] + [(col, np.dtype(dtype).newbyteorder("<")) for col in self.columns[1:]])
+        self.chunk_rows = chunk_rows
+        self.header = dict(meta or {})
+        self.header.update({
+            "columns": self.columns,
+            "dtype": self.dtype.descr,
+        })
+        header_bytes = json.dumps(self.header).encode()
+        self.data_offset = -(-(PREAMBLE_SIZE + len(header_bytes) + HEADER_SLACK) // PAGE_SIZE) * PAGE_SIZE
+        with open(path, "xb") as fd:
+            fd.write(MAGIC)
+            fd.write(np.array([self.data_offset, 0, len(header_bytes)], dtype="<u8").tobytes())
+            fd.write(header_bytes)
+        self.rows_field = np.memmap(path, dtype="<u8", mode="r+", offset=len(MAGIC) + 8, shape=(1,))
+        self.rows = 0
+        self.capacity = 0
+        self.records = None
+        self._grow()
+
+    def _grow(self):
+        if self.records is not None:
+            self.records.flush()
+        self.capacity += self.chunk_rows
+        with open(self.path, "r+b") as fd:
+            fd.truncate(self.data_offset + self.capacity * self.dtype.itemsize)
+        self.records = np.memmap(self.path, dtype=self.dtype, mode="r+", offset=self.data_offset, shape=(self.capacity,))
+
+    def write(self, block: np.ndarray):
+        n = block.shape[0]
+        while self.rows + n > self.capacity:
+            self._grow()
+        dest = self.records[self.rows:self.rows + n]
+        for i, name in enumerate(self.dtype.names):
+            dest[name] = block[:, i]
+        self.rows += n
+        self.rows_field[0] = self.rows
+
+    def update_meta(self, meta):
+        """
+        Merge `meta` into the JSON header, if it still fits in front of the data.
+        """
+        header = dict(self.header, **meta)
+        header_bytes = json.dumps(header).encode()
+        if PREAMBLE_SIZE + len(header_bytes) > self.data_offset:
+            logger.warning(f"Header of {self.path} has no room for {list(meta)}, not updated")
+            return
+        with open(self.path, "r+b") as fd:
+            fd.seek(PREAMBLE_SIZE)
+            fd.write(header_bytes)
+            fd.seek(len(MAGIC) + 16)
+            fd.write(np.array([len(header_bytes)], dtype="<u8").tobytes())
+        self.header = header
+
+    def flush(self):
+        self.records.flush()
+        self.rows_field.flush()
+
+    def sync(self):
+        # memmap.flush() is an msync, so flushing is already durable
+        self.flush()
+
+    def close(self):
+        self.flush()
+        del self.records
+        del self.rows_field
+        with open(self.path, "r+b") as fd:
+            fd.truncate(self.data_offset + self.rows * self.dtype.itemsize)
+
+RECORDERS = {
+    "csv": CsvRecorder,
+    "binary": BinaryRecorder,
+}
+
+def make_recorder(config: ConfigParser, columns, meta=None, directory: str = "../data", stem: str = None):
+    fmt = config.get("recording", "format", fallback="csv")
+    if fmt not in RECORDERS:
+        raise Exception(f"Unknown recording format '{fmt}', expected one of {list(RECORDERS)}")
+    recorder_cls = RECORDERS[fmt]
+    stem = stem or dt.datetime.now().strftime('%m_%d_%Y_%H:%M:%S')
+    path = os.path.join(directory, f"{stem}.{recorder_cls.extension}")
+    if recorder_cls is BinaryRecorder:
+        sample_rate = int(config["general"]["sample_rate"])
+        chunk_secs = config.getint("recording", "chunk_secs", fallback=60)
+        return BinaryRecorder(path, columns, meta,
+                              dtype=config.get("recording", "binary_dtype", fallback="float32"),
+                              chunk_rows=sample_rate * chunk_secs)
+    return recorder_cls(path, columns, meta)
+
+class BackgroundWriter(threading.Thread):
+    """
+    Writes submitted blocks to a recorder on its own thread, fed through a bounded queue.
+    The recorder is flushed every `flush_blocks` blocks or `flush_secs` seconds and fsynced every
+    `fsync_secs`. Once the queue passes its high-water mark the backpressure policy kicks in:
+    'decimate' keeps every `decimation`th row, 'drop' discards whole blocks and 'block' stalls the caller.
+    """
+    def __init__(self, recorder, max_blocks: int = 256, high_water: float = 0.75, flush_blocks: int = 30,
+                 flush_secs: float = 0.5, fsync_secs: float = 2.0, policy: str = "decimate", decimation: int = 10):
+        super().__init__(name=f"recorder-{os.path.basename(recorder.path)}", daemon=True)
+        if policy not in ("decimate", "drop", "block"):
+            raise Exception(f"Unknown backpressure policy '{policy}'")
+        self.recorder = recorder
+        self.queue = queue.Queue(max_blocks)
+        self.high_water = max(1, int(max_blocks * high_water))
+        self.flush_blocks = flush_blocks
+        self.flush_secs = flush_secs
+        self.fsync_secs = fsync_secs
+        self.policy = policy
+        self.decimation = decimation
+        self.backpressure = False
+        self.max_queue_depth = 0
+        self.blocks_written = 0
+        self.rows_written = 0
+        self.decimated_rows = 0
+        self.dropped_rows = 0
+        self.fsyncs = 0
+        self.last_write_latency = 0.0
+        self.max_write_latency = 0.0
+        self.total_write_latency = 0.0
+        self.final_meta = None
+        self.write_failures = 0 # consecutive, reset by the next successful write
+        self.failed_rows = 0
+        labels = {"file": os.path.basename(recorder.path)}
+        self.write_time = REGISTRY.histogram("recorder_write_seconds", "Time to write one block to the data file", labels)
+        self.queue_depth = REGISTRY.gauge("recorder_queue_blocks", "Blocks waiting for the recorder thread", labels)
+        self.write_errors = REGISTRY.counter("recorder_write_errors", "Failed writes, flushes and syncs of the data file", labels)
+
+    def submit(self, block: np.ndarray, release=None):
+        """
+        Queue a block for writing. The writer keeps a reference, so the caller must not modify it afterwards.
+        `release` is called once the writer is done with the block (written, decimated away or dropped),
+        so a pooled buffer can be reused.
+        """
+        depth = self.queue.qsize()
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+        if depth >= self.high_water:
+            if not self.backpressure:
+                self.backpressure = True
+                logger.warning(f"Recorder queue at {depth}/{self.queue.maxsize} blocks, applying '{self.policy}' backpressure")
+            if self.policy == "drop":
+                self.dropped_rows += block.shape[0]
+                if release is not None:
+                    release()
+                return
+            if self.policy == "decimate":
+                self.decimated_rows += block.shape[0] - len(range(0, block.shape[0], self.decimation))
+                block = block[::self.decimation]
+        elif self.backpressure and depth < self.high_water // 2:
+            self.backpressure = False
+            logger.warning(f"Recorder queue recovered, {self.decimated_rows} rows decimated and {self.dropped_rows} dropped so far")
+        if self.policy == "block":
+            self.queue.put((block, release))
+            return
+        try:
+            self.queue.put_nowait((block, release))
+        except queue.Full:
+            self.dropped_rows += block.shape[0]
+            if release is not None:
+                release()
+
+    def run(self):
+        pending = 0
+        last_flush = last_sync = time.monotonic()
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_secs)
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item is not False:
+                block, release = item
+                start = time.perf_counter()
+                try:
+                    self.recorder.write(block)
+                except Exception as e:
+                    # e.g. a full or failing SD card- keep draining, so submit() never waits on a dead thread
+                    self._write_failed(e, block.shape[0])
+                    continue
+                finally:
+                    if release is not None:
+                        release()
+                if self.write_failures:
+                    logger.warning(f"Recording to {self.recorder.path} recovered after {self.write_failures} failed writes")
+                    READINESS.set("recorder", "ready", self.recorder.path)
+                    self.write_failures = 0
+                latency = time.perf_counter() - start
+                self.write_time.observe(latency)
+                self.queue_depth.set(self.queue.qsize())
+                self.last_write_latency = latency
+                self.max_write_latency = max(self.max_write_latency, latency)
+                self.total_write_latency += latency
+                self.blocks_written += 1
+                self.rows_written += block.shape[0]
+                pending += 1
+            now = time.monotonic()
+            try:
+                if now - last_sync >= self.fsync_secs:
+                    last_flush = last_sync = now
+                    pending = 0
+                    self.recorder.sync()
+                    self.fsyncs += 1
+                elif pending and (pending >= self.flush_blocks or now - last_flush >= self.flush_secs):
+                    last_flush = now
+                    pending = 0
+                    self.recorder.flush()
+            except Exception as e:
+                self._write_failed(e, 0)
+        try:
+            if self.final_meta:
+                self.recorder.update_meta(self.final_meta)
+            self.recorder.sync()
+            self.recorder.close()
+        except Exception as e:
+            logger.error(f"Closing {self.recorder.path} failed: {e}")
+
+    def _write_failed(self, error: Exception, rows: int):
+        self.write_errors.inc()
+        self.failed_rows += rows
+        if self.write_failures == 0:
+            logger.error(f"Writing to {self.recorder.path} failed, data is not being recorded: {error}")
+            # shows up in the dashboard's Status
+            READINESS.set("recorder", "failed", f"{self.recorder.path}: {error}")
+        self.write_failures += 1
+
+    def close(self, timeout: float = 10.0, meta=None):
+        """
+        Write out everything queued and close the recorder, first adding `meta` to its header.
+        """
+        self.final_meta = meta
+        self.queue.put(None)
+        self.join(timeout)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "blocks_written": self.blocks_written,
+            "rows_written": self.rows_written,
+            "decimated_rows": self.decimated_rows,
+            "dropped_rows": self.dropped_rows,
+            "failed_rows": self.failed_rows,
+            "fsyncs": self.fsyncs,
+            "last_write_latency_ms": self.last_write_latency * 1000,
+            "max_write_latency_ms": self.max_write_latency * 1000,
+            "mean_write_latency_ms": self.total_write_latency * 1000 / max(1, self.blocks_written),
+        }
+
+def make_writer(config: ConfigParser, recorder):
+    writer = BackgroundWriter(
+        recorder,
+        max_blocks=config.getint("recording", "queue_blocks", fallback=256),
+        high_water=config.getfloat("recording", "high_water", fallback=0.75),
+        flush_blocks=config.getint("recording", "flush_blocks", fallback=30),
+        flush_secs=config.getfloat("recording", "flush_secs", fallback=0.5),
+        fsync_secs=config.getfloat("recording", "fsync_secs", fallback=2.0),
+        policy=config.get("recording", "backpressure", fallback="decimate"),
+        decimation=config.getint("recording", "decimation", fallback=10),
+    )
+    writer.start()
+    return writer
+
+def read_recording(path: str):
+    """
+    Returns (header, records) for a binary recording- records is a read-only memmap structured array.
+    """
+    with open(path, "rb") as fd:
+        if fd.read(len(MAGIC)) != MAGIC:
+            raise Exception(f"{path} is not a labjack binary recording")
+        data_offset, rows, header_len = np.frombuffer(fd.read(24), dtype="<u8")
+        header = json.loads(fd.read(int(header_len)))
+    dtype = np.dtype([tuple(field) for field in header["dtype"]])
+    records = np.memmap(path, dtype=dtype, mode="r", offset=int(data_offset), shape=(int(rows),)) if rows else np.empty(0, dtype)
+    return header, records
+
+def export_csv(path: str, out_path: str = None, chunk_rows: int = 100000):
+    header, records = read_recording(path)
+    out_path = out_path or os.path.splitext(path)[0] + ".csv"
+    names = records.dtype.names
+    with open(out_path, "x", newline="") as fd:
+        writer = csv.writer(fd)
+        writer.writerow(header["columns"])
+        for start in range(0, records.shape[0], chunk_rows):
+            chunk = records[start:start + chunk_rows]
+            # numpy scalars format with their shortest round-trip repr, so float32 columns stay tidy
+            writer.writerows(zip(*(chunk[name] for name in names)))
+    logger.info(f"Exported {records.shape[0]} rows to {out_path}")
+    return out_path
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "export":
+        print("usage: python recorder.py export <recording.ljr> [out.csv]")
+        sys.exit(1)
+    print(export_csv(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None))
@@ -0,0 +1,145 @@
+"""
+Abort rules, compiled once at startup into NumPy predicates over (rows, channels) scan blocks.
+
+Each rule in [abort_rules] is `name = <condition> [for N samples]`, where a condition is comparisons
+joined by `and`/`or` (`and` binds tighter):
+    chamber_overpressure = pres_1 > 1100 for 3 samples
+    injector_spike       = rate(pres_3) > 20000 psi/s
+    hot_feed             = thermo_2 > 300 and driver 5 open
+`rate(x)` is the per-scan derivative in units per second, `driver N open|closed` tests a valve state,
+and a word after the number (like a unit) is ignored- unless it's a dangling and/or. Evaluating a
+block costs a handful of array operations per rule, never per-sample Python work.
+"""
+
+from configparser import ConfigParser
+from calibration import Calibration
+from typing import Dict, List
+import numpy as np
+import re
+
+RULE_RE = re.compile(r"^(?P<cond>.*?)(?:\s+for\s+(?P<samples>\d+)\s+samples?)?\s*$")
+DRIVER_RE = re.compile(r"^driver\s+(?P<driver>\w+)\s+(?P<state>open|closed)$")
+COMPARE_RE = re.compile(r"^(?:rate\(\s*(?P<rate>\w+)\s*\)|(?P<chan>\w+))\s*(?P<op>>=|<=|>|<)\s*(?P<value>-?\d+(?:\.\d*)?(?:e-?\d+)?)(?:\s+(?!(?:and|or)$)\S+)?$")
+OPERATORS = {">": np.greater, ">=": np.greater_equal, "<": np.less, "<=": np.less_equal}
+
+def consecutive(mask: np.ndarray, carry: int) -> np.ndarray:
+    """
+    Length of the run of True ending at each row, with `carry` True rows assumed before the block.
+    """
+    idx = np.arange(mask.shape[0])
+    last_false = np.maximum.accumulate(np.where(mask, -1, idx))
+    run = idx - last_false
+    run[last_false < 0] += carry
+    return run
+
+class BlockContext():
+    """
+    Lazily calibrated view of one raw block, shared by every rule evaluated on it.
+    """
+    def __init__(self, block: np.ndarray, calibration: Calibration, sample_rate: float, previous: Dict[int, float], states):
+        self.block = block
+        self.calibration = calibration
+        self.sample_rate = sample_rate
+        self.previous = previous
+        self.states = states
+        self.cache = {}
+
+    def values(self, index: int) -> np.ndarray:
+        if index not in self.cache:
+            self.cache[index] = self.calibration.convert(self.block[:, index], index)
+        return self.cache[index]
+
+    def rate(self, index: int) -> np.ndarray:
+        values = self.values(index)
+        # the first scan is differenced against the last scan of the previous block
+        return np.diff(values, prepend=self.previous.get(index, np.nan)) * self.sample_rate
+
+    def driver(self, driver: int) -> bool:
+        return bool(self.states is not None and driver < len(self.states) and self.states[driver])
+
+class Rule():
+    def __init__(self, name: str, text: str, calibration: Calibration):
+        self.name = name
+        self.text = text
+        match = RULE_RE.match(text.strip())
+        self.samples = int(match["samples"] or 1)
+        self.channels = set()
+        # OR of AND groups of compiled terms
+        self.groups = [[self._compile_term(term.strip(), calibration) for term in re.split(r"\s+and\s+", group)]
+                       for group in re.split(r"\s+or\s+", match["cond"])]
+        self.strikes = 0
+        self.armed = True
+        self.trips = 0
+
+    def _compile_term(self, term: str, calibration: Calibration):
+        match = DRIVER_RE.match(term)
+        if match:
+            driver, want_open = int(match["driver"]), match["state"] == "open"
+            return lambda ctx: ctx.driver(driver) == want_open
+        match = COMPARE_RE.match(term)
+        if not match:
+            raise Exception(f"Can't parse abort rule '{self.name}': '{term}'")
+        chan = match["rate"] or match["chan"]
+        if chan not in calibration.channels:
+            raise Exception(f"Abort rule '{self.name}' uses unknown sensor '{chan}'")
+        index = calibration.channels.index(chan)
+        self.channels.add(index)
+        op, limit = OPERATORS[match["op"]], float(match["value"])
+        if match["rate"]:
+            return lambda ctx: op(ctx.rate(index), limit)
+        return lambda ctx: op(ctx.values(index), limit)
+
+    def evaluate(self, ctx: BlockContext) -> np.ndarray:
+        rows = ctx.block.shape[0]
+        result = np.zeros(rows, dtype=bool)
+        for group in self.groups:
+            group_mask = np.ones(rows, dtype=bool)
+            for term in group:
+                group_mask &= term(ctx)
+            result |= group_mask
+        return result
+
+class RuleSet():
+    def __init__(self, rules: List[Rule], calibration: Calibration, sample_rate: float):
+        self.rules = rules
+        self.calibration = calibration
+        self.sample_rate = sample_rate
+        self.previous = {}
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, calibration: Calibration, sample_rate: float):
+        rules = []
+        legacy = "proxima_emergency_shutdown"
+        if config.has_section(legacy) and "sensor_name" in config[legacy]:
+            text = (f"{config[legacy]['sensor_name']} > {config[legacy]['max_pressure']} "
+                    f"for {config[legacy].getint('strikes', fallback=3)} samples")
+            rules.append(Rule("max_pressure", text, calibration))
+        if config.has_section("abort_rules"):
+            for name, text in config["abort_rules"].items():
+                rules.append(Rule(name, text, calibration))
+        return cls(rules, calibration, sample_rate)
+
+    def evaluate(self, block: np.ndarray, states=None):
+        """
+        Returns [(rule, row)] for every rule that newly tripped in this block, with the first offending row.
+        """
+        ctx = BlockContext(block, self.calibration, self.sample_rate, self.previous, states)
+        tripped = []
+        for rule in self.rules:
+            mask = rule.evaluate(ctx)
+            if not mask.any():
+                rule.strikes = 0
+                rule.armed = True
+                continue
+            run = consecutive(mask, rule.strikes)
+            hits = np.flatnonzero(run >= rule.samples)
+            if hits.size and rule.armed:
+                rule.armed = False
+                rule.trips += 1
+                tripped.append((rule, int(hits[0])))
+            rule.strikes = int(run[-1])
+            if not mask[-1]:
+                rule.armed = True
+        for index in ctx.cache:
+            self.previous[index] = ctx.cache[index][-1]
+        return tripped
@@ -0,0 +1,123 @@
+"""
+Settings that can change while the stream runs.
+
+RuntimeConfig compiles config.ini once into typed attributes and a Calibration,
+so nothing per-command or per-block goes back to string-keyed ConfigParser lookups. It is never modified,
+only replaced as a whole- whoever holds a reference sees either the old settings or the new ones.
+A ConfigWatcher (or the ReloadConfig command) loads a new one when config.ini changes; calibration, abort
+rules, sequences, telemetry rates, logging and the password take effect between blocks without stopping the
+stream. Changes to anything else, like the channel table, rates or recording, need a restart and are only reported.
+"""
+
+from configparser import ConfigParser
+from calibration import Calibration
+from devices import merge_device_channels
+from typing import Dict, List
+import logging
+import asyncio
+import os
+
+logger = logging.getLogger(__name__)
+
+# sections applied live, sequence_* sections are as well
+LIVE_SECTIONS = {"conversion", "nonlinear_calibration", "abort_rules", "proxima_emergency_shutdown", "logging"}
+LIVE_GENERAL = {"password", "dash_send_delay_ms", "dash_max_send_delay_ms", "dash_keyframe_every", "dash_max_window_points"}
+CALIBRATION_SECTIONS = {"conversion", "nonlinear_calibration"}
+RULE_SECTIONS = {"abort_rules", "proxima_emergency_shutdown"}
+
+def file_mtimes(files: List[str]):
+    mtimes = []
+    for path in files:
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+def _is_live(section: str) -> bool:
+    return section in LIVE_SECTIONS or section.startswith("sequence_")
+
+class RuntimeConfig():
+    def __init__(self, config: ConfigParser, files: List[str] = (), mtimes=None):
+        self.config = config
+        # where it was loaded from, and when those files were last modified
+        self.files = list(files)
+        self.mtimes = file_mtimes(self.files) if mtimes is None else mtimes
+        general = config["general"]
+        self.password = general["password"]
+        self.driver_names = {int(driver): name for driver, name in config["driver_mapping"].items()}
+        self.send_delay = general.getint("dash_send_delay_ms") / 1000
+        self.max_send_delay = general.getint("dash_max_send_delay_ms", fallback=5000) / 1000
+        self.keyframe_every = general.getint("dash_keyframe_every", fallback=20)
+        self.max_window_points = general.getint("dash_max_window_points", fallback=1000)
+        self.channels = list(config["sensor_channel_mapping"].keys())
+        self.calibration = Calibration.from_config(config)
+        self.sections = {name: dict(config[name]) for name in config.sections()}
+
+    @classmethod
+    def load(cls, files: List[str]):
+        mtimes = file_mtimes(files)
+        config = ConfigParser()
+        files = config.read(files)
+        if not files:
+            raise Exception("Can't read the config file")
+        merge_device_channels(config)
+        return cls(config, files, mtimes)
+
+    @classmethod
+    def from_sections(cls, sections: Dict[str, Dict[str, str]]):
+        # what the server process sends the acquisition process, since compiled calibrations don't pickle
+        config = ConfigParser()
+        config.read_dict(sections)
+        return cls(config)
+
+    def changes(self, new: "RuntimeConfig"):
+        """
+        Returns (live, restart)- the names of the changed sections (and [general] keys) that are applied
+        live, and of the ones that need a restart.
+        """
+        live, restart = set(), set()
+        for name in set(self.sections) | set(new.sections):
+            old_items, new_items = self.sections.get(name, {}), new.sections.get(name, {})
+            if name == "general":
+                for key in set(old_items) | set(new_items):
+                    if old_items.get(key) != new_items.get(key):
+                        (live if key in LIVE_GENERAL else restart).add(f"general.{key}")
+            elif old_items != new_items:
+                (live if _is_live(name) else restart).add(name)
+        return sorted(live), sorted(restart)
+
+class ConfigWatcher():
+    """
+    Calls `on_change()` whenever one of `files` gets a modification time other than `mtimes`, checking
+    every `interval` seconds.
+    """
+    def __init__(self, files: List[str], mtimes, on_change, interval: float = 2.0):
+        self.files = list(files)
+        self.mtimes = mtimes
+        self.on_change = on_change
+        self.interval = interval
+        self.task = None
+
+    async def __aenter__(self):
+        if self.files and self.interval > 0:
+            self.task = asyncio.create_task(self._run())
+            logger.info(f"Watching {', '.join(self.files)} for changes")
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if file_mtimes(self.files) == self.mtimes:
+                continue
+            # editors often write in several steps, let the file settle first
+            await asyncio.sleep(min(self.interval, 0.5))
+            self.mtimes = file_mtimes(self.files)
+            try:
+                await self.on_change()
+            except Exception as e:
+                logger.error(f"Config reload failed: {e}")
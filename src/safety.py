@@ -0,0 +1,92 @@
+from configparser import ConfigParser
+from calibration import Calibration
+from rules import RuleSet
+from valve_io import ValveIO
+import numpy as np
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class SafetyMonitor():
+    """
+    Emergency shutdown check run by the StreamReader thread on every raw scan block, so it never
+    waits on the event loop. Every abort rule (see rules.py) is evaluated over the whole block, and the
+    first one to trip writes the shutdown valve configured in [proxima_emergency_shutdown].
+    Reaction time is measured from the estimated sample time of the offending scan to the valve write.
+    """
+    def __init__(self, config: ConfigParser, calibration: Calibration, valve_io: ValveIO, sample_rate: int, notify=None):
+        self.valve_io = valve_io
+        self.sample_rate = sample_rate
+        self.notify = notify
+        self.trips = 0
+        self.last_reaction_time = None
+        self.max_reaction_time = 0.0
+        self.enabled = False
+        self.rules = None
+        self.configure(config, calibration)
+
+    def configure(self, config: ConfigParser, calibration: Calibration):
+        """
+        (Re)compile the rules, e.g. after a calibration change. Safe while the stream runs- the reader
+        thread picks up the new rule set on its next block.
+        """
+        section = "proxima_emergency_shutdown"
+        if not (config.has_section(section) and config[section].getboolean("enabled", fallback=True)):
+            self.enabled = False
+            logger.warning("Emergency shutdown monitor disabled")
+            return
+        rules = RuleSet.from_config(config, calibration, self.sample_rate)
+        self.valve = int(config[section]["shutdown_valve"])
+        self.shutdown_state = config[section].getint("shutdown_state", fallback=0)
+        # rules before enabled, check() may run in between
+        self.rules = rules
+        self.enabled = True
+        for rule in rules.rules:
+            logger.info(f"Abort rule {rule.name}: {rule.text}")
+
+    def set_sample_rate(self, sample_rate: float):
+        """
+        Called by the stream reader between blocks after restarting the stream at another rate.
+        """
+        self.sample_rate = sample_rate
+        rules = self.rules
+        if rules is not None:
+            rules.sample_rate = sample_rate
+            # a rate() over the restart would divide by the wrong interval
+            rules.previous.clear()
+
+    def check(self, block: np.ndarray, read_time: float, backlog: int = 0):
+        """
+        `block` is a (rows, channels) array of raw voltages that eStreamRead returned at `read_time`
+        (monotonic), with `backlog` scans still queued behind it.
+        """
+        if not self.enabled or block.shape[0] == 0:
+            return
+        # last known driver states, the monitor never waits on a fresh read
+        tripped = self.rules.evaluate(block, self.valve_io.states)
+        if tripped:
+            self._trip(block, tripped, read_time, backlog)
+
+    def _trip(self, block: np.ndarray, tripped, read_time: float, backlog: int):
+        self.valve_io.write({self.valve: self.shutdown_state})
+        done = time.monotonic()
+        row = min(row for _, row in tripped)
+        sample_time = read_time - (block.shape[0] - 1 - row + backlog) / self.sample_rate
+        self.last_reaction_time = float(done - sample_time)
+        self.max_reaction_time = max(self.max_reaction_time, self.last_reaction_time)
+        self.trips += 1
+        names = ", ".join(f"{rule.name} ({rule.text})" for rule, _ in tripped)
+        message = f"Emergency shutdown executed! Tripped {names}, reaction time {self.last_reaction_time * 1000:.1f} ms"
+        logger.critical(message)
+        if self.notify is not None:
+            self.notify(message)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "trips": self.trips,
+            "rule_trips": {rule.name: rule.trips for rule in self.rules.rules} if self.enabled else {},
+            "last_reaction_time_ms": None if self.last_reaction_time is None else self.last_reaction_time * 1000,
+            "max_reaction_time_ms": self.max_reaction_time * 1000,
+        }
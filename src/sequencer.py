@@ -0,0 +1,172 @@
+"""
+Data-driven ignition sequences, run on their own high-priority thread with absolute deadlines.
+
+A sequence lives in a [sequence_<name>] section. `steps` holds one step per line as
+`<seconds from start> <action> ...`, where the action is one of
+    open <driver ids>                     close <driver ids>
+    message <text>                        countdown <from> <to> <text with {n}>
+`countdown` expands to one message per second. Valve steps that share a time are written in one
+transaction. `abort` lists the drivers closed immediately if the sequence is canceled.
+"""
+
+from configparser import ConfigParser
+from valve_io import ValveIO
+from typing import Dict, List
+import threading
+import logging
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+# the thread sleeps until this close to a deadline, then spins
+SPIN_SECS = 0.002
+
+class SequenceStep():
+    def __init__(self, at: float, action: str, args: List[str]):
+        self.at = at
+        self.action = action
+        self.args = args
+
+class Sequence():
+    def __init__(self, name: str, steps: List[SequenceStep], abort: List[int]):
+        self.name = name
+        self.steps = sorted(steps, key=lambda step: step.at)
+        self.abort = abort
+
+    @classmethod
+    def from_config(cls, name: str, section, driver_mapping):
+        steps = []
+        for line in section["steps"].strip().splitlines():
+            at, action, *args = line.split(maxsplit=2) + [""]
+            at = float(at)
+            args = args[0].split() if action in ("open", "close", "countdown") else [args[0]]
+            if action == "countdown":
+                start, stop, text = int(args[0]), int(args[1]), " ".join(args[2:])
+                step = -1 if stop < start else 1
+                for i, n in enumerate(range(start, stop + step, step)):
+                    steps.append(SequenceStep(at + i, "message", [text.format(n=n)]))
+                continue
+            if action in ("open", "close"):
+                for driver in args:
+                    if driver not in driver_mapping:
+                        raise Exception(f"Sequence {name} uses driver {driver}, which is not in [driver_mapping]")
+            elif action != "message":
+                raise Exception(f"Sequence {name}: unknown action '{action}'")
+            steps.append(SequenceStep(at, action, args))
+        abort = [int(driver) for driver in section.get("abort", "").split()]
+        for driver in abort:
+            if str(driver) not in driver_mapping:
+                raise Exception(f"Sequence {name} aborts driver {driver}, which is not in [driver_mapping]")
+        return cls(name, steps, abort)
+
+def load_sequences(config: ConfigParser) -> Dict[str, Sequence]:
+    sequences = {}
+    for section in config.sections():
+        if not section.startswith("sequence_"):
+            continue
+        name = section[len("sequence_"):]
+        try:
+            sequences[name] = Sequence.from_config(name, config[section], config["driver_mapping"])
+        except Exception as e:
+            logger.error(f"Sequence {name} is unavailable: {e}")
+    return sequences
+
+class SequenceRunner(threading.Thread):
+    """
+    Executes one Sequence against ValveIO. Each group of steps waits for its absolute deadline
+    (sequence start + step time), so delays never accumulate, and cancellation is checked while waiting.
+    The commanded vs actual time of every valve write is kept in `timing`.
+    """
+    def __init__(self, sequence: Sequence, valve_io: ValveIO, notify=None, priority: int = 0):
+        super().__init__(name=f"sequence-{sequence.name}", daemon=True)
+        self.sequence = sequence
+        self.valve_io = valve_io
+        self.notify = notify or (lambda message: None)
+        self.priority = priority
+        self.canceled = threading.Event()
+        self.timing = [] # (commanded s, actual s, writes)
+
+    def cancel(self):
+        self.canceled.set()
+
+    def _set_priority(self):
+        if self.priority <= 0:
+            return
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.priority))
+        except (AttributeError, PermissionError, OSError) as e:
+            logger.debug(f"Could not raise sequence thread priority: {e}")
+
+    def _wait_until(self, deadline: float) -> bool:
+        # returns False if canceled before the deadline
+        remaining = deadline - time.perf_counter() - SPIN_SECS
+        if remaining > 0 and self.canceled.wait(remaining):
+            return False
+        while time.perf_counter() < deadline:
+            if self.canceled.is_set():
+                return False
+        return not self.canceled.is_set()
+
+    def run(self):
+        self._set_priority()
+        start = time.perf_counter()
+        failed = False
+        try:
+            self._run_steps(start)
+        except Exception as e:
+            failed = True
+            logger.critical(f"Sequence {self.sequence.name} failed, closing {self.sequence.abort}: {e}")
+            self.notify(f"IGNITION FAILED: {e}")
+        finally:
+            # whatever stopped it, the abort drivers end up closed
+            if failed or self.canceled.is_set():
+                self._close_abort_drivers(start)
+        if self.canceled.is_set() and not failed:
+            self.notify("IGNITION CANCELED")
+            logger.warning("Ignition canceled")
+        self._log_timing()
+
+    def _run_steps(self, start: float):
+        steps = self.sequence.steps
+        i = 0
+        while i < len(steps):
+            at = steps[i].at
+            group = []
+            while i < len(steps) and steps[i].at == at:
+                group.append(steps[i])
+                i += 1
+            if not self._wait_until(start + at):
+                return
+            writes = {}
+            for step in group:
+                if step.action in ("open", "close"):
+                    for driver in step.args:
+                        writes[int(driver)] = 1 if step.action == "open" else 0
+            if writes:
+                self.valve_io.write(writes)
+                self.timing.append((at, time.perf_counter() - start, writes))
+            for step in group:
+                if step.action == "message":
+                    self.notify(step.args[0])
+
+    def _close_abort_drivers(self, start: float):
+        try:
+            self.valve_io.write({driver: 0 for driver in self.sequence.abort})
+            self.timing.append(("abort", time.perf_counter() - start, self.sequence.abort))
+        except Exception as e:
+            logger.critical(f"Closing abort drivers {self.sequence.abort} of sequence {self.sequence.name} failed: {e}")
+            self.notify(f"CLOSING ABORT DRIVERS FAILED: {e}")
+
+    def _log_timing(self):
+        errors = []
+        for commanded, actual, writes in self.timing:
+            if commanded == "abort":
+                logger.info(f"Sequence {self.sequence.name}: abort at {actual:.4f} s closed {writes}")
+                continue
+            errors.append(actual - commanded)
+            logger.info(f"Sequence {self.sequence.name}: {writes} commanded {commanded:.4f} s, "
+                        f"actual {actual:.4f} s, error {(actual - commanded) * 1000:.2f} ms")
+        if errors:
+            logger.info(f"Sequence {self.sequence.name} timing error: max {max(errors) * 1000:.2f} ms, "
+                        f"mean {sum(errors) / len(errors) * 1000:.2f} ms")
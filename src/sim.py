@@ -2,18 +2,43 @@ from unittest.mock import patch
 import mock_ljm
 from labjack import ljm
 import configparser
+import argparse
 import logging
 
 logger = logging.getLogger(__name__)
 
+parser = argparse.ArgumentParser(description="Run the full service against a simulated LabJack")
+parser.add_argument("--replay", help="recording (.csv or .ljr) to stream instead of synthesized waveforms")
+parser.add_argument("--speed", type=float, help="stream this many times faster than real time, 0 for as fast as possible")
+parser.add_argument("--sample-rate", type=int, help="override [general] sample_rate")
+parser.add_argument("--reads-per-sec", type=int, help="override [general] reads_per_sec")
+args = parser.parse_args()
+
+overrides = {"general": {}, "sim": {}}
+if args.replay:
+    overrides["sim"]["source"] = args.replay
+if args.speed is not None:
+    overrides["sim"]["speed"] = str(args.speed)
+if args.sample_rate:
+    overrides["general"]["sample_rate"] = str(args.sample_rate)
+if args.reads_per_sec:
+    overrides["general"]["reads_per_sec"] = str(args.reads_per_sec)
+
 # Mock behavior for ConfigParser's read method
 def mock_read(self, filenames, encoding=None):
     # Simulate reading from config_sim.ini
-    return super(configparser.ConfigParser, self).read('config_sim.ini', encoding)
+    read = super(configparser.ConfigParser, self).read('config_sim.ini', encoding)
+    self.read_dict(overrides)
+    return read
+
+# The simulated LabJack streams at the configured rates- see [sim] in config_sim.ini
+sim_config = configparser.ConfigParser()
+sim_config.read('config_sim.ini')
+sim_config.read_dict(overrides)
 
 # Mock ljm when running on a non-LabJack machine
-with patch('labjack.ljm', new=mock_ljm.SimLJM()):
+with patch('labjack.ljm', new=mock_ljm.SimLJM(sim_config)):
     with patch.object(configparser.ConfigParser, 'read', mock_read):
         logger.info("Simulating...")
         import main
-        main.main()
\ No newline at end of file
+        main.main()
@@ -0,0 +1,5 @@
+import sys
+import os
+
+# the service's modules are flat in src/ and import each other by name, like main.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,126 @@
+from acquisition import ScanRingBuffer, StreamReader, StreamTimebase
+from readiness import READINESS
+import numpy as np
+import pytest
+import types
+import time
+import sys
+
+def scans(first: int, rows: int, channels: int = 3) -> np.ndarray:
+    # each row holds its own scan number, so order mistakes show up as wrong values
+    return np.repeat(np.arange(first, first + rows, dtype=np.float64), channels).reshape(rows, channels)
+
+def test_ring_push_pop_in_order():
+    ring = ScanRingBuffer(8, 3)
+    assert ring.push(scans(0, 5)) == 5
+    assert len(ring) == 5
+    indices, out = ring.pop_indexed()
+    assert indices.tolist() == [0, 1, 2, 3, 4]
+    assert np.array_equal(out, scans(0, 5))
+    assert len(ring) == 0
+
+def test_ring_wraps_around():
+    ring = ScanRingBuffer(8, 3)
+    ring.push(scans(0, 6))
+    ring.pop(4)
+    # 2 rows at the end of the buffer, 4 wrapped to the start
+    ring.push(scans(6, 6))
+    indices, out = ring.pop_indexed()
+    assert indices.tolist() == list(range(4, 12))
+    assert np.array_equal(out, scans(4, 8))
+    assert ring.overruns == 0
+
+def test_ring_overrun_drops_the_newest_scans():
+    ring = ScanRingBuffer(8, 3)
+    ring.push(scans(0, 6))
+    assert ring.push(scans(6, 5)) == 2
+    assert ring.overruns == 3
+    indices, out = ring.pop_indexed()
+    assert indices.tolist() == list(range(8))
+    assert np.array_equal(out, scans(0, 8))
+
+def test_ring_continues_scan_indices_after_a_gap():
+    ring = ScanRingBuffer(8, 3)
+    ring.push(scans(0, 2))
+    # e.g. scans lost while reconnecting
+    ring.push(scans(10, 2), first_index=10)
+    ring.push(scans(12, 1))
+    assert ring.pop_indexed()[0].tolist() == [0, 1, 10, 11, 12]
+
+def test_ring_pop_into_fills_views_without_allocating():
+    ring = ScanRingBuffer(8, 3)
+    ring.push(scans(0, 7))
+    ring.pop(5)
+    ring.push(scans(7, 4))
+    block = np.zeros((10, 5))
+    index = np.zeros(10, dtype=np.int64)
+    rows = ring.pop_into(block[:, 1:4], index)
+    assert rows == 6
+    assert index[:rows].tolist() == list(range(5, 11))
+    assert np.array_equal(block[:rows, 1:4], scans(5, 6))
+    assert not block[rows:].any()
+
+def test_timebase_anchors():
+    assert StreamTimebase(100).times([0, 1, 250]).tolist() == [0, 0.01, 2.5]
+    assert StreamTimebase(100, "monotonic", start_monotonic=50).times([0, 100]).tolist() == [50, 51]
+    assert StreamTimebase(100, "core_timer", core_timer=80_000_000).times([10]).tolist() == [2.1]
+    with pytest.raises(Exception):
+        StreamTimebase(100, "wall")
+
+def test_timebase_rate_switch():
+    timebase = StreamTimebase(100)
+    # scan 49 is at 0.49 s, and the first scan at the new rate comes 10 ms after it
+    timebase.add_segment(50, 0.01, 1000)
+    assert timebase.scan_rate == 1000
+    assert timebase.times([0, 49, 50, 51, 1050]).tolist() == [0, 0.49, 0.5, 0.501, 1.5]
+    assert timebase.describe_segments() == [[50, 0.5, 1000.0]]
+
+def test_timebase_stamps_a_block_straddling_switches():
+    timebase = StreamTimebase(100)
+    timebase.add_segment(50, 0.001, 1000)
+    timebase.add_segment(60, 0.5, 100)
+    column = np.arange(45, 65, dtype=np.float64)
+    stamped = timebase.stamp(column)
+    assert stamped is column
+    assert np.all(np.diff(column) > 0)
+    assert column[[4, 5, 14, 15, 16]].tolist() == [0.49, 0.491, 0.5, 1.0, 1.01]
+    # blocks after the last switch take the fast path and agree with it
+    assert timebase.stamp(np.arange(60, 63, dtype=np.float64)).tolist() == column[15:18].tolist()
+
+def fake_ljm(monkeypatch, channels: int):
+    # eStreamRead hands back two scans of zeros per read, with nothing queued behind them
+    def read(handle):
+        time.sleep(0.001)
+        return [0.0] * (2 * channels), 0, 0
+    labjack = types.ModuleType("labjack")
+    labjack.ljm = types.SimpleNamespace(eStreamRead=read)
+    monkeypatch.setitem(sys.modules, "labjack", labjack)
+
+def test_failed_rate_switch_without_reconnect_stops_the_reader(monkeypatch):
+    fake_ljm(monkeypatch, 3)
+
+    def restart(sample_rate, reads_per_sec):
+        raise Exception("USB gone")
+
+    reader = StreamReader(1, ScanRingBuffer(10000, 3), name="test-stream-restart", scan_rate=100,
+                          restart=restart, timebase=StreamTimebase(100))
+    reader.start()
+    done = reader.request_rate(1000, 10)
+    assert done.wait(2)
+    reader.join(2)
+    assert not reader.is_alive()
+    assert str(reader.error) == str(reader.rate_error) == "USB gone"
+    assert READINESS.snapshot()["test-stream-restart"]["state"] == "failed"
+
+def test_rate_switch_adds_a_timebase_segment(monkeypatch):
+    fake_ljm(monkeypatch, 3)
+    timebase = StreamTimebase(100)
+    reader = StreamReader(1, ScanRingBuffer(10000, 3), name="test-stream-switch", scan_rate=100,
+                          restart=lambda sample_rate, reads_per_sec: (sample_rate, time.monotonic()), timebase=timebase)
+    reader.start()
+    done = reader.request_rate(1000, 10)
+    assert done.wait(2)
+    reader.stop()
+    assert reader.rate_error is None
+    assert reader.scan_rate == timebase.scan_rate == 1000
+    assert len(timebase.segments) == 2
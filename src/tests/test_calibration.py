@@ -0,0 +1,95 @@
+from calibration import Calibration
+from configparser import ConfigParser
+import numpy as np
+import pytest
+import os
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIGS = ["config.ini", "config_sim.ini", "sphinx_config.ini", "proxima_config.ini"]
+LEGACY_KEYS = {"thermo": "thermo", "b_load": "big_lc", "k_load": "k_lc", "s_load": "small_lc", "strain": "strain"}
+
+def load(name: str, **sections) -> ConfigParser:
+    config = ConfigParser()
+    config.read(os.path.join(SRC, name))
+    config.read_dict(sections)
+    return config
+
+def legacy_convert(config: ConfigParser, voltages: np.ndarray) -> np.ndarray:
+    # the per-channel conversion Calibration replaced, as it was in labjack_interface._voltages_to_values
+    values = voltages.copy()
+    for i, chan in enumerate(config["sensor_channel_mapping"].keys()):
+        key_prefix = chan[:6]
+        if key_prefix[:4] == "pres":
+            key = chan[:6]
+        else:
+            key = LEGACY_KEYS.get(key_prefix)
+        if key is None:
+            continue
+        values[:, i] = np.round((voltages[:, i] - float(config["conversion"][key + "_offset"])) /
+                                float(config["conversion"][key + "_scale"]), 5)
+    return values
+
+@pytest.mark.parametrize("name", CONFIGS)
+def test_matches_the_legacy_conversion(name):
+    config = load(name)
+    calibration = Calibration.from_config(config)
+    voltages = np.random.default_rng(0).uniform(-10, 10, (2000, len(calibration.channels)))
+    expected = legacy_convert(config, voltages)
+    got = calibration.apply(voltages.copy())
+    # every sensor prefix in the file is covered
+    assert not np.array_equal(got, voltages)
+    np.testing.assert_array_equal(got, expected)
+
+def test_apply_works_in_place_and_convert_matches_it():
+    calibration = Calibration.from_config(load("config.ini"))
+    block = np.random.default_rng(1).uniform(0, 5, (50, len(calibration.channels)))
+    raw = block.copy()
+    assert calibration.apply(block) is block
+    for i in range(len(calibration.channels)):
+        np.testing.assert_allclose(np.round(calibration.convert(raw[:, i], i), 5), block[:, i], atol=1e-9)
+    assert calibration.apply(np.empty((0, len(calibration.channels)))).shape == (0, len(calibration.channels))
+
+def test_nonlinear_polynomial_and_table():
+    config = load("config.ini", nonlinear_calibration={"thermo_1": "table 0.0:-250, 1.25:0, 2.5:250",
+                                                        "pres_4": "polynomial 0.5 520.1 -245.3"})
+    calibration = Calibration.from_config(config)
+    thermo, pres = calibration.channels.index("thermo_1"), calibration.channels.index("pres_4")
+    block = np.zeros((4, len(calibration.channels)))
+    block[:, thermo] = [0, 0.625, 2.5, 3]
+    block[:, pres] = [0, 1, 2, -1]
+    calibration.apply(block)
+    # piecewise linear between the points, clamped outside them
+    assert block[:, thermo].tolist() == [-250, -125, 250, 250]
+    assert block[:, pres].tolist() == [-245.3, 275.3, 796.9, -764.9]
+    assert calibration.describe()["pres_4"] == {"type": "polynomial", "args": ["0.5", "520.1", "-245.3"]}
+
+def test_unknown_nonlinear_kind_and_missing_keys():
+    with pytest.raises(Exception, match="Unknown calibration type 'spline'"):
+        Calibration.from_config(load("config.ini", nonlinear_calibration={"thermo_1": "spline 1 2"}))
+    config = load("config.ini")
+    config.remove_option("conversion", "pres_2_scale")
+    with pytest.raises(Exception, match="pres_2_offset'/'pres_2_scale"):
+        Calibration.from_config(config)
+
+def test_tare_zeroes_the_current_reading():
+    calibration = Calibration.from_config(load("config.ini"))
+    index = calibration.channels.index("b_load_1")
+    voltage = np.array([0.8])
+    reading = calibration.convert(voltage, index)[0]
+    tared = calibration.tare({index: reading})
+    assert tared.convert(voltage, index)[0] == pytest.approx(0, abs=1e-9)
+    # to a target, and leaving the other channels and the original alone
+    tared = calibration.tare({index: reading}, target=10)
+    assert tared.convert(voltage, index)[0] == pytest.approx(10)
+    assert calibration.convert(voltage, index)[0] == reading
+    others = [i for i in range(len(calibration.channels)) if i != index]
+    assert np.array_equal(tared.offset[others], calibration.offset[others])
+    assert np.array_equal(tared.scale, calibration.scale)
+
+def test_tare_refuses_nonlinear_channels():
+    calibration = Calibration.from_config(load("config.ini", nonlinear_calibration={"thermo_1": "table 0:0 1:100"}))
+    index = calibration.channels.index("thermo_1")
+    with pytest.raises(Exception, match="thermo_1 has a nonlinear calibration"):
+        calibration.tare({index: 20.0})
+    # a linear one next to it still works
+    assert calibration.tare({calibration.channels.index("pres_1"): 5.0}).nonlinear == calibration.nonlinear
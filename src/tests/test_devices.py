@@ -0,0 +1,39 @@
+from devices import LabjackDevice
+from mock_ljm import LJMError, SimLJM
+import pytest
+import types
+import sys
+
+@pytest.fixture
+def ljm(monkeypatch):
+    sim = SimLJM()
+    labjack = types.ModuleType("labjack")
+    labjack.ljm = sim
+    monkeypatch.setitem(sys.modules, "labjack", labjack)
+    return sim
+
+def device(ljm) -> LabjackDevice:
+    dev = LabjackDevice("main", "ANY", {"pres_1": "AIN0", "load_1": "AIN2"}, {"load_1": "AIN3"})
+    dev.open()
+    return dev
+
+def test_stream_setup_writes_the_stream_registers(ljm):
+    dev = device(ljm)
+    timebase = dev.stream_setup(1000, 100)
+    assert timebase.scan_rate == 1000
+    assert dev.handle in ljm.streams
+    assert ljm.registers[(dev.handle, "AIN2_NEGATIVE_CH")] == 3
+    assert ljm.registers[(dev.handle, "AIN2_RANGE")] == 1
+
+def test_failed_register_write_closes_without_starting_the_stream(ljm, monkeypatch):
+    dev = device(ljm)
+    def refuse(*args):
+        raise LJMError(1239, None, "LJME_RECONNECT_FAILED")
+    monkeypatch.setattr(ljm, "eWriteNames", refuse)
+    started = []
+    monkeypatch.setattr(ljm, "eStreamStart", lambda *args: started.append(args))
+    with pytest.raises(Exception, match="Failed to configure LabJack data stream on main") as raised:
+        dev.stream_setup(1000, 100)
+    assert isinstance(raised.value.__cause__, LJMError)
+    assert started == []
+    assert dev.handle not in ljm.device_index
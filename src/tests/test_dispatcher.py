@@ -0,0 +1,50 @@
+from dispatcher import CommandDispatcher, CommandRejected
+import dispatcher
+import asyncio
+import json
+
+class StalledSocket():
+    # a dashboard that stopped reading- sends never complete
+    remote_address = ("10.0.0.2", 50000)
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, payload: str):
+        self.sent.append(json.loads(payload))
+        await asyncio.Event().wait()
+
+class Socket(StalledSocket):
+    remote_address = ("10.0.0.3", 50000)
+
+    async def send(self, payload: str):
+        self.sent.append(json.loads(payload))
+
+def test_stalled_client_does_not_hold_up_the_queue(monkeypatch):
+    monkeypatch.setattr(dispatcher, "SEND_TIMEOUT_SECS", 0.05)
+    ran = []
+
+    async def execute(cmd, websocket, received):
+        ran.append(cmd["type"])
+        if cmd["type"] == "History":
+            dispatcher.send_soon(websocket, json.dumps({"type": "History"}))
+        if cmd["type"] == "Bad":
+            raise CommandRejected("nope")
+
+    async def main():
+        stalled, other = StalledSocket(), Socket()
+        async with CommandDispatcher(execute) as commands:
+            for _ in range(3):
+                commands.submit({"type": "History"}, stalled)
+            commands.submit({"type": "Bad", "id": 7}, other)
+            commands.submit({"type": "Actuate", "id": 8}, other)
+            await asyncio.sleep(0.02)
+            assert sorted(ran) == ["Actuate", "Bad", "History", "History", "History"]
+            assert {ack["id"]: ack["status"] for ack in other.sent} == {7: "rejected", 8: "done"}
+            # replies go out in order- each History reply before its ack
+            assert [message["type"] for message in stalled.sent] == ["History", "Ack"] * 3
+            await asyncio.sleep(0.1)
+        # the stalled sends were given up on rather than left waiting
+        assert not dispatcher._sends
+
+    asyncio.run(main())
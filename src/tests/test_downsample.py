@@ -0,0 +1,85 @@
+from downsample import HistoryStore, envelope
+import numpy as np
+import pytest
+
+RATE = 100
+
+def samples(first: int, count: int) -> np.ndarray:
+    # (time, channels) rows, scan i at i / RATE with values that make min/max/mean easy to check
+    i = np.arange(first, first + count)
+    return np.column_stack((i / RATE, i % 7, np.sin(i / 50) * 100))
+
+def filled(rows: int = 10000, chunk: int = 37, **kwargs) -> HistoryStore:
+    store = HistoryStore(RATE, 2, **{"secs": 100, "factor": 10, "min_buckets": 10, **kwargs})
+    for first in range(0, rows, chunk):
+        store.push(samples(first, min(chunk, rows - first)))
+    return store
+
+def brute_force(t, scans: int, first_scan: int = 0):
+    raw = samples(first_scan, 20000)
+    out = []
+    for start in t:
+        index = int(round(start * RATE)) - first_scan
+        rows = raw[index:index + scans, 1:]
+        out.append((rows.min(axis=0), rows.max(axis=0), rows.mean(axis=0)))
+    return [np.array(column) for column in zip(*out)]
+
+def test_pyramid_levels():
+    store = filled(0)
+    assert [level.scans for level in store.levels] == [1, 10, 100, 1000]
+    assert [level.capacity for level in store.levels] == [10000, 1000, 100, 10]
+
+@pytest.mark.parametrize("t0, t1, points, level_scans, scans", [
+    (0, 100, 10, 1000, 1000), # 10 buckets of the coarsest level, as they are
+    (0, 100, 100, 10, 100), # 1000 buckets of the 10 scan level, merged 10 to a point
+    (20, 21.99, 500, 1, 1), # raw samples
+    (20, 29.99, 40, 10, 30), # 100 buckets of 10 scans, 3 to a point
+])
+def test_level_selection(t0, t1, points, level_scans, scans):
+    store = filled()
+    got_scans, t, mins, maxs, means = store.query(t0, t1, points)
+    assert got_scans == scans
+    assert 0 < t.shape[0] <= points
+    assert t[0] == pytest.approx(t0)
+
+def test_merged_points_are_evenly_spaced():
+    store = filled()
+    # 366 buckets of 10 scans down to at most 100 points- 4 buckets each, the last one gets the remaining 2
+    scans, t, mins, maxs, means = store.query(10, 46.59, 100)
+    assert scans == 40
+    assert t.shape[0] == 92
+    np.testing.assert_allclose(np.diff(t), 0.4)
+
+def test_min_max_mean_match_the_raw_samples():
+    store = filled()
+    for t0, t1, points in ((0, 99.99, 10), (10, 46.59, 100), (20, 29.99, 40), (3.3, 7.7, 1000)):
+        scans, t, mins, maxs, means = store.query(t0, t1, points)
+        expected_min, expected_max, expected_mean = brute_force(t[:-1], scans)
+        np.testing.assert_allclose(mins[:-1], expected_min, rtol=1e-6, atol=1e-4)
+        np.testing.assert_allclose(maxs[:-1], expected_max, rtol=1e-6, atol=1e-4)
+        np.testing.assert_allclose(means[:-1], expected_mean, rtol=1e-5, atol=1e-3)
+
+def test_chunking_does_not_change_the_pyramid():
+    a, b = filled(chunk=37), filled(chunk=1000)
+    for level_a, level_b in zip(a.levels, b.levels):
+        assert level_a.head == level_b.head
+        np.testing.assert_array_equal(level_a.times, level_b.times)
+        np.testing.assert_array_equal(level_a.min, level_b.min)
+        np.testing.assert_array_equal(level_a.max, level_b.max)
+        np.testing.assert_allclose(level_a.mean, level_b.mean, rtol=1e-6)
+
+def test_only_the_last_secs_are_kept():
+    store = filled(25000)
+    assert store.latest_time() == pytest.approx(249.99)
+    scans, t, _, _, _ = store.query(0, 1000, 100)
+    assert t[0] >= 150
+    assert store.query(0, 140, 100)[1].shape[0] == 0
+
+def test_envelope_bins():
+    times = np.arange(10) / 10
+    values = np.arange(10, dtype=np.float64)[:, None]
+    t, mins, maxs, means = envelope(times, values, 3)
+    assert t.tolist() == [0, 0.3, 0.6]
+    assert mins[:, 0].tolist() == [0, 3, 6]
+    assert maxs[:, 0].tolist() == [2, 5, 9]
+    assert means[:, 0].tolist() == [1, 4, 7.5]
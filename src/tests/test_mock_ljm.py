@@ -0,0 +1,44 @@
+from configparser import ConfigParser
+from mock_ljm import LJMError, SimLJM
+import pytest
+
+CONFIG = """
+[devices]
+main   = ANY
+second = 470012345 connection=ETHERNET
+
+[sensor_channel_mapping_main]
+pres_1 = AIN0
+
+[sensor_channel_mapping_second]
+thermo_1 = AIN0
+"""
+
+def sim() -> SimLJM:
+    config = ConfigParser()
+    config.read_string(CONFIG)
+    return SimLJM(config)
+
+def channels(ljm: SimLJM, handle: int):
+    return ljm._channels(handle, [0])
+
+def test_devices_are_found_by_identifier_in_any_order():
+    ljm = sim()
+    second = ljm.openS("T7", "ETHERNET", "470012345")
+    main = ljm.openS("T7", "USB", "ANY")
+    assert channels(ljm, main) == ["pres_1"]
+    assert channels(ljm, second) == ["thermo_1"]
+
+def test_reopened_device_keeps_its_channels():
+    ljm = sim()
+    main = ljm.openS("T7", "USB", "ANY")
+    second = ljm.openS("T7", "ETHERNET", "470012345")
+    # the first device drops off and is reconnected while the second stays open
+    ljm.close(main)
+    main = ljm.openS("T7", "USB", "ANY")
+    assert channels(ljm, main) == ["pres_1"]
+    assert channels(ljm, second) == ["thermo_1"]
+
+def test_unknown_identifier_is_not_found():
+    with pytest.raises(LJMError):
+        sim().openS("T7", "USB", "470099999")
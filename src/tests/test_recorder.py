@@ -0,0 +1,219 @@
+from recorder import BackgroundWriter, BinaryRecorder, CsvRecorder, export_csv, read_recording
+from metrics import REGISTRY
+from readiness import READINESS
+import numpy as np
+import threading
+import logging
+import time
+import json
+import csv
+
+COLUMNS = ["Time (s)", "pres_1", "thermo_1", "Skipped"]
+
+def blocks():
+    rng = np.random.default_rng(0)
+    out = []
+    start = 0
+    for rows in (5, 17, 1, 30):
+        block = np.empty((rows, len(COLUMNS)))
+        block[:, 0] = np.round(np.arange(start, start + rows) / 300, 5)
+        block[:, 1:3] = np.round(rng.normal(500, 200, (rows, 2)), 5)
+        block[:, 3] = 0
+        start += rows
+        out.append(block)
+    # a skipped scan, written as NaN
+    out[1][3, 1:3] = np.nan
+    out[1][3, 3] = 1
+    return out
+
+def record(recorder_cls, path, **kwargs):
+    recorder = recorder_cls(str(path), COLUMNS, {"sample_rate": 300}, **kwargs)
+    for block in blocks():
+        recorder.write(block)
+    return recorder
+
+def read_csv(path):
+    with open(path, newline="") as fd:
+        return list(csv.reader(fd))
+
+def test_binary_round_trip_across_chunks(tmp_path):
+    recorder = record(BinaryRecorder, tmp_path / "run.ljr", dtype="float64", chunk_rows=8)
+    recorder.flush()
+    # readable while still recording
+    header, records = read_recording(recorder.path)
+    assert records.shape == (53,)
+    recorder.close()
+    header, records = read_recording(recorder.path)
+    expected = np.concatenate(blocks())
+    assert header["columns"] == COLUMNS
+    assert header["sample_rate"] == 300
+    got = np.column_stack([records[name] for name in records.dtype.names])
+    np.testing.assert_array_equal(got, expected)
+    # the file was truncated to what was written
+    assert (tmp_path / "run.ljr").stat().st_size == recorder.data_offset + 53 * records.dtype.itemsize
+
+def test_update_meta_past_the_initial_slack(tmp_path, caplog):
+    recorder = record(BinaryRecorder, tmp_path / "run.ljr", dtype="float64")
+    initial = len(json.dumps(recorder.header))
+    # more than the slack, but it still fits in front of the page aligned data
+    meta = {"gaps": [[i, 10] for i in range(200)]}
+    assert len(json.dumps(dict(recorder.header, **meta))) > initial + 1024
+    recorder.update_meta(meta)
+    # too big to fit, left as it was
+    with caplog.at_level(logging.WARNING, logger="recorder"):
+        recorder.update_meta({"huge": "x" * recorder.data_offset})
+    assert "no room for ['huge']" in caplog.text
+    recorder.close()
+    header, records = read_recording(recorder.path)
+    assert header["gaps"] == meta["gaps"]
+    assert "huge" not in header
+    assert records.shape == (53,)
+    assert records["pres_1"][0] == blocks()[0][0, 1]
+
+def test_export_matches_the_csv_recorder(tmp_path):
+    binary = record(BinaryRecorder, tmp_path / "run.ljr", dtype="float64", chunk_rows=8)
+    binary.update_meta({"scan_index": 53})
+    binary.close()
+    text = record(CsvRecorder, tmp_path / "direct.csv")
+    text.close()
+    exported = export_csv(binary.path, str(tmp_path / "exported.csv"), chunk_rows=10)
+    assert read_csv(exported) == read_csv(text.path)
+
+def test_float32_export_keeps_values_to_float32_precision(tmp_path):
+    binary = record(BinaryRecorder, tmp_path / "run.ljr", dtype="float32")
+    binary.close()
+    rows = read_csv(export_csv(binary.path))
+    assert rows[0] == COLUMNS
+    got = np.array(rows[1:], dtype=np.float64)
+    expected = np.concatenate(blocks())
+    # time stays float64
+    np.testing.assert_array_equal(got[:, 0], expected[:, 0])
+    np.testing.assert_allclose(got[:, 1:], expected[:, 1:], rtol=1e-6)
+    assert np.isnan(got[8, 1:3]).all()
+
+class StubRecorder():
+    """
+    Stands in for a recorder on a slow or failing disk: write() waits for `gate` and raises on the
+    write numbers in `fail`.
+    """
+    def __init__(self, path: str, fail=(), gate: threading.Event = None):
+        self.path = path
+        self.fail = set(fail)
+        self.gate = gate
+        self.writing = threading.Event()
+        self.calls = 0
+        self.rows = []
+        self.closed = False
+
+    def write(self, block: np.ndarray):
+        self.calls += 1
+        self.writing.set()
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.calls in self.fail:
+            raise OSError(28, "No space left on device")
+        self.rows.extend(block[:, 0].tolist())
+
+    def flush(self):
+        pass
+
+    def sync(self):
+        pass
+
+    def update_meta(self, meta):
+        pass
+
+    def close(self):
+        self.closed = True
+
+def rows(first: int, count: int = 10) -> np.ndarray:
+    return np.arange(first, first + count, dtype=np.float64).reshape(-1, 1).repeat(3, axis=1)
+
+def stalled_writer(tmp_path, name: str, **kwargs):
+    # the thread is stuck in its first write, so everything submitted after it queues up
+    gate = threading.Event()
+    recorder = StubRecorder(str(tmp_path / name), gate=gate)
+    writer = BackgroundWriter(recorder, max_blocks=8, high_water=0.5, **kwargs)
+    writer.start()
+    writer.submit(rows(0))
+    assert recorder.writing.wait(5)
+    return writer, recorder, gate
+
+def test_drop_policy_never_blocks_the_producer(tmp_path):
+    writer, recorder, gate = stalled_writer(tmp_path, "drop.csv", policy="drop")
+    released = []
+    start = time.perf_counter()
+    for i in range(1, 11):
+        writer.submit(rows(i * 10), release=lambda: released.append(1))
+    assert time.perf_counter() - start < 0.5
+    # 4 queued up to the high-water mark, the rest dropped and handed straight back
+    assert writer.stats()["dropped_rows"] == 60
+    assert len(released) == 6
+    gate.set()
+    writer.close()
+    assert len(released) == 10
+    assert recorder.rows == list(range(50))
+    assert writer.stats()["rows_written"] == 50
+    assert recorder.closed
+
+def test_decimate_policy_thins_then_drops_when_full(tmp_path):
+    writer, recorder, gate = stalled_writer(tmp_path, "decimate.csv", policy="decimate", decimation=3)
+    for i in range(1, 11):
+        writer.submit(rows(i * 10))
+    stats = writer.stats()
+    # 6 blocks past the high-water mark keep 4 of their 10 rows, and the last 2 don't fit in the queue at all
+    assert stats["decimated_rows"] == 36
+    assert stats["dropped_rows"] == 8
+    gate.set()
+    writer.close()
+    assert writer.stats()["rows_written"] == 10 + 40 + 16
+    assert recorder.rows[50:54] == [50, 53, 56, 59]
+
+def test_block_policy_waits_for_room(tmp_path):
+    writer, recorder, gate = stalled_writer(tmp_path, "block.csv", policy="block")
+    threading.Timer(0.2, gate.set).start()
+    start = time.perf_counter()
+    for i in range(1, 21):
+        writer.submit(rows(i * 10))
+    assert time.perf_counter() - start >= 0.15
+    writer.close()
+    stats = writer.stats()
+    assert stats["dropped_rows"] == stats["decimated_rows"] == 0
+    assert recorder.rows == list(range(210))
+
+def test_keeps_draining_after_write_errors(tmp_path):
+    recorder = StubRecorder(str(tmp_path / "failing.csv"), fail={2, 3})
+    writer = BackgroundWriter(recorder, policy="block")
+    errors = REGISTRY.counter("recorder_write_errors", "", {"file": "failing.csv"})
+    before = errors.value
+    released = []
+    writer.start()
+    for i in range(5):
+        writer.submit(rows(i * 10), release=lambda: released.append(1))
+    writer.close()
+    assert not writer.is_alive()
+    assert len(released) == 5
+    assert recorder.rows == list(range(10)) + list(range(30, 50))
+    assert writer.stats()["failed_rows"] == 20
+    assert errors.value - before == 2
+    # recovered with the write after the failures
+    assert writer.write_failures == 0
+    assert READINESS.snapshot()["recorder"]["state"] == "ready"
+    assert recorder.closed
+
+def test_a_dead_disk_never_stalls_a_blocking_producer(tmp_path):
+    recorder = StubRecorder(str(tmp_path / "dead.csv"), fail=range(1, 1000))
+    writer = BackgroundWriter(recorder, max_blocks=4, policy="block")
+    writer.start()
+    done = threading.Event()
+
+    def produce():
+        for i in range(50):
+            writer.submit(rows(i * 10))
+        done.set()
+
+    threading.Thread(target=produce, daemon=True).start()
+    assert done.wait(5)
+    writer.close()
+    assert writer.stats()["failed_rows"] == 500
+    assert READINESS.snapshot()["recorder"]["state"] == "failed"
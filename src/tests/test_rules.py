@@ -0,0 +1,114 @@
+from calibration import Calibration
+from configparser import ConfigParser
+from rules import Rule, RuleSet, consecutive
+import numpy as np
+import pytest
+
+CHANNELS = ["pres_1", "pres_3", "thermo_2"]
+# identity calibration, so blocks are in engineering units already
+CALIBRATION = Calibration(CHANNELS, [0, 0, 0], [1, 1, 1])
+
+def block(**columns) -> np.ndarray:
+    rows = len(next(iter(columns.values())))
+    out = np.zeros((rows, len(CHANNELS)))
+    for name, values in columns.items():
+        out[:, CHANNELS.index(name)] = values
+    return out
+
+def rules(*texts, sample_rate: float = 100) -> RuleSet:
+    return RuleSet([Rule(f"rule_{i}", text, CALIBRATION) for i, text in enumerate(texts)], CALIBRATION, sample_rate)
+
+def tripped(ruleset: RuleSet, data: np.ndarray, states=None):
+    return [(rule.name, row) for rule, row in ruleset.evaluate(data, states)]
+
+def test_consecutive_counts_runs_and_carry():
+    mask = np.array([True, True, False, True, True, True])
+    assert consecutive(mask, 0).tolist() == [1, 2, 0, 1, 2, 3]
+    assert consecutive(mask, 4).tolist() == [5, 6, 0, 1, 2, 3]
+    assert consecutive(np.zeros(3, dtype=bool), 2).tolist() == [0, 0, 0]
+
+def test_run_carries_over_between_blocks():
+    ruleset = rules("pres_1 > 1100 for 3 samples")
+    assert tripped(ruleset, block(pres_1=[0, 0, 1200, 1200])) == []
+    assert ruleset.rules[0].strikes == 2
+    assert tripped(ruleset, block(pres_1=[1200, 0])) == [("rule_0", 0)]
+
+def test_interrupted_run_does_not_trip():
+    ruleset = rules("pres_1 > 1100 for 3 samples")
+    assert tripped(ruleset, block(pres_1=[1200, 1200, 0, 1200])) == []
+    assert ruleset.rules[0].strikes == 1
+    assert tripped(ruleset, block(pres_1=[1200, 0, 0])) == []
+    assert ruleset.rules[0].strikes == 0
+
+def test_strikes_reset_on_a_clear_block():
+    ruleset = rules("pres_1 > 1100 for 3 samples")
+    tripped(ruleset, block(pres_1=[0, 1200, 1200]))
+    tripped(ruleset, block(pres_1=[0, 0, 0]))
+    assert ruleset.rules[0].strikes == 0
+    assert tripped(ruleset, block(pres_1=[1200, 0, 0])) == []
+
+def test_rate_across_a_block_boundary():
+    # 2000 psi/s at 100 scans/s is 20 psi per scan
+    ruleset = rules("rate(pres_3) > 2000 psi/s")
+    # the first scan of the first block has nothing to difference against
+    assert tripped(ruleset, block(pres_3=[500, 501, 502])) == []
+    assert tripped(ruleset, block(pres_3=[530, 531])) == [("rule_0", 0)]
+    assert tripped(ruleset, block(pres_3=[532, 533])) == []
+
+def test_falling_rate_rule():
+    ruleset = rules("rate(pres_3) < -1000")
+    tripped(ruleset, block(pres_3=[100, 100]))
+    assert tripped(ruleset, block(pres_3=[100, 80])) == [("rule_0", 1)]
+
+def test_rearms_after_the_condition_clears():
+    ruleset = rules("pres_1 > 1100 for 2 samples")
+    rule = ruleset.rules[0]
+    assert tripped(ruleset, block(pres_1=[1200, 1200, 1200])) == [("rule_0", 1)]
+    # still over- one trip per excursion
+    assert tripped(ruleset, block(pres_1=[1200, 1200])) == []
+    assert not rule.armed
+    assert tripped(ruleset, block(pres_1=[1200, 0])) == []
+    assert rule.armed
+    assert tripped(ruleset, block(pres_1=[0, 1200, 1200])) == [("rule_0", 2)]
+    assert rule.trips == 2
+
+def test_and_binds_tighter_than_or_with_driver_terms():
+    ruleset = rules("thermo_2 > 300 and driver 5 open or pres_1 >= 1500")
+    states = [0] * 6
+    assert tripped(ruleset, block(thermo_2=[400]), states) == []
+    states[5] = 1
+    assert tripped(ruleset, block(thermo_2=[400]), states) == [("rule_0", 0)]
+    ruleset = rules("thermo_2 > 300 and driver 5 open or pres_1 >= 1500")
+    assert tripped(ruleset, block(pres_1=[0, 1500])) == [("rule_0", 1)]
+
+def test_rules_are_independent():
+    ruleset = rules("pres_1 > 1100", "thermo_2 > 300 for 2 samples")
+    assert tripped(ruleset, block(pres_1=[0, 1200], thermo_2=[400, 400])) == [("rule_0", 1), ("rule_1", 1)]
+
+@pytest.mark.parametrize("text, error", [
+    ("pres_1 >> 1100", "Can't parse"),
+    ("pres_1 > lots", "Can't parse"),
+    ("rate(pres_1 > 5", "Can't parse"),
+    ("pres_1 = 1100", "Can't parse"),
+    ("pres_1 > 1100 for three samples", "Can't parse"),
+    ("driver 5 ajar", "Can't parse"),
+    ("pres_1 > 1100 and", "Can't parse"),
+    ("pres_9 > 1100", "unknown sensor 'pres_9'"),
+    ("rate(pres_9) > 1100", "unknown sensor 'pres_9'"),
+])
+def test_bad_rules_are_rejected(text, error):
+    with pytest.raises(Exception, match=error):
+        Rule("bad", text, CALIBRATION)
+
+def test_parse_units_and_samples():
+    rule = Rule("ok", "pres_1 >= -1.5e3 psi for 10 samples", CALIBRATION)
+    assert rule.samples == 10
+    assert rule.channels == {0}
+
+def test_legacy_shutdown_section_becomes_a_rule():
+    config = ConfigParser()
+    config.read_string("[proxima_emergency_shutdown]\nsensor_name = pres_1\nmax_pressure = 1100\nstrikes = 2\n"
+                       "[abort_rules]\nhot = thermo_2 > 300\n")
+    ruleset = RuleSet.from_config(config, CALIBRATION, 100)
+    assert [(rule.name, rule.samples) for rule in ruleset.rules] == [("max_pressure", 2), ("hot", 1)]
+    assert tripped(ruleset, block(pres_1=[1200, 1200])) == [("max_pressure", 1)]
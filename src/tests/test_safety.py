@@ -0,0 +1,70 @@
+from calibration import Calibration
+from configparser import ConfigParser
+from safety import SafetyMonitor
+import numpy as np
+import time
+import os
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.ini")
+
+class FakeValveIO():
+    def __init__(self):
+        self.states = [0] * 8
+        self.writes = []
+
+    def write(self, values):
+        self.writes.append(dict(values))
+
+def setup(enabled: bool = True):
+    config = ConfigParser()
+    config.read(CONFIG)
+    config["proxima_emergency_shutdown"]["enabled"] = str(enabled).lower()
+    calibration = Calibration.from_config(config)
+    valve_io = FakeValveIO()
+    messages = []
+    monitor = SafetyMonitor(config, calibration, valve_io, config["general"].getint("sample_rate"), notify=messages.append)
+    return monitor, valve_io, calibration, messages
+
+def raw_block(calibration: Calibration, pressures) -> np.ndarray:
+    # voltages that calibrate to `pressures` on pres_1 and 0 elsewhere
+    index = calibration.channels.index("pres_1")
+    block = np.tile(calibration.offset, (len(pressures), 1))
+    block[:, index] = np.asarray(pressures) * calibration.scale[index] + calibration.offset[index]
+    return block
+
+def test_config_enables_the_pres_1_rule():
+    monitor, _, _, _ = setup()
+    assert monitor.enabled
+    assert [rule.text for rule in monitor.rules.rules] == ["pres_1 > 1100 for 3 samples"]
+    assert (monitor.valve, monitor.shutdown_state) == (1, 0)
+
+def test_overpressure_closes_the_shutdown_valve_once():
+    monitor, valve_io, calibration, messages = setup()
+    monitor.check(raw_block(calibration, [1000, 1150, 1150]), time.monotonic())
+    assert valve_io.writes == []
+    # the third sample over is row 0 of this block, the read came back 50 ms after the block's last scan
+    read_time = time.monotonic() - 0.05
+    monitor.check(raw_block(calibration, [1150, 1200, 1000, 1000]), read_time)
+    assert valve_io.writes == [{1: 0}]
+    assert monitor.trips == 1
+    assert "pres_1 > 1100 for 3 samples" in messages[-1]
+    # row 0 was sampled 3 scans before the last one
+    assert monitor.last_reaction_time >= 0.05 + 3 / monitor.sample_rate
+    assert monitor.last_reaction_time < 1
+    assert monitor.stats()["max_reaction_time_ms"] == monitor.last_reaction_time * 1000
+
+def test_sustained_overpressure_does_not_write_again():
+    monitor, valve_io, calibration, _ = setup()
+    for _ in range(5):
+        monitor.check(raw_block(calibration, [1200] * 10), time.monotonic())
+    assert valve_io.writes == [{1: 0}]
+    assert monitor.stats()["rule_trips"] == {"max_pressure": 1}
+    # a new excursion after it cleared trips again
+    monitor.check(raw_block(calibration, [0] * 10), time.monotonic())
+    monitor.check(raw_block(calibration, [1200] * 10), time.monotonic())
+    assert valve_io.writes == [{1: 0}, {1: 0}]
+
+def test_disabled_monitor_never_writes():
+    monitor, valve_io, calibration, _ = setup(enabled=False)
+    monitor.check(raw_block(calibration, [5000] * 10), time.monotonic())
+    assert valve_io.writes == []
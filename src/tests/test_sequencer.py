@@ -0,0 +1,107 @@
+from configparser import ConfigParser
+from sequencer import Sequence, SequenceRunner, load_sequences
+import pytest
+
+CONFIG = """
+[driver_mapping]
+0 = FIO0
+1 = FIO1
+2 = FIO2
+
+[sequence_short]
+steps =
+    0 countdown 2 1 T-{n}
+    0 open 1
+    0.05 open 0 2
+    0.05 message go
+    0.1 close 0
+abort = 0 1
+
+[sequence_bad_driver]
+steps =
+    0 open 7
+
+[sequence_bad_action]
+steps =
+    0 spin 1
+"""
+
+class FakeValveIO():
+    def __init__(self, fail_on=None):
+        self.writes = []
+        self.fail_on = fail_on
+
+    def write(self, values):
+        if values == self.fail_on:
+            raise Exception("USB gone")
+        self.writes.append(dict(values))
+
+def load():
+    config = ConfigParser()
+    config.read_string(CONFIG)
+    return load_sequences(config)
+
+def run(sequence, valve_io, cancel_first: bool = False):
+    messages = []
+    runner = SequenceRunner(sequence, valve_io, notify=messages.append)
+    if cancel_first:
+        runner.cancel()
+    runner.start()
+    runner.join(2)
+    assert not runner.is_alive()
+    return runner, messages
+
+def test_invalid_sequences_are_left_out():
+    sequences = load()
+    assert list(sequences) == ["short"]
+
+def test_steps_expand_and_sort():
+    sequence = load()["short"]
+    assert sequence.abort == [0, 1]
+    assert [(step.at, step.action, step.args) for step in sequence.steps] == [
+        (0, "message", ["T-2"]),
+        (0, "open", ["1"]),
+        (0.05, "open", ["0", "2"]),
+        (0.05, "message", ["go"]),
+        (0.1, "close", ["0"]),
+        (1, "message", ["T-1"]),
+    ]
+
+def test_unknown_driver_is_rejected():
+    config = ConfigParser()
+    config.read_string(CONFIG)
+    with pytest.raises(Exception, match="not in \\[driver_mapping\\]"):
+        Sequence.from_config("bad_driver", config["sequence_bad_driver"], config["driver_mapping"])
+
+def test_runs_to_the_end():
+    valve_io = FakeValveIO()
+    runner, messages = run(Sequence("quick", load()["short"].steps[:5], [0, 1]), valve_io)
+    # steps at the same time go out in one write
+    assert valve_io.writes == [{1: 1}, {0: 1, 2: 1}, {0: 0}]
+    assert messages == ["T-2", "go"]
+    assert [commanded for commanded, _, _ in runner.timing] == [0, 0.05, 0.1]
+
+def test_cancel_closes_the_abort_drivers():
+    valve_io = FakeValveIO()
+    runner = SequenceRunner(load()["short"], valve_io, notify=lambda message: None)
+    runner.start()
+    # after the first valve step, well before T-1 at 1 s
+    runner.canceled.wait(0.2)
+    runner.cancel()
+    runner.join(2)
+    assert not runner.is_alive()
+    assert valve_io.writes[-1] == {0: 0, 1: 0}
+    assert {1: 1} in valve_io.writes
+    assert runner.timing[-1][0] == "abort"
+
+def test_cancel_before_start_writes_nothing_but_the_abort():
+    valve_io = FakeValveIO()
+    _, messages = run(load()["short"], valve_io, cancel_first=True)
+    assert valve_io.writes == [{0: 0, 1: 0}]
+    assert messages == ["IGNITION CANCELED"]
+
+def test_failed_write_closes_the_abort_drivers():
+    valve_io = FakeValveIO(fail_on={0: 1, 2: 1})
+    _, messages = run(load()["short"], valve_io)
+    assert valve_io.writes == [{1: 1}, {0: 0, 1: 0}]
+    assert messages[-1] == "IGNITION FAILED: USB gone"
@@ -0,0 +1,103 @@
+from configparser import ConfigParser
+from mock_ljm import SimLJM
+from valve_io import ValveIO
+import pytest
+import types
+import sys
+
+CONFIG = """
+[general]
+valve_state_refresh_ms = 100
+
+[driver_mapping]
+0 = FIO0
+1 = FIO7
+2 = EIO0
+3 = EIO5
+4 = CIO2
+5 = MIO1
+7 = EIO7
+"""
+
+# driver, state register, the register's value with only that driver open
+TABLE = [
+    (0, "FIO_STATE", 0b00000001),
+    (1, "FIO_STATE", 0b10000000),
+    (2, "EIO_STATE", 0b00000001),
+    (3, "EIO_STATE", 0b00100000),
+    (4, "CIO_STATE", 0b00000100),
+    (5, "MIO_STATE", 0b00000010),
+    (7, "EIO_STATE", 0b10000000),
+]
+
+@pytest.fixture
+def ljm(monkeypatch):
+    sim = SimLJM()
+    labjack = types.ModuleType("labjack")
+    labjack.ljm = sim
+    monkeypatch.setitem(sys.modules, "labjack", labjack)
+    return sim
+
+def valves(ljm, refresh_ms: int = 100) -> ValveIO:
+    config = ConfigParser()
+    config.read_string(CONFIG)
+    config["general"]["valve_state_refresh_ms"] = str(refresh_ms)
+    return ValveIO(config, ljm.openS("T7", "USB", "ANY"))
+
+def test_state_registers():
+    io = valves(SimLJM())
+    assert io.state_registers == ["CIO_STATE", "EIO_STATE", "FIO_STATE", "MIO_STATE"]
+    assert io.num_states == 8
+
+@pytest.mark.parametrize("driver, register, value", TABLE)
+def test_driver_maps_to_its_state_bit(ljm, driver, register, value):
+    io = valves(ljm, refresh_ms=0)
+    io.write({driver: 1})
+    registers = dict(zip(io.state_registers, ljm.eReadNames(io.handle, len(io.state_registers), io.state_registers)))
+    assert registers == {reg: value if reg == register else 0 for reg in io.state_registers}
+    states = io.read_states(force=True)
+    assert states == [int(d == driver) for d in range(8)]
+    io.write({driver: 0})
+    assert io.read_states(force=True) == [0] * 8
+
+def test_write_sets_several_drivers_in_one_transaction(ljm, monkeypatch):
+    io = valves(ljm, refresh_ms=0)
+    calls = []
+    write = ljm.eWriteNames
+    monkeypatch.setattr(ljm, "eWriteNames", lambda *args: calls.append(args) or write(*args))
+    io.write({1: 1, 3: True, 4: 5, 7: 0})
+    assert calls == [(io.handle, 4, ["FIO7", "EIO5", "CIO2", "EIO7"], [1, 1, 1, 0])]
+    assert io.read_states(force=True) == [0, 1, 0, 1, 1, 0, 0, 0]
+    assert io.writes == 1
+
+def test_states_are_cached_for_the_refresh_interval(ljm):
+    io = valves(ljm, refresh_ms=60000)
+    assert io.read_states() == [0] * 8
+    # set behind ValveIO's back- the cached states don't see it until a forced or stale read
+    ljm.eWriteName(io.handle, "EIO0", 1)
+    assert io.read_states() == [0] * 8
+    assert io.reads == 1
+    assert io.read_states(force=True) == [0, 0, 1, 0, 0, 0, 0, 0]
+    assert io.reads == 2
+
+def test_write_updates_the_cache(ljm):
+    io = valves(ljm, refresh_ms=60000)
+    io.read_states()
+    io.write({3: 1, 5: 1})
+    assert io.read_states() == [0, 0, 0, 1, 0, 1, 0, 0]
+    io.clear()
+    assert io.read_states() == [0] * 8
+    assert io.reads == 1
+
+def test_stale_cache_is_read_again(ljm):
+    io = valves(ljm, refresh_ms=0)
+    io.read_states()
+    ljm.eWriteName(io.handle, "CIO2", 1)
+    assert io.read_states()[4] == 1
+    assert io.reads == 2
+
+def test_non_dio_names_are_refused():
+    config = ConfigParser()
+    config.read_string("[general]\n[driver_mapping]\n0 = EIO0\n1 = DAC0\n")
+    with pytest.raises(Exception, match="Driver 1 is mapped to 'DAC0'"):
+        ValveIO(config, 0)
@@ -0,0 +1,71 @@
+from configparser import ConfigParser
+from typing import Dict, List
+import logging
+import time
+import re
+
+logger = logging.getLogger(__name__)
+
+DIO_RE = re.compile(r"^(FIO|EIO|CIO|MIO)(\d+)$")
+
+class ValveIO():
+    """
+    Batched digital output access for the drivers in [driver_mapping]. Every write is one eWriteNames
+    transaction, so multi-valve transitions land on the same device tick, and all driver states are read
+    back with a single eReadNames of the *_STATE registers, cached for `valve_state_refresh_ms`.
+    Writes may come from the event loop, the sequencer and the safety monitor threads- LJM itself is thread safe.
+    """
+    def __init__(self, config: ConfigParser, handle: int):
+        self.handle = handle
+        self.driver_mapping = {int(driver): name for driver, name in config["driver_mapping"].items()}
+        self.refresh_interval = config["general"].getfloat("valve_state_refresh_ms", fallback=100) / 1000
+        self.bits = {}
+        for driver, name in self.driver_mapping.items():
+            match = DIO_RE.match(name)
+            if not match:
+                raise Exception(f"Driver {driver} is mapped to '{name}', which is not a digital I/O line")
+            self.bits[driver] = (match[1] + "_STATE", int(match[2]))
+        self.state_registers = sorted(set(reg for reg, _ in self.bits.values()))
+        self.num_states = max(self.driver_mapping) + 1 if self.driver_mapping else 0
+        self.states = None
+        self.last_refresh = 0.0
+        self.writes = 0
+        self.reads = 0
+
+    def write(self, values: Dict[int, int]):
+        """
+        Set several drivers, keyed by driver id, in one transaction.
+        """
+        drivers = [int(driver) for driver in values]
+        names = [self.driver_mapping[driver] for driver in drivers]
+        states = [int(bool(value)) for value in values.values()]
+        # imported here so hosts without the LJM library can still load this module, see devices.py
+        from labjack import ljm
+        ljm.eWriteNames(self.handle, len(names), names, states)
+        self.writes += 1
+        if self.states is not None:
+            cached = list(self.states)
+            for driver, state in zip(drivers, states):
+                cached[driver] = state
+            self.states = cached
+
+    def clear(self):
+        self.write({driver: 0 for driver in self.driver_mapping})
+
+    def read_states(self, force: bool = False) -> List[int]:
+        """
+        States of drivers 0..max id (unmapped ids read 0), refreshed from the device at most once per refresh interval.
+        """
+        now = time.monotonic()
+        if not force and self.states is not None and now - self.last_refresh < self.refresh_interval:
+            return self.states
+        from labjack import ljm
+        raw = ljm.eReadNames(self.handle, len(self.state_registers), self.state_registers)
+        registers = {reg: int(value) for reg, value in zip(self.state_registers, raw)}
+        states = [0] * self.num_states
+        for driver, (reg, bit) in self.bits.items():
+            states[driver] = (registers[reg] >> bit) & 1
+        self.states = states
+        self.last_refresh = now
+        self.reads += 1
+        return states